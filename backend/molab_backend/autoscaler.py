@@ -0,0 +1,248 @@
+import asyncio
+import contextlib
+import logging
+import math
+import os
+import shlex
+import time
+from typing import Any, Optional
+
+from . import metrics
+
+logger = logging.getLogger("backend.autoscaler")
+
+# Fraction of the worker slots that may be busy with the arriving jobs
+TARGET_UTILIZATION = 0.8
+# Seconds over which the arrival rate is averaged
+ARRIVAL_RATE_WINDOW = 300.0
+
+
+def desired_workers(
+    queued: int,
+    in_flight: int,
+    arrival_rate: float,
+    service_time: float,
+    capacity: float,
+    target_wait: float,
+) -> int:
+    """
+    Estimate the number of workers a model needs.
+
+    The arriving jobs keep `arrival_rate * service_time` slots busy (Little's
+    law), which should be at most `TARGET_UTILIZATION` of all slots. On top of
+    that, the queued jobs have to be worked off within `target_wait` seconds.
+    The running jobs keep their workers in any case.
+
+    Args:
+        queued (int): The number of queued jobs.
+        in_flight (int): The number of jobs running on workers.
+        arrival_rate (float): The new jobs per second.
+        service_time (float): The seconds per job on a worker slot.
+        capacity (float): The number of slots per worker.
+        target_wait (float): The seconds in which the queue should be worked off.
+
+    Returns:
+        int: The number of workers, 0 if there is nothing to do.
+    """
+    slots = arrival_rate * service_time / TARGET_UTILIZATION + queued * service_time / target_wait
+    slots = max(slots, in_flight)
+    return math.ceil(slots / capacity - 1e-9)
+
+
+class Autoscaler:
+    """Sizes the workers of every model by its queue and optionally runs them locally.
+
+    Every `interval` seconds, `update` computes the desired number of workers of
+    every model from its queue depth, the rate of new jobs and the measured
+    service time, see `desired_workers`, clamped to `min_workers` and
+    `max_workers`. The desired counts are exposed by `status` and as metric, so
+    external orchestrators can act on them.
+
+    If a `command` is set, the autoscaler also launches worker processes for a
+    model while it has fewer workers than desired, and retires idle workers it
+    launched while it has more. The command is a template formatted with the
+    `model`, which is also passed in `MOLAB_WORKER_CHECKPOINT`. Launched workers
+    are recognized by the `pid` they announce on registration. Scaling up again
+    waits `up_cooldown` seconds, scaling down waits `down_cooldown` seconds
+    after any change, so workers are not started and stopped in quick succession.
+
+    Args:
+        worker_manager (Any): The `WorkerManager` of the gateway.
+        command (str): The command template to start a worker, empty to only
+            compute the desired counts.
+        min_workers (int): The minimum number of workers per model.
+        max_workers (int): The maximum number of workers per model.
+        up_cooldown (float): The seconds between two scale-ups of a model.
+        down_cooldown (float): The seconds after any change before scaling down a model.
+        target_wait (float): The seconds in which a backlog should be worked off.
+    """
+
+    def __init__(
+        self,
+        worker_manager: Any,
+        command: str = "",
+        min_workers: int = 0,
+        max_workers: int = 4,
+        up_cooldown: float = 60.0,
+        down_cooldown: float = 300.0,
+        target_wait: float = 60.0,
+    ):
+        self.worker_manager = worker_manager
+        self.command = command
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.up_cooldown = up_cooldown
+        self.down_cooldown = down_cooldown
+        self.target_wait = target_wait
+        self.processes: dict[str, list[asyncio.subprocess.Process]] = {}
+        self.models: dict[str, dict] = {}
+        self.updated_at: Optional[float] = None
+
+    def status(self) -> dict[str, dict]:
+        """The inputs and the desired number of workers of every model."""
+        return {model: dict(state) for model, state in self.models.items()}
+
+    def _observe(self, model: str, elapsed: float) -> dict:
+        """Update the measurements of a model and compute its desired number of workers."""
+        manager = self.worker_manager
+        state = self.models.setdefault(
+            model, {"arrivals": 0, "arrival_rate": 0.0, "service_time": None, "capacity": 1.0}
+        )
+        workers = [w for w in manager.workers if w.model == model and not w.retiring]
+        service_times = [w.service_time for w in workers if w.service_time is not None]
+        if service_times:
+            state["service_time"] = sum(service_times) / len(service_times)
+        if workers:
+            state["capacity"] = sum(w.capacity for w in workers) / len(workers)
+
+        arrivals = manager.arrivals[model]
+        if elapsed > 0:
+            rate = (arrivals - state["arrivals"]) / elapsed
+            alpha = 1 - math.exp(-elapsed / ARRIVAL_RATE_WINDOW)
+            state["arrival_rate"] += alpha * (rate - state["arrival_rate"])
+        state["arrivals"] = arrivals
+
+        queue = manager.queues.get(model)
+        state["queued"] = len(queue) if queue is not None else 0
+        state["in_flight"] = sum(w.load for w in workers)
+        state["workers"] = len(workers)
+        desired = desired_workers(
+            state["queued"],
+            state["in_flight"],
+            state["arrival_rate"],
+            state["service_time"] or 1.0,
+            state["capacity"],
+            self.target_wait,
+        )
+        state["desired"] = min(self.max_workers, max(self.min_workers, desired))
+        metrics.DESIRED_WORKERS.set(state["desired"], model=model)
+        return state
+
+    async def update(self):
+        """Compute the desired number of workers of every model and scale the local workers."""
+        now = time.monotonic()
+        elapsed = 0.0 if self.updated_at is None else now - self.updated_at
+        self.updated_at = now
+        for model in sorted(self.worker_manager.models):
+            state = self._observe(model, elapsed)
+            if self.command:
+                await self.scale(model, state, now)
+
+    async def scale(self, model: str, state: dict, now: float):
+        """
+        Launch or retire local workers of a model towards its desired number.
+
+        Args:
+            model (str): The model to scale.
+            state (dict): The measurements of the model, see `status`.
+            now (float): Monotonic timestamp of the update.
+        """
+        processes = self.processes.setdefault(model, [])
+        for process in [p for p in processes if p.returncode is not None]:
+            logger.warning(f"Worker process {process.pid} of {model} exited with {process.returncode}")
+            processes.remove(process)
+        pids = {p.pid for p in processes}
+        external = [
+            w for w in self.worker_manager.workers
+            if w.model == model and not w.retiring and w.pid not in pids
+        ]
+        total = len(external) + len(processes)
+        state["launched"] = len(processes)
+        changed_at = state.get("changed_at", -math.inf)
+
+        if state["desired"] > total and now - state.get("scaled_up_at", -math.inf) >= self.up_cooldown:
+            for _ in range(state["desired"] - total):
+                await self.launch(model)
+            state["scaled_up_at"] = state["changed_at"] = now
+        elif state["desired"] < total and now - changed_at >= self.down_cooldown:
+            retired = await self.retire(model, total - state["desired"])
+            if retired:
+                state["changed_at"] = now
+        state["launched"] = len(processes)
+
+    async def launch(self, model: str):
+        """Start a local worker process serving a model."""
+        args = shlex.split(self.command.format(model=model))
+        process = await asyncio.create_subprocess_exec(
+            *args, env={**os.environ, "MOLAB_WORKER_CHECKPOINT": model}
+        )
+        self.processes.setdefault(model, []).append(process)
+        logger.info(f"Launched worker process {process.pid} for {model}")
+
+    async def retire(self, model: str, count: int) -> int:
+        """
+        Stop up to `count` local workers of a model that are starting or idle.
+
+        Idle workers are marked as retiring first, so no job is dispatched to
+        them while they shut down.
+
+        Args:
+            model (str): The model to scale down.
+            count (int): The number of workers to stop.
+
+        Returns:
+            int: The number of stopped workers.
+        """
+        processes = self.processes.get(model, [])
+        async with self.worker_manager.lock:
+            workers = {w.pid: w for w in self.worker_manager.workers if w.pid is not None}
+            # Workers that did not connect yet go first, then idle ones
+            candidates = [p for p in processes if p.pid not in workers]
+            for process in processes:
+                worker = workers.get(process.pid)
+                if worker is not None and worker.load == 0 and not worker.retiring:
+                    candidates.append(process)
+            candidates = candidates[:count]
+            for process in candidates:
+                if process.pid in workers:
+                    workers[process.pid].retiring = True
+        for process in candidates:
+            logger.info(f"Retiring worker process {process.pid} of {model}")
+            processes.remove(process)
+            with contextlib.suppress(ProcessLookupError):
+                process.terminate()
+        return len(candidates)
+
+    async def run(self, interval: float):
+        """
+        Periodically update the desired number of workers and scale the local workers.
+
+        Args:
+            interval (float): The seconds between two updates.
+        """
+        while True:
+            try:
+                await self.update()
+            except Exception:
+                logger.exception("Autoscaler update failed")
+            await asyncio.sleep(interval)
+
+    async def stop(self):
+        """Terminate all launched worker processes and wait for them to exit."""
+        processes = [p for model in self.processes.values() for p in model]
+        self.processes.clear()
+        for process in processes:
+            with contextlib.suppress(ProcessLookupError):
+                process.terminate()
+        for process in processes:
+            await process.wait()
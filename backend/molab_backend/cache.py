@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger("backend.cache")
+
+
+class ResultCache:
+    """Content-addressed cache for inference results.
+
+    Results are stored as encoded binary frames, see `molab_backend.protocol`, and
+    kept in memory in least-recently-used order, bounded by their total size.
+    With a `spill_dir`, every result is also written
+    to disk, so evicted results and results from before a restart can still be
+    served, just a bit slower. Entries older than `ttl` seconds are never served.
+    """
+
+    def __init__(
+        self, max_bytes: int, ttl: float, spill_dir: Optional[Path] = None
+    ):
+        """
+        Initialize the cache and remove expired results from the spill directory.
+
+        Args:
+            max_bytes (int): The maximum total size of the results kept in memory.
+            ttl (float): The number of seconds a result stays valid.
+            spill_dir (Optional[Path]): Directory for the on-disk tier, disabled if None.
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.spill_dir = spill_dir
+        self.entries: OrderedDict[str, tuple[bytes, int, float]] = OrderedDict()
+        self.size = 0
+
+        if self.spill_dir is not None:
+            self.spill_dir.mkdir(parents=True, exist_ok=True)
+            self._prune_spill_dir()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def _is_expired(self, stored_at: float) -> bool:
+        return time.time() - stored_at > self.ttl
+
+    def _spill_path(self, key: str) -> Path:
+        return self.spill_dir / f"{key}.bin"
+
+    def _prune_spill_dir(self):
+        """Delete results in the spill directory that exceeded the TTL."""
+        for path in self.spill_dir.iterdir():
+            if self._is_expired(path.stat().st_mtime):
+                path.unlink(missing_ok=True)
+
+    def _remember(self, key: str, value: bytes, size: int, stored_at: float):
+        """Keep a result in memory and evict the least recently used ones."""
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[1]
+        if size > self.max_bytes:
+            return
+        self.entries[key] = (value, size, stored_at)
+        self.size += size
+        while self.size > self.max_bytes:
+            _, (_, evicted_size, _) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+
+    def _load(self, key: str) -> Optional[tuple[bytes, int, float]]:
+        """Read a result from the spill directory."""
+        path = self._spill_path(key)
+        try:
+            stored_at = path.stat().st_mtime
+            if self._is_expired(stored_at):
+                path.unlink(missing_ok=True)
+                return None
+            data = path.read_bytes()
+        except FileNotFoundError:
+            return None
+        return data, len(data), stored_at
+
+    def _store(self, key: str, data: bytes):
+        """Write a result to the spill directory, atomically replacing older ones."""
+        path = self._spill_path(key)
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_bytes(data)
+        tmp_path.replace(path)
+
+    async def get(self, key: str) -> Optional[bytes]:
+        """
+        Get a cached result.
+
+        Args:
+            key (str): The cache key of the request.
+
+        Returns:
+            Optional[bytes]: The encoded result, or None if it is not cached or expired.
+        """
+        entry = self.entries.get(key)
+        if entry is not None:
+            value, _, stored_at = entry
+            if not self._is_expired(stored_at):
+                self.entries.move_to_end(key)
+                return value
+            self.size -= self.entries.pop(key)[1]
+
+        if self.spill_dir is None:
+            return None
+
+        try:
+            entry = await asyncio.to_thread(self._load, key)
+        except OSError:
+            logger.exception(f"Failed to load cached result {key}")
+            return None
+        if entry is None:
+            return None
+        self._remember(key, *entry)
+        return entry[0]
+
+    async def put(self, key: str, data: bytes):
+        """
+        Cache a result.
+
+        Args:
+            key (str): The cache key of the request.
+            data (bytes): The encoded result.
+        """
+        self._remember(key, data, len(data), time.time())
+        if self.spill_dir is not None:
+            try:
+                await asyncio.to_thread(self._store, key, data)
+            except OSError:
+                logger.exception(f"Failed to spill cached result {key}")
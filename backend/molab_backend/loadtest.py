@@ -0,0 +1,418 @@
+"""Load test of the gateway with simulated workers and clients.
+
+Starts the gateway in a subprocess (or targets a running one with `--url`),
+connects fake workers that sleep for the given service time and answer with
+results of realistic size, and fake clients that keep a number of requests in
+flight each. Reports the throughput, the latency percentiles seen by the
+clients and the CPU and memory used by the gateway. No GPU or checkpoint is
+needed, so it runs on a laptop:
+
+    python -m molab_backend.loadtest --workers 8 --clients 32 --requests 50
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+import uuid
+from dataclasses import dataclass, field
+from typing import Optional
+
+import websockets
+
+from .protocol import ENCODINGS, decode_frame, encode_frame, pack_arrays
+
+# Fields of `InferenceResults` and the joints of the HumanML3D skeleton
+RESULT_ARRAYS = ["root_positions", "joint_rotations", "obs_root_positions", "obs_joint_rotations"]
+N_JOINTS = 22
+
+
+def fake_result(samples: int, frames: int) -> dict:
+    """
+    Build a result with the shapes of real `InferenceResults`.
+
+    Args:
+        samples (int): The number of generated samples.
+        frames (int): The number of frames per sample.
+
+    Returns:
+        dict: The result message without `request_id`.
+    """
+    positions = [[[random.random() for _ in range(3)] for _ in range(frames)] for _ in range(samples)]
+    rotations = [
+        [[[random.random() for _ in range(3)] for _ in range(N_JOINTS)] for _ in range(frames)]
+        for _ in range(samples)
+    ]
+    return {
+        "type": "result",
+        "root_positions": positions,
+        "joint_rotations": rotations,
+        "obs_root_positions": positions,
+        "obs_joint_rotations": rotations,
+    }
+
+
+def fake_request(frames: int) -> dict:
+    """
+    Build an inference request with a start and an end pose, like a simple in-betweening.
+
+    Args:
+        frames (int): The number of frames of the motion.
+
+    Returns:
+        dict: The `infer` message without `request_id`.
+    """
+    pose = [[0.0, 0.0, 0.0] for _ in range(N_JOINTS + 1)]
+    return {"type": "infer", "packed_motion": {0: pose, frames - 1: pose}}
+
+
+def percentile(values: list[float], q: float) -> Optional[float]:
+    """The q-th percentile of the values, using the nearest rank."""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(q / 100 * len(values)) - 1))]
+
+
+@dataclass
+class Report:
+    """Outcome of a load test.
+
+    Args:
+        requests (int): The number of requests sent.
+        results (int): The number of results received.
+        errors (int): The number of errors received.
+        rejected (int): The number of requests rejected as busy.
+        seconds (float): The duration of the load phase.
+        latencies (list[float]): The seconds from sending each request to its result.
+        gateway_cpu_seconds (Optional[float]): The CPU time of the gateway during
+            the load phase, None if it can not be measured.
+        gateway_max_rss_mib (Optional[float]): The peak memory of the gateway process.
+    """
+
+    requests: int = 0
+    results: int = 0
+    errors: int = 0
+    rejected: int = 0
+    seconds: float = 0.0
+    latencies: list[float] = field(default_factory=list)
+    gateway_cpu_seconds: Optional[float] = None
+    gateway_max_rss_mib: Optional[float] = None
+
+    def summary(self) -> dict:
+        """The throughput, latency percentiles and gateway usage."""
+        cpu = self.gateway_cpu_seconds
+        return {
+            "requests": self.requests,
+            "results": self.results,
+            "errors": self.errors,
+            "rejected": self.rejected,
+            "seconds": round(self.seconds, 2),
+            "throughput": round(self.results / self.seconds, 2) if self.seconds else None,
+            **{
+                f"p{q}_latency": None if (v := percentile(self.latencies, q)) is None else round(v, 4)
+                for q in (50, 95, 99)
+            },
+            "gateway_cpu_percent": None if cpu is None else round(100 * cpu / self.seconds, 1),
+            "gateway_max_rss_mib": self.gateway_max_rss_mib,
+        }
+
+
+async def fake_worker(
+    uri: str,
+    capacity: int,
+    service_time: float,
+    jitter: float,
+    samples: int,
+    frames: int,
+    binary: bool,
+    compression: Optional[str] = None,
+):
+    """
+    Serve inference requests by sleeping and sending a precomputed result.
+
+    Args:
+        uri (str): The `/register_worker` URI of the gateway.
+        capacity (int): The number of requests served concurrently.
+        service_time (float): The mean seconds per request.
+        jitter (float): The relative random deviation of the service time.
+        samples (int): The number of samples per result.
+        frames (int): The number of frames per sample.
+        binary (bool): Whether to offer binary frames.
+        compression (Optional[str]): The WebSocket compression, e.g. "deflate".
+    """
+    result = fake_result(samples, frames)
+    header, body = pack_arrays(result, RESULT_ARRAYS)
+    # Only the request ID changes, so the JSON result is encoded once
+    json_tail = json.dumps(result, separators=(",", ":"))[1:]
+    tasks = set()
+
+    async with websockets.connect(uri, max_size=None, compression=compression) as websocket:
+        await websocket.send(json.dumps({
+            "type": "register",
+            "capacity": capacity,
+            "checkpoint": "loadtest",
+            "encodings": ENCODINGS if binary else ["json"],
+        }))
+        use_binary = False
+
+        async def serve(request_id: str):
+            await asyncio.sleep(service_time * random.uniform(1 - jitter, 1 + jitter))
+            if use_binary:
+                await websocket.send(encode_frame({**header, "request_id": request_id}, body))
+            else:
+                await websocket.send(f'{{"request_id":{json.dumps(request_id)},{json_tail}')
+
+        async for message in websocket:
+            if isinstance(message, bytes):
+                message, _ = decode_frame(message)
+            else:
+                message = json.loads(message)
+            if message["type"] == "registered":
+                use_binary = "binary" in message.get("encodings", []) and binary
+            elif message["type"] == "infer":
+                task = asyncio.create_task(serve(message["request_id"]))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+
+async def fake_client(
+    uri: str,
+    requests: int,
+    concurrency: int,
+    frames: int,
+    binary: bool,
+    priority: str,
+    report: Report,
+    compression: Optional[str] = None,
+):
+    """
+    Send requests and keep `concurrency` of them in flight until all are answered.
+
+    Args:
+        uri (str): The `/register_client` URI of the gateway.
+        requests (int): The number of requests to send.
+        concurrency (int): The number of requests in flight at once.
+        frames (int): The number of frames per request.
+        binary (bool): Whether to negotiate binary frames.
+        priority (str): The priority class of the requests.
+        report (Report): Collects the outcomes.
+        compression (Optional[str]): The WebSocket compression, e.g. "deflate".
+    """
+    request = fake_request(frames)
+    sent_at: dict[str, float] = {}
+    remaining = requests
+
+    async with websockets.connect(uri, max_size=None, compression=compression) as websocket:
+
+        async def send():
+            nonlocal remaining
+            remaining -= 1
+            request_id = str(uuid.uuid4())
+            sent_at[request_id] = time.perf_counter()
+            report.requests += 1
+            # A unique prompt, so the requests are not coalesced
+            await websocket.send(json.dumps({
+                **request,
+                "text_prompt": request_id,
+                "request_id": request_id,
+                "priority": priority,
+            }))
+
+        if binary:
+            await websocket.send(json.dumps({"type": "hello", "encodings": ENCODINGS}))
+        for _ in range(min(concurrency, remaining)):
+            await send()
+
+        while sent_at:
+            message = await websocket.recv()
+            if isinstance(message, bytes):
+                message, _ = decode_frame(message)
+            else:
+                message = json.loads(message)
+            if message["type"] not in ("result", "error", "busy"):
+                continue
+            started = sent_at.pop(message.get("request_id"), None)
+            if started is None:
+                continue
+            if message["type"] == "result":
+                report.results += 1
+                report.latencies.append(time.perf_counter() - started)
+            elif message["type"] == "error":
+                report.errors += 1
+            else:
+                report.rejected += 1
+            if remaining:
+                await send()
+
+
+def free_port() -> int:
+    """A port on localhost that is currently not in use."""
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def _cpu_seconds(pid: int) -> Optional[float]:
+    """The CPU time of a process, only available on Linux."""
+    try:
+        with open(f"/proc/{pid}/stat") as file:
+            fields = file.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    # utime and stime, see proc(5)
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def _max_rss_mib_of_children() -> Optional[float]:
+    """The peak memory of the terminated child processes."""
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # Bytes on macOS, KiB everywhere else
+    return round(max_rss / 2**20 if sys.platform == "darwin" else max_rss / 2**10, 1)
+
+
+@contextlib.contextmanager
+def start_gateway(port: int):
+    """Run the gateway in a subprocess until it is ready, stop it on exit."""
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "molab_backend.main:app", "--port", str(port), "--log-level", "warning"],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        for _ in range(100):
+            try:
+                with urllib.request.urlopen(f"http://localhost:{port}/stats", timeout=1):
+                    break
+            except OSError:
+                if process.poll() is not None:
+                    raise RuntimeError("The gateway did not start") from None
+                time.sleep(0.1)
+        else:
+            raise RuntimeError("The gateway did not become ready")
+        yield process
+    finally:
+        process.terminate()
+        process.wait()
+
+
+async def run_load_test(
+    url: str,
+    workers: int,
+    clients: int,
+    requests: int,
+    concurrency: int = 1,
+    capacity: int = 1,
+    service_time: float = 0.5,
+    jitter: float = 0.1,
+    samples: int = 3,
+    frames: int = 196,
+    binary: bool = True,
+    priority: str = "interactive",
+    compression: Optional[str] = None,
+    pid: Optional[int] = None,
+) -> Report:
+    """
+    Run fake workers and clients against a gateway until all requests are answered.
+
+    Args:
+        url (str): The WebSocket base URL of the gateway, e.g. `ws://localhost:8000`.
+        workers (int): The number of fake workers.
+        clients (int): The number of fake clients.
+        requests (int): The number of requests per client.
+        concurrency (int): The number of requests each client keeps in flight.
+        capacity (int): The number of concurrent requests per worker.
+        service_time (float): The mean seconds a worker needs per request.
+        jitter (float): The relative random deviation of the service time.
+        samples (int): The number of samples per result.
+        frames (int): The number of frames per sample.
+        binary (bool): Whether workers and clients use binary frames.
+        priority (str): The priority class of the requests.
+        compression (Optional[str]): The WebSocket compression of workers and
+            clients, None by default so the fake peers do not become the bottleneck.
+        pid (Optional[int]): The process ID of the gateway, to measure its CPU time.
+
+    Returns:
+        Report: The outcomes of the requests.
+    """
+    report = Report()
+    worker_tasks = [
+        asyncio.create_task(
+            fake_worker(
+                f"{url}/register_worker", capacity, service_time, jitter, samples, frames, binary, compression
+            )
+        )
+        for _ in range(workers)
+    ]
+    await asyncio.sleep(0.5)  # Let the workers register
+
+    cpu_before = _cpu_seconds(pid) if pid else None
+    start = time.perf_counter()
+    await asyncio.gather(*[
+        fake_client(
+            f"{url}/register_client", requests, concurrency, frames, binary, priority, report, compression
+        )
+        for _ in range(clients)
+    ])
+    report.seconds = time.perf_counter() - start
+    cpu_after = _cpu_seconds(pid) if pid else None
+    if cpu_before is not None and cpu_after is not None:
+        report.gateway_cpu_seconds = cpu_after - cpu_before
+
+    for task in worker_tasks:
+        task.cancel()
+    await asyncio.gather(*worker_tasks, return_exceptions=True)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--url", help="WebSocket URL of a running gateway, e.g. ws://localhost:8000. Starts a gateway if omitted.")
+    parser.add_argument("--workers", type=int, default=4, help="Number of fake workers.")
+    parser.add_argument("--clients", type=int, default=8, help="Number of fake clients.")
+    parser.add_argument("--requests", type=int, default=25, help="Requests per client.")
+    parser.add_argument("--concurrency", type=int, default=1, help="Requests each client keeps in flight.")
+    parser.add_argument("--capacity", type=int, default=1, help="Concurrent requests per worker.")
+    parser.add_argument("--service-time", type=float, default=0.5, help="Mean seconds per request.")
+    parser.add_argument("--jitter", type=float, default=0.1, help="Relative deviation of the service time.")
+    parser.add_argument("--samples", type=int, default=3, help="Samples per result.")
+    parser.add_argument("--frames", type=int, default=196, help="Frames per sample.")
+    parser.add_argument("--json-only", dest="binary", action="store_false", help="Do not use binary frames.")
+    parser.add_argument("--priority", default="interactive", help="Priority class of the requests.")
+    parser.add_argument(
+        "--deflate",
+        dest="compression",
+        action="store_const",
+        const="deflate",
+        help="Use permessage-deflate like the `websockets` defaults of the real worker.",
+    )
+    args = parser.parse_args()
+
+    options = {k: v for k, v in vars(args).items() if k != "url"}
+    if args.url:
+        report = asyncio.run(run_load_test(args.url, **options))
+    else:
+        with start_gateway(free_port()) as process:
+            port = process.args[process.args.index("--port") + 1]
+            report = asyncio.run(run_load_test(f"ws://localhost:{port}", pid=process.pid, **options))
+        report.gateway_max_rss_mib = _max_rss_mib_of_children()
+
+    summary = report.summary()
+    print(json.dumps({"options": vars(args), **summary}, indent=2))
+    if not report.results:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
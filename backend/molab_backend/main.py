@@ -1,39 +1,827 @@
 import asyncio
+import contextlib
+import hashlib
+import itertools
+import json
 import logging
 import os
+import tempfile
+import time
 import uuid
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Awaitable, Callable, ClassVar, Optional, Union
 
 import uvicorn
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi import Body, FastAPI, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi.responses import FileResponse, PlainTextResponse, StreamingResponse
+
+from . import metrics
+from .autoscaler import Autoscaler
+from .cache import ResultCache
+from .protocol import (
+    ENCODINGS,
+    concat_results,
+    decode_frame,
+    decompress_body,
+    encode_frame,
+    loads,
+    negotiate_compression,
+    patch_request,
+    unpack_arrays,
+    validate_frame,
+)
+from .scheduling import PRIORITIES, HashRing, JobQueue, RequestQueue
+from .spool import JobSpool
+from .sqlite_queue import SQLiteQueue
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger("backend")
 
+# Weight of the latest job in the moving average of a worker's service time
+SERVICE_TIME_SMOOTHING = 0.3
+
+# Fields of client messages that are handled by the gateway and not sent to workers
+GATEWAY_FIELDS = (
+    "request_id",
+    "coalesce",
+    "cache",
+    "priority",
+    "model",
+    "session",
+    "deadline",
+    "max_queue_age",
+    "split",
+)
+
+# Model served by workers that do not announce one and used by requests without `model`
+DEFAULT_MODEL = os.getenv("MOLAB_DEFAULT_MODEL", "random_frames")
+
+# Identifies this gateway process in queues shared with other gateways
+GATEWAY_ID = str(uuid.uuid4())
+
+# Number of recent requests per client that delta requests can be based on
+REQUEST_HISTORY = int(os.getenv("MOLAB_REQUEST_HISTORY", 16))
+
+# Maximum number of samples per part of a split request, 0 to never split
+SPLIT_SAMPLES = int(os.getenv("MOLAB_SPLIT_SAMPLES", 0))
+
+# Number of workers on the hash ring of a session that are preferred for its jobs
+SESSION_AFFINITY_WORKERS = 2
+
+# Messages queued for a connection before its `OUTBOX_POLICY` applies
+OUTBOX_SIZE = int(os.getenv("MOLAB_OUTBOX_SIZE", 256))
+
+# Bytes of message bodies queued for a connection before its `OUTBOX_POLICY` applies
+OUTBOX_BYTES = int(os.getenv("MOLAB_OUTBOX_BYTES", 64 * 2**20))
+
+# Handling of messages for a connection with a full outbox: "shed" drops the
+# `SHEDDABLE_MESSAGES` and closes the connection otherwise, "disconnect" always closes it
+OUTBOX_POLICY = os.getenv("MOLAB_OUTBOX_POLICY", "shed")
+
+# Messages that are superseded by later ones, i.e. progress and position updates
+SHEDDABLE_MESSAGES = ("progress", "queued")
+
+# Messages and bodies of at least this many bytes are decoded, hashed and encoded
+# by the `decode_executor` threads instead of on the event loop
+LARGE_MESSAGE_BYTES = int(os.getenv("MOLAB_LARGE_MESSAGE_BYTES", 64 * 2**10))
+
+# Maximum number of grid points of a sweep request
+MAX_SWEEP_POINTS = int(os.getenv("MOLAB_MAX_SWEEP_POINTS", 1024))
+
+
+def request_hash(message: dict, body: bytes = b"") -> str:
+    """
+    Hash the canonical JSON form of an inference message.
+
+    Args:
+        message (dict): The inference message without the gateway fields.
+        body (bytes): The binary body of the message.
+
+    Returns:
+        str: The hex digest identifying byte-identical requests.
+    """
+    canonical = json.dumps(message, sort_keys=True, separators=(",", ":"))
+    digest = hashlib.sha256(canonical.encode())
+    digest.update(body)
+    return digest.hexdigest()
+
+
+def derive_seed(seed: int, index: int) -> int:
+    """
+    Derive the seed of a part of a split request.
+
+    Args:
+        seed (int): The seed of the request.
+        index (int): The index of the part.
+
+    Returns:
+        int: A reproducible seed, distinct for every part.
+    """
+    digest = hashlib.sha256(f"{seed}:{index}".encode()).digest()
+    return int.from_bytes(digest[:4], "little") >> 1
+
+
+def expand_grid(grid: dict) -> list[dict]:
+    """
+    Expand the parameter grid of a sweep request into its points.
+
+    Args:
+        grid (dict): The values of every swept field, e.g.
+            `{"unpack_mode": ["linear", "step"], "seed": [1, 2]}`.
+
+    Returns:
+        list[dict]: The fields of every point, the Cartesian product of the
+            values in grid order, the last field varying fastest.
+
+    Raises:
+        ValueError: If the grid is empty, has no values for a field, sweeps a
+            field that identifies the request or has more than `MAX_SWEEP_POINTS`
+            points.
+    """
+    if not isinstance(grid, dict) or not grid:
+        raise ValueError("expected the values of every swept field")
+    for name, values in grid.items():
+        if name in ("type", "request_id", "base_request_id"):
+            raise ValueError(f"{name} can not be swept")
+        if not isinstance(values, list) or not values:
+            raise ValueError(f"expected a non-empty list of values for {name}")
+    size = 1
+    for values in grid.values():
+        size *= len(values)
+    if size > MAX_SWEEP_POINTS:
+        raise ValueError(f"{size} points, at most {MAX_SWEEP_POINTS} are allowed")
+    return [dict(zip(grid, values)) for values in itertools.product(*grid.values())]
+
+
+def cache_key(key: str, checkpoint: str) -> str:
+    """
+    Combine a request hash with the checkpoint identity of a worker.
+
+    Args:
+        key (str): The canonical hash of the inference message.
+        checkpoint (str): The checkpoint identity announced by the worker.
+
+    Returns:
+        str: The key of the result in the `ResultCache`.
+    """
+    return hashlib.sha256(f"{key}:{checkpoint}".encode()).hexdigest()
+
+
+async def offload(size: int, func: Callable, *args) -> Any:
+    """
+    Call a function on the `decode_executor` threads if the data is large, directly otherwise.
+
+    Parsing, hashing and encoding a large message would stall all other
+    connections and heartbeats if it ran on the event loop. On a thread, the
+    event loop keeps its turn at the GIL every switch interval, small control
+    messages stay on the event loop to avoid the handoff.
+
+    Args:
+        size (int): The size of the processed data in bytes, compared with
+            `LARGE_MESSAGE_BYTES`.
+        func (Callable): The function to call.
+        *args: The arguments of the function.
+
+    Returns:
+        Any: The return value of the function.
+    """
+    if size < LARGE_MESSAGE_BYTES:
+        return func(*args)
+    metrics.OFFLOADED_CALLS.inc(function=func.__name__)
+    return await asyncio.get_running_loop().run_in_executor(decode_executor, func, *args)
+
+
+def parse_message(text: str) -> dict:
+    """
+    Parse a JSON message, see `molab_backend.protocol.loads`.
+
+    Raises:
+        ValueError: If the text is not a JSON object.
+    """
+    message = loads(text)
+    if not isinstance(message, dict):
+        raise ValueError("Expected a JSON object")  # noqa: TRY004
+    return message
+
+
+async def receive_message(websocket: WebSocket, peer: str) -> tuple[dict, bytes, int]:
+    """
+    Receive a JSON message or binary frame.
+
+    Args:
+        websocket (WebSocket): The WebSocket connection to receive from.
+        peer (str): The kind of peer, "client" or "worker", for the metrics.
+
+    Returns:
+        tuple[dict, bytes, int]: The message header, the binary body, which is
+            empty for JSON messages, and the size of the received data in bytes.
+
+    Raises:
+        WebSocketDisconnect: If the connection was closed.
+        ValueError: If the message is neither a JSON object nor a valid frame.
+    """
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000))
+    if message.get("bytes") is not None:
+        metrics.PAYLOAD_BYTES.observe(
+            len(message["bytes"]), peer=peer, direction="in", encoding="binary"
+        )
+        return (*decode_frame(message["bytes"]), len(message["bytes"]))
+    text = message["text"]
+    metrics.PAYLOAD_BYTES.observe(len(text), peer=peer, direction="in", encoding="json")
+    return await offload(len(text), parse_message, text), b"", len(text)
+
+
+async def monitor_event_loop_lag(interval: float):
+    """
+    Periodically measure how late the event loop wakes up a sleeping task.
+
+    The lag is the time the event loop was blocked, e.g. by decoding a large
+    message, during which no other connection was served.
+
+    Args:
+        interval (float): The seconds between two measurements.
+    """
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        metrics.EVENT_LOOP_LAG.observe(max(0.0, time.perf_counter() - start - interval))
+
+
+class QueueFull(Exception):
+    """Raised when a request is rejected because the queue reached its maximum depth.
+
+    Args:
+        retry_after (float): The estimated seconds until the queue has room again.
+    """
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"The gateway is busy, retry after {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+def encode_json(message: dict, body: bytes = b"") -> str:
+    """Encode a message as JSON, with the arrays of its binary body decoded into the message."""
+    if body:
+        message = unpack_arrays(message, body)
+    return json.dumps(message, separators=(",", ":"), ensure_ascii=False)
+
 
 @dataclass
 class Connection:
     """Simple connection class to handle WebSocket connections.
 
+    Once started, messages are not written to the WebSocket by the sender, but
+    queued in the outbox of the connection and written by its own writer task,
+    so a slow peer only delays its own messages. Outboxes are bounded by
+    `OUTBOX_SIZE` messages and `OUTBOX_BYTES` bytes of bodies, messages for a
+    full outbox are handled according to `OUTBOX_POLICY`. A message that can
+    not be encoded only fails its own request, see `write_failed`, and a
+    writer that stops closes the connection.
+
     Args:
         websocket (WebSocket): The WebSocket connection for the worker or client.
         id (str): The unique identifier for the connection.
+        binary (bool): Whether the peer accepts binary frames, negotiated on connect.
+        compression (list[str]): The body compressions the peer accepts, negotiated on connect.
+        history (OrderedDict[str, tuple[dict, bytes]]): The latest `REQUEST_HISTORY`
+            requests of a client by request ID, the bases of its delta requests.
+        outbox (Optional[asyncio.Queue]): The messages and bodies waiting to be
+            written, None until `start` is called.
+        outbox_bytes (int): The size of the bodies in the outbox.
+        writer (Optional[asyncio.Task]): The task writing the outbox to the WebSocket.
+        closed (bool): Whether the connection was closed, no messages are sent anymore.
+        on_write_error (Optional[Callable[[dict, str], Awaitable[None]]]): Called
+            with a message that could not be written and the reason, e.g. to fail
+            the job sent to a worker. None to answer the peer with an `error`.
     """
 
+    peer: ClassVar[str] = "client"
+
     websocket: WebSocket
     id: str = field(default_factory=lambda: str(uuid.uuid4()))
+    binary: bool = False
+    compression: list[str] = field(default_factory=list)
+    history: OrderedDict[str, tuple[dict, bytes]] = field(default_factory=OrderedDict)
+    outbox: Optional[asyncio.Queue] = field(default=None, repr=False, compare=False)
+    outbox_bytes: int = 0
+    writer: Optional[asyncio.Task] = field(default=None, repr=False, compare=False)
+    closed: bool = False
+    on_write_error: Optional[Callable[[dict, str], Awaitable[None]]] = field(
+        default=None, repr=False, compare=False
+    )
+    closer: Optional[asyncio.Task] = field(default=None, repr=False, compare=False)
+
+    def start(self):
+        """Create the outbox and start the writer task of the connection."""
+        self.outbox = asyncio.Queue()
+        self.writer = asyncio.create_task(self._write_outbox())
+        self.writer.add_done_callback(self._writer_done)
+
+    async def _write_outbox(self):
+        while True:
+            message, body = await self.outbox.get()
+            self.outbox_bytes -= len(body)
+            try:
+                sent = await self.write(message, body)
+            except Exception as e:
+                logger.exception(
+                    f"Failed to write a {message.get('type')} message to {self.peer} {self.id}"
+                )
+                await self.write_failed(message, f"Failed to encode the message: {e}")
+                continue
+            if not sent:
+                self.closed = True
+                return
+
+    def _writer_done(self, writer: asyncio.Task):
+        """Close the connection once its writer stopped, so it can not stall silently."""
+        if writer.cancelled():
+            return
+        if writer.exception() is not None:
+            logger.error(f"Writer of {self.peer} {self.id} failed", exc_info=writer.exception())
+        self.closed = True
+        self.closer = asyncio.ensure_future(self.close(code=1011))
+
+    async def write_failed(self, message: dict, reason: str):
+        """
+        Fail the request of a message that could not be written.
+
+        Args:
+            message (dict): The message that could not be written.
+            reason (str): Why the message could not be written.
+        """
+        if self.on_write_error is not None:
+            await self.on_write_error(message, reason)
+        elif message.get("request_id") is not None and message.get("type") != "error":
+            await self.write({"type": "error", "request_id": message["request_id"], "message": reason})
+
+    async def close(self, code: Optional[int] = None):
+        """
+        Stop sending messages and discard the outbox.
+
+        Args:
+            code (Optional[int]): The close code to close the WebSocket with,
+                None if the peer already disconnected.
+        """
+        self.closed = True
+        if self.writer is not None:
+            self.writer.cancel()
+        if code is not None:
+            with contextlib.suppress(RuntimeError, WebSocketDisconnect):
+                await self.websocket.close(code=code)
+
+    def remember(self, request_id: str, message: dict, body: bytes = b""):
+        """
+        Keep a request as base for delta requests, forgetting the oldest ones.
+
+        Args:
+            request_id (str): The request ID of the client.
+            message (dict): The full inference message.
+            body (bytes): The binary body of the message.
+        """
+        self.history[request_id] = (message, body)
+        self.history.move_to_end(request_id)
+        while len(self.history) > REQUEST_HISTORY:
+            self.history.popitem(last=False)
+
+    def negotiate(self, encodings: list, compression: list = ()) -> dict:
+        """
+        Agree on binary frames and body compressions if the peer supports them.
+
+        Args:
+            encodings (list): The encodings supported by the peer.
+            compression (list): The body compressions supported by the peer.
+
+        Returns:
+            dict: The encodings and common compressions, to reply to the peer.
+        """
+        self.binary = "binary" in encodings
+        self.compression = negotiate_compression(compression) if self.binary else []
+        return {"encodings": ENCODINGS, "compression": self.compression}
+
+    async def send(self, message: dict, body: bytes = b"") -> bool:
+        """
+        Queue a message in the outbox, or write it right away if the connection was not started.
+
+        If the outbox is full, `SHEDDABLE_MESSAGES` are dropped with the "shed"
+        `OUTBOX_POLICY`, all other messages close the connection (code 1013,
+        try again later). Its requests are cancelled like those of any other
+        client that disconnects.
+
+        Args:
+            message (dict): The message to send.
+            body (bytes): The binary body described by the `arrays` of the message.
+
+        Returns:
+            bool: Whether the message was queued or sent, False if the connection
+                is closed or the message was dropped.
+        """
+        if self.closed:
+            return False
+        if self.outbox is None:
+            return await self.write(message, body)
+        if self.outbox.qsize() >= OUTBOX_SIZE or self.outbox_bytes > OUTBOX_BYTES:
+            if OUTBOX_POLICY == "shed" and message.get("type") in SHEDDABLE_MESSAGES:
+                metrics.OUTBOX_OVERFLOWS.inc(peer=self.peer, action="shed")
+                return False
+            logger.warning(
+                f"Outbox of {self.peer} {self.id} is full "
+                f"({self.outbox.qsize()} messages, {self.outbox_bytes} bytes), disconnecting"
+            )
+            metrics.OUTBOX_OVERFLOWS.inc(peer=self.peer, action="disconnect")
+            await self.close(code=1013)
+            return False
+        self.outbox_bytes += len(body)
+        self.outbox.put_nowait((message, body))
+        return True
+
+    async def write(self, message: dict, body: bytes = b"") -> bool:
+        """
+        Write a message to the WebSocket, tolerating connections that are already closed.
+
+        Peers that negotiated binary frames receive the message and body as is,
+        compressed bodies are only decompressed for peers that do not support
+        their compression. Otherwise the body is decoded into the JSON message.
+
+        Args:
+            message (dict): The message to send.
+            body (bytes): The binary body described by the `arrays` of the message.
+
+        Returns:
+            bool: Whether the message was sent.
+        """
+        try:
+            if self.binary and body:
+                compression = message.get("compression")
+                if compression is not None and compression not in self.compression:
+                    message, body = await offload(len(body), decompress_body, message, body)
+                data = encode_frame(message, body)
+                await self.websocket.send_bytes(data)
+                encoding = "binary"
+            else:
+                data = await offload(len(body), encode_json, message, body)
+                await self.websocket.send_text(data)
+                encoding = "json"
+            metrics.PAYLOAD_BYTES.observe(
+                len(data), peer=self.peer, direction="out", encoding=encoding
+            )
+        except (WebSocketDisconnect, RuntimeError):
+            logger.warning(f"Connection {self.id} is closed, dropping message")
+            return False
+        return True
+
+
+@dataclass
+class SpoolConnection(Connection):
+    """Client of the jobs submitted over HTTP, records their outcome in the `JobSpool`.
+
+    The messages about a job update its status record, results are written to
+    disk as binary frames instead of being sent anywhere.
+
+    Args:
+        spool (Optional[JobSpool]): The spool holding the status and results of the jobs.
+    """
+
+    peer: ClassVar[str] = "http"
+
+    spool: Optional[JobSpool] = None
+
+    async def send(self, message: dict, body: bytes = b"") -> bool:
+        """
+        Update the status record of the job the message is about.
+
+        Args:
+            message (dict): The message about a job, tagged with its `request_id`.
+            body (bytes): The binary body of the message.
+
+        Returns:
+            bool: Always True, the spool is never disconnected.
+        """
+        message = dict(message)
+        job_id = message.pop("request_id", None)
+        message_type = message.get("type")
+        if message_type == "queued":
+            fields = {k: message[k] for k in ("position", "estimated_start") if k in message}
+            self.spool.update(job_id, **fields)
+        elif message_type == "progress":
+            progress = {k: message.get(k) for k in ("stage", "step", "total", "eta")}
+            self.spool.update(job_id, status="running", progress=progress)
+        elif message_type == "result":
+            await self.spool.store(job_id, encode_frame(message, body))
+        elif message_type == "error":
+            self.spool.update(job_id, status="failed", error=message.get("message"))
+        elif message_type == "busy":
+            self.spool.update(
+                job_id,
+                status="rejected",
+                error=message.get("message"),
+                retry_after=message.get("retry_after"),
+            )
+        elif message_type == "cancelled":
+            self.spool.update(job_id, status="cancelled")
+        elif message_type == "expired":
+            self.spool.update(job_id, status="expired", error=message.get("message"))
+        return True
+
+
+@dataclass
+class Subscriber:
+    """A client waiting for the outcome of a job under its own request ID.
+
+    Args:
+        client (Connection): The client that sent the request.
+        request_id (str): The client-supplied or gateway-assigned request ID,
+            echoed on every message sent to the client about the job.
+    """
+
+    client: Connection
+    request_id: str
+
+
+@dataclass
+class Job:
+    """A single inference request on its way through the gateway.
+
+    Identical requests are coalesced into one job, so a job can have several
+    subscribers that all receive the same messages.
+
+    Args:
+        message (dict): The inference message without the gateway fields.
+        body (bytes): The binary body of the inference message.
+        key (str): The canonical hash of the inference message.
+        subscribers (list[Subscriber]): The clients waiting for the job.
+        cache (bool): Whether the result can be cached, only requests with a
+            fixed `seed` are deterministic.
+        id (str): The unique identifier for the job, forwarded to and echoed by the worker.
+        dispatched_at (float): Monotonic timestamp of the dispatch to a worker,
+            0 while the job is queued.
+        worker (Optional[Worker]): The worker running the job, None while queued.
+        cancelled (bool): Whether all subscribers cancelled the job.
+        priority (str): The priority class of the job, see `PRIORITIES`.
+        queued_at (float): Monotonic timestamp of the submission.
+        position (Optional[int]): The last queue position sent to the subscribers.
+        attempts (int): The number of times the job was dispatched.
+        created_at (float): Monotonic timestamp of the first request of the job.
+        model (str): The model that has to run the job.
+        remote (bool): Whether the job was queued by another gateway, its
+            outcome is passed back through the shared queue.
+        session (Optional[str]): The session key of the client, jobs of a session
+            prefer the same workers.
+        deadline (Optional[float]): The Unix time after which the job is dropped
+            instead of dispatched, None to wait as long as it takes.
+        parts (list[Job]): The parts of a split job, which are queued instead of it.
+        parent (Optional[Job]): The split job this job is a part of.
+        index (int): The position of the part within its split job.
+        part_results (dict[int, tuple[dict, bytes, Optional[str]]]): The results
+            of the finished parts by index, with the checkpoints that produced them.
+    """
+
+    message: dict
+    body: bytes = b""
+    key: str = ""
+    subscribers: list[Subscriber] = field(default_factory=list)
+    cache: bool = False
+    id: str = field(default_factory=lambda: str(uuid.uuid4()))
+    dispatched_at: float = 0.0
+    worker: Optional["Worker"] = None
+    cancelled: bool = False
+    priority: str = PRIORITIES[0]
+    queued_at: float = field(default_factory=time.monotonic)
+    position: Optional[int] = None
+    attempts: int = 0
+    created_at: float = field(default_factory=time.monotonic)
+    model: str = DEFAULT_MODEL
+    remote: bool = False
+    session: Optional[str] = None
+    deadline: Optional[float] = None
+    parts: list["Job"] = field(default_factory=list, repr=False, compare=False)
+    parent: Optional["Job"] = field(default=None, repr=False, compare=False)
+    index: int = 0
+    part_results: dict[int, tuple[dict, bytes, Optional[str]]] = field(
+        default_factory=dict, repr=False, compare=False
+    )
+
+    async def notify(self, message: dict, body: bytes = b""):
+        """
+        Send a message about this job to all subscribers, tagged with their request IDs.
+
+        Args:
+            message (dict): The message to send.
+            body (bytes): The binary body of the message.
+        """
+        for subscriber in self.subscribers:
+            await subscriber.client.send(
+                {**message, "request_id": subscriber.request_id}, body
+            )
+
+    def encode(self) -> bytes:
+        """Serialize the job for a `JobQueue` shared with other gateways."""
+        return encode_frame(
+            {
+                "id": self.id,
+                "message": self.message,
+                "key": self.key,
+                "cache": self.cache,
+                "priority": self.priority,
+                "model": self.model,
+                "attempts": self.attempts,
+                "session": self.session,
+                "deadline": self.deadline,
+            },
+            self.body,
+        )
+
+    @classmethod
+    def decode(cls, data: bytes) -> "Job":
+        """Rebuild a job queued by another gateway, see `encode`."""
+        header, body = decode_frame(data)
+        return cls(body=body, remote=True, **header)
+
+
+@dataclass
+class Worker(Connection):
+    """Worker connection that keeps track of its capacity and current load.
+
+    Args:
+        capacity (int): The number of jobs the worker can process concurrently,
+            as advertised by the worker on registration.
+        checkpoint (str): The identity of the model checkpoint loaded by the worker.
+        model (str): The name of the model served by the worker, e.g. "random_frames".
+        samplers (list[str]): The samplers supported by the worker.
+        max_frames (Optional[int]): The longest motion the worker generates.
+        device (str): The class of device the worker runs on, e.g. "cpu" or the GPU name.
+        reported_load (int): The number of jobs the worker reported as busy.
+        service_time (Optional[float]): Moving average of the seconds per job,
+            `None` until the first job finished.
+        in_flight (dict[str, Job]): The jobs currently sent to the worker, keyed by job ID.
+        connected_at (float): Monotonic timestamp of the connection.
+        busy_seconds (float): The seconds the worker was busy, weighted by the
+            fraction of used slots, updated by `account`.
+        accounted_at (float): Monotonic timestamp of the last `account`.
+        pid (Optional[int]): The process ID announced by the worker, identifies
+            the workers launched by the `Autoscaler`.
+        retiring (bool): Whether the worker is shutting down, no jobs are
+            dispatched to it anymore.
+    """
+
+    peer: ClassVar[str] = "worker"
+
+    capacity: int = 1
+    checkpoint: str = ""
+    model: str = DEFAULT_MODEL
+    samplers: list[str] = field(default_factory=list)
+    max_frames: Optional[int] = None
+    device: str = ""
+    reported_load: int = 0
+    service_time: Optional[float] = None
+    in_flight: dict[str, Job] = field(default_factory=dict)
+    connected_at: float = field(default_factory=time.monotonic)
+    busy_seconds: float = 0.0
+    accounted_at: float = field(default_factory=time.monotonic)
+    pid: Optional[int] = None
+    retiring: bool = False
+
+    @property
+    def load(self) -> int:
+        """The number of jobs the worker is busy with."""
+        return max(len(self.in_flight), self.reported_load)
+
+    @property
+    def free_slots(self) -> int:
+        """The number of additional jobs the worker can accept right now."""
+        return self.capacity - self.load
+
+    def expected_completion(self, default_service_time: float) -> float:
+        """
+        Estimate the seconds until a new job sent to this worker would be finished.
+
+        Args:
+            default_service_time (float): Service time to assume for workers that
+                did not finish a job yet.
+
+        Returns:
+            float: The expected completion time in seconds.
+        """
+        service_time = self.service_time or default_service_time
+        jobs_ahead = max(0, self.load - self.capacity + 1)
+        return service_time * (1 + jobs_ahead / self.capacity)
+
+    def account(self):
+        """Add the busy time since the last call, must be called before the load changes."""
+        now = time.monotonic()
+        busy = (now - self.accounted_at) * min(self.load, self.capacity) / self.capacity
+        self.busy_seconds += busy
+        self.accounted_at = now
+        metrics.WORKER_BUSY_SECONDS.inc(busy, worker=self.id)
+
+    @property
+    def busy_ratio(self) -> float:
+        """The fraction of its connected time the worker was busy."""
+        connected = self.accounted_at - self.connected_at
+        return self.busy_seconds / connected if connected > 0 else 0.0
+
+    def record_service_time(self, seconds: float):
+        """Update the moving average of the service time with a finished job."""
+        if self.service_time is None:
+            self.service_time = seconds
+        else:
+            alpha = SERVICE_TIME_SMOOTHING
+            self.service_time = alpha * seconds + (1 - alpha) * self.service_time
 
 
 class WorkerManager:
-    """Worker manager class to manage worker connections using round-robin scheduling."""
+    """Worker manager class to manage worker connections using load-aware scheduling.
 
-    def __init__(self):
-        self.workers: list[Connection] = []
+    Requests are dispatched as soon as a suitable worker has a free slot, so every
+    connected worker is kept busy at once. Only workers serving the requested
+    model are suitable, of those the one with the shortest expected completion
+    time is chosen, based on its advertised capacity, its current load and the
+    measured service time of its previous jobs.
+    Results are read by the connection handler of each worker and routed back
+    to the client via the job ID.
+    Cancelled jobs are skipped when they are taken from the queue, or cancelled
+    on the worker if they are already running.
+    Every model has its own queue and dispatcher, so a saturated model does not
+    hold up the requests of another one. Queued jobs are ordered by their
+    priority class first and then fairly shared between the clients, see
+    `RequestQueue`. New jobs are rejected once `max_queue_depth` jobs are queued
+    for their model.
+    Jobs asking for more samples than the split size are split into parts with
+    derived seeds, which are queued separately so idle workers run them in
+    parallel, see `split`. Their results are merged back in order by `gather`,
+    a failing part fails the whole job.
+    Jobs with a `deadline` are dispatched earliest deadline first within their
+    priority class, and dropped with an `expired` message once their deadline
+    passed before a worker picked them up.
+    Jobs with a `session` key prefer the first `SESSION_AFFINITY_WORKERS`
+    workers of the session on the consistent hash ring of their model, as long
+    as one of them has a free slot, so the caches of the workers stay hot while
+    an animator iterates on a shot. Workers joining or leaving only move the
+    sessions next to them on the ring.
+    Jobs in flight on a worker that disconnects are queued again at the head of
+    the queue, until they were dispatched `max_retries` + 1 times.
+    The queues are created by `queue_factory`, with a queue shared between
+    several gateways, e.g. `SQLiteQueue`, jobs are dispatched to the workers of
+    any gateway and their outcome is relayed back by `collect_results`.
+
+    Args:
+        cache (Optional[ResultCache]): Cache for the results of deterministic requests.
+        max_queue_depth (int): The maximum number of queued jobs, 0 for unbounded.
+        max_retries (int): How often a job is retried after losing its worker.
+        queue_factory (Optional[Callable[[str], JobQueue]]): Creates the queue of
+            a model, an in-memory `RequestQueue` by default.
+    """
+
+    def __init__(
+        self,
+        cache: Optional[ResultCache] = None,
+        max_queue_depth: int = 0,
+        max_retries: int = 2,
+        queue_factory: Optional[Callable[[str], JobQueue]] = None,
+    ):
+        self.workers: list[Worker] = []
         self.lock = asyncio.Lock()
+        self.worker_available = asyncio.Condition(self.lock)
         self.next_worker = 0
-        self.request_queue = asyncio.Queue()
+        self.queue_factory = queue_factory or (lambda model: RequestQueue())
+        self.queues: dict[str, JobQueue] = {}
+        self.dispatchers: dict[str, asyncio.Task] = {}
+        self.pending: dict[str, Job] = {}
+        self.subscriptions: dict[tuple[str, str], Job] = {}
+        self.stats = Counter()
+        self.arrivals = Counter()
+        self.cache = cache
+        self.checkpoints: dict[str, set[str]] = {}
+        self.rings: dict[str, HashRing] = {}
+        self.max_queue_depth = max_queue_depth
+        self.max_retries = max_retries
 
-    async def register(self, websocket: WebSocket) -> Connection:
+    @property
+    def models(self) -> set[str]:
+        """The default model and all models announced by workers so far."""
+        return {DEFAULT_MODEL, *self.checkpoints}
+
+    def queue(self, model: str) -> JobQueue:
+        """
+        Get the queue of a model, starting its dispatcher on first use.
+
+        Args:
+            model (str): The name of the model.
+
+        Returns:
+            JobQueue: The queue of the model.
+        """
+        if model not in self.queues:
+            self.queues[model] = self.queue_factory(model)
+            self.dispatchers[model] = asyncio.create_task(self.process_requests(model))
+        return self.queues[model]
+
+    async def register(self, websocket: WebSocket) -> Worker:
         """
         Register a new worker.
 
@@ -41,59 +829,700 @@ class WorkerManager:
             websocket (WebSocket): The WebSocket connection for the worker.
 
         Returns:
-            Connection: The registered worker instance.
+            Worker: The registered worker instance.
         """
-        worker = Connection(websocket)
+        worker = Worker(websocket)
+        worker.on_write_error = lambda message, reason: self.fail_dispatch(worker, message, reason)
+        worker.start()
         async with self.lock:
             self.workers.append(worker)
+            self.rings.setdefault(worker.model, HashRing()).add(worker.id)
             logger.info(
                 f"Worker {worker.id} connected. Total workers: {len(self.workers)}"
             )
+            self.worker_available.notify_all()
         return worker
 
-    async def unregister(self, worker: Connection):
+    async def fail_dispatch(self, worker: Worker, message: dict, reason: str):
+        """
+        Fail a job whose message could not be written to its worker.
+
+        Args:
+            worker (Worker): The worker the job was dispatched to.
+            message (dict): The `infer` message of the job.
+            reason (str): Why the message could not be written.
+        """
+        if message.get("type") == "infer":
+            await self.handle_result(
+                worker, {"type": "error", "request_id": message.get("request_id"), "message": reason}
+            )
+
+    async def unregister(self, worker: Worker):
         """
-        Unregister an existing worker.
+        Unregister an existing worker and retry its in-flight jobs.
 
         Args:
-            worker (Connection): The worker instance to unregister.
+            worker (Worker): The worker instance to unregister.
         """
         async with self.lock:
             self.workers.remove(worker)
+            self.rings[worker.model].remove(worker.id)
             logger.info(
                 f"Worker {worker.id} disconnected. Total workers: {len(self.workers)}"
             )
             if len(self.workers) > 0:
                 self.next_worker = self.next_worker % len(self.workers)
+            await worker.close()
+            dropped = list(worker.in_flight.values())
+            worker.in_flight.clear()
+            for metric in (
+                metrics.WORKER_CAPACITY,
+                metrics.WORKER_LOAD,
+                metrics.WORKER_BUSY_SECONDS,
+                metrics.WORKER_BUSY_RATIO,
+            ):
+                metric.remove(worker=worker.id)
 
-    async def get_next_worker(self) -> Connection:
+        if dropped:
+            logger.warning(f"Worker {worker.id} dropped {len(dropped)} in-flight job(s)")
+        for job in dropped:
+            await self.retry(job, f"Worker {worker.id} disconnected")
+
+    async def retry(self, job: Job, reason: str):
+        """
+        Queue a job that lost its worker again, or fail it once its retries are used up.
+
+        Args:
+            job (Job): The job that was in flight.
+            reason (str): Why the job has to be retried.
+        """
+        job.worker = None
+        job.dispatched_at = 0.0
+        if job.cancelled:
+            return
+        if job.attempts > self.max_retries:
+            self.stats["failed"] += 1
+            logger.error(f"Job {job.id} failed after {job.attempts} attempts: {reason}")
+            self._forget(job)
+            await self.complete(job, {
+                "type": "error",
+                "message": f"{reason}, giving up after {job.attempts} attempts",
+            })
+            return
+        self.stats["retried"] += 1
+        logger.info(f"Retrying job {job.id} ({reason})")
+        job.queued_at = time.monotonic()
+        await self.queue(job.model).requeue(job, job.priority)
+
+    def _forget(self, job: Job):
+        """Remove a finished job from the coalescing and cancellation indices."""
+        if self.pending.get(job.key) is job:
+            del self.pending[job.key]
+        for subscriber in job.subscribers:
+            self.subscriptions.pop((subscriber.client.id, subscriber.request_id), None)
+
+    async def update_worker(self, worker: Worker, message: dict):
+        """
+        Update the worker from a `register` or `status` message.
+
+        Args:
+            worker (Worker): The worker that sent the message.
+            message (dict): The message containing `capacity`, `load` and/or the
+                capabilities `model`, `checkpoint`, `samplers`, `max_frames`, `device`
+                and `pid`.
+        """
+        async with self.worker_available:
+            worker.account()
+            if "capacity" in message:
+                worker.capacity = max(1, int(message["capacity"]))
+                logger.info(f"Worker {worker.id} has a capacity of {worker.capacity}")
+            if "model" in message:
+                self.rings[worker.model].remove(worker.id)
+                worker.model = str(message["model"])
+                self.rings.setdefault(worker.model, HashRing()).add(worker.id)
+                self.checkpoints.setdefault(worker.model, set())
+                logger.info(f"Worker {worker.id} serves model {worker.model}")
+            if "checkpoint" in message:
+                worker.checkpoint = str(message["checkpoint"])
+                self.checkpoints.setdefault(worker.model, set()).add(worker.checkpoint)
+                logger.info(f"Worker {worker.id} uses checkpoint {worker.checkpoint}")
+            if "samplers" in message:
+                worker.samplers = [str(s) for s in message["samplers"]]
+            if "max_frames" in message:
+                worker.max_frames = int(message["max_frames"])
+            if "device" in message:
+                worker.device = str(message["device"])
+            if "pid" in message:
+                worker.pid = int(message["pid"])
+            if "load" in message:
+                worker.reported_load = max(0, int(message["load"]))
+            self.worker_available.notify_all()
+
+    def _default_service_time(self, workers: list[Worker]) -> float:
+        """The mean service time of the given workers with measurements, 1s otherwise."""
+        known = [w.service_time for w in workers if w.service_time is not None]
+        return sum(known) / len(known) if known else 1.0
+
+    async def get_next_worker(self, model: str = DEFAULT_MODEL) -> Worker:
         """
-        Get the next available worker using round-robin scheduling.
+        Get the worker of a model with the shortest expected completion time.
+
+        Waits while no worker of the model is connected or the best worker has
+        no free slot, a slower worker is only used if it would still finish the
+        job first. Ties are broken round-robin.
+
+        Args:
+            model (str): The model the worker has to serve.
 
         Returns:
-            Connection: The next available worker instance.
+            Worker: The next available worker instance.
         """
-        async with self.lock:
-            worker = self.workers[self.next_worker]
-            self.next_worker = (self.next_worker + 1) % len(self.workers)
-        return worker
+        async with self.worker_available:
+            while True:
+                n_workers = len(self.workers)
+                rotated = self.workers[self.next_worker :] + self.workers[: self.next_worker]
+                candidates = [w for w in rotated if w.model == model and not w.retiring]
+                if candidates:
+                    default_service_time = self._default_service_time(candidates)
+                    worker = min(
+                        candidates,
+                        key=lambda w: w.expected_completion(default_service_time),
+                    )
+                    if worker.free_slots > 0:
+                        self.next_worker = (self.workers.index(worker) + 1) % n_workers
+                        return worker
+                await self.worker_available.wait()
+
+    def session_worker(self, session: str, model: str = DEFAULT_MODEL) -> Optional[Worker]:
+        """
+        Get the preferred worker of a session that has a free slot.
+
+        Args:
+            session (str): The session key of the job.
+            model (str): The model the worker has to serve.
+
+        Returns:
+            Optional[Worker]: The first of the session's `SESSION_AFFINITY_WORKERS`
+                workers on the hash ring with a free slot, None if all are busy.
+        """
+        if model not in self.rings:
+            return None
+        workers = {w.id: w for w in self.workers if w.model == model and not w.retiring}
+        ring = self.rings[model]
+        for worker_id in itertools.islice(ring.nodes(session), SESSION_AFFINITY_WORKERS):
+            worker = workers.get(worker_id)
+            if worker is not None and worker.free_slots > 0:
+                return worker
+        return None
+
+    def estimate_start(self, position: int, model: str = DEFAULT_MODEL) -> Optional[float]:
+        """
+        Estimate the seconds until the job at the given queue position is dispatched.
+
+        Based on the throughput of the workers of the model, i.e. their
+        capacities and measured service times.
+
+        Args:
+            position (int): The number of jobs queued ahead of the job.
+            model (str): The model of the queue.
+
+        Returns:
+            Optional[float]: The estimated seconds, None if no worker of the model
+                is connected.
+        """
+        workers = [w for w in self.workers if w.model == model]
+        if not workers:
+            return None
+        default_service_time = self._default_service_time(workers)
+        throughput = sum(
+            w.capacity / (w.service_time or default_service_time) for w in workers
+        )
+        free_slots = sum(max(0, w.free_slots) for w in workers)
+        return max(0, position + 1 - free_slots) / throughput
+
+    async def notify_position(self, job: Job, position: int):
+        """
+        Send the queue position and estimated start of a job to its subscribers.
+
+        Args:
+            job (Job): The queued job.
+            position (int): The number of jobs queued ahead of the job.
+        """
+        job.position = position
+        estimated_start = self.estimate_start(position, job.model)
+        await job.notify({
+            "type": "queued",
+            "position": position,
+            "estimated_start": None if estimated_start is None else round(estimated_start, 1),
+        })
+
+    async def expire(self, job: Job):
+        """
+        Drop a job whose deadline passed before it was dispatched and tell its subscribers.
+
+        Args:
+            job (Job): The job taken from or still in the queue.
+        """
+        self.stats["expired"] += 1
+        metrics.EXPIRED_REQUESTS.inc(priority=job.priority)
+        logger.info(f"Job {job.id} expired before it was dispatched")
+        self._forget(job)
+        await self.complete(job, {
+            "type": "expired",
+            "message": "The deadline of the request passed before it was dispatched",
+        })
 
-    async def process_requests(self):
+    async def report_positions(self, interval: float):
+        """
+        Periodically drop expired jobs and send updated queue positions to the
+        subscribers of all queued jobs.
+
+        Args:
+            interval (float): The seconds between two updates.
+        """
         while True:
-            client, message = await self.request_queue.get()
-            worker = await self.get_next_worker()
-            await worker.websocket.send_json(message)
-            result = await worker.websocket.receive_json()
-            await client.websocket.send_json(result)
-            self.request_queue.task_done()
+            await asyncio.sleep(interval)
+            now = time.time()
+            for queue in list(self.queues.values()):
+                for _, job in queue.positions():
+                    if job.deadline is not None and job.deadline < now and queue.remove(job):
+                        await self.expire(job)
+                reported = set()
+                for position, job in queue.positions():
+                    job = job.parent or job  # Split jobs are at the position of their first part
+                    if id(job) in reported:
+                        continue
+                    reported.add(id(job))
+                    if job.position != position and not job.cancelled:
+                        await self.notify_position(job, position)
+
+    async def submit(
+        self,
+        client: Connection,
+        message: dict,
+        body: bytes,
+        request_id: str,
+        coalesce: bool = True,
+        cache: bool = True,
+        priority: str = PRIORITIES[0],
+        model: str = DEFAULT_MODEL,
+        session: Optional[str] = None,
+        deadline: Optional[float] = None,
+        split: int = SPLIT_SAMPLES,
+        size: int = 0,
+    ) -> Optional[Job]:
+        """
+        Queue an inference request, or attach it to an identical queued or running job.
+
+        Requests with a fixed `seed` are deterministic and answered from the cache
+        if any known checkpoint of the model already produced their result.
+        The request is acknowledged with a `queued` message, which carries the
+        queue position and estimated start if the request has to wait.
+
+        Args:
+            client (Connection): The client sending the request.
+            message (dict): The inference message without the gateway fields.
+            body (bytes): The binary body of the inference message.
+            request_id (str): The request ID of the client.
+            coalesce (bool): Whether the request may share the job of an identical
+                request. Defaults to True.
+            cache (bool): Whether the request may be answered from and stored in
+                the cache. Defaults to True.
+            priority (str): The priority class of the request, one of `PRIORITIES`.
+                Defaults to "interactive".
+            model (str): The model that has to run the request, see `models`.
+                Defaults to `DEFAULT_MODEL`.
+            session (Optional[str]): The session key of the client, see `session_worker`.
+            deadline (Optional[float]): The Unix time after which the request is
+                dropped if it was not dispatched yet, None for no deadline.
+            split (int): The maximum number of samples per part, requests for more
+                `num_samples` are split, 0 to never split. Defaults to `SPLIT_SAMPLES`.
+            size (int): The size of the received request in bytes, large requests
+                are hashed off the event loop, see `offload`.
+
+        Returns:
+            Optional[Job]: The new or the existing job, None for cache hits.
+
+        Raises:
+            QueueFull: If the request needs a new job, but the queue is full.
+        """
+        received_at = time.monotonic()
+        subscriber = Subscriber(client, request_id)
+        queued = {"type": "queued", "request_id": request_id}
+        num_samples = message.get("num_samples")
+        split = split if isinstance(num_samples, int) and 0 < split < num_samples else 0
+        # The partition and seeds of the parts change the result
+        key = await offload(
+            size,
+            request_hash,
+            {**message, "model": model, **({"split": split} if split else {})},
+            body,
+        )
+        request_queue = self.queue(model)
+        self.stats["requests"] += 1
+
+        cache = cache and self.cache is not None and message.get("seed") is not None
+        if cache:
+            for checkpoint in self.checkpoints.get(model, ()):
+                frame = await self.cache.get(cache_key(key, checkpoint))
+                if frame is not None:
+                    self.stats["cache_hits"] += 1
+                    metrics.CACHE_LOOKUPS.inc(result="hit")
+                    logger.info(f"Request {request_id} answered from cache")
+                    result, result_body = decode_frame(frame)
+                    await client.send(queued)
+                    await client.send({**result, "request_id": request_id}, result_body)
+                    metrics.REQUEST_LATENCY.observe(
+                        time.monotonic() - received_at, outcome="cache_hit"
+                    )
+                    return None
+            self.stats["cache_misses"] += 1
+            metrics.CACHE_LOOKUPS.inc(result="miss")
+
+        job = self.pending.get(key) if coalesce else None
+        if job is not None:
+            job.subscribers.append(subscriber)
+            self.subscriptions[client.id, request_id] = job
+            if any([request_queue.promote(part, client.id, priority) for part in job.parts or [job]]):
+                job.priority = priority
+            if job.deadline is not None:
+                # Only drop the job once no subscriber is waiting for it anymore
+                job.deadline = None if deadline is None else max(job.deadline, deadline)
+                for part in job.parts:
+                    part.deadline = job.deadline
+            self.stats["coalesced_running" if job.dispatched_at else "coalesced_queued"] += 1
+            logger.info(
+                f"Request {request_id} attached to job {job.id} "
+                f"({len(job.subscribers)} subscribers)"
+            )
+            await client.send(queued)
+            return job
+
+        if self.max_queue_depth and len(request_queue) >= self.max_queue_depth:
+            self.stats["rejected"] += 1
+            estimated_start = self.estimate_start(len(request_queue) - self.max_queue_depth, model)
+            raise QueueFull(max(1.0, estimated_start or 10.0))
+
+        job = Job(
+            message,
+            body,
+            key,
+            [subscriber],
+            cache=cache,
+            priority=priority,
+            model=model,
+            session=session,
+            deadline=deadline,
+        )
+        self.subscriptions[client.id, request_id] = job
+        if coalesce:
+            self.pending[key] = job
+        if split:
+            job.parts = self.split(job, split)
+            self.stats["split_jobs"] += 1
+            logger.info(f"Split job {job.id} into {len(job.parts)} parts")
+        for part in job.parts or [job]:
+            await request_queue.put(part, client.id, priority, deadline=deadline)
+        self.arrivals[model] += len(job.parts) or 1
+        for position, queued_job in request_queue.positions():
+            if queued_job is job or queued_job.parent is job:
+                await self.notify_position(job, position)
+                break
+        else:  # Already dispatched
+            await client.send(queued)
+        return job
+
+    def split(self, job: Job, size: int) -> list[Job]:
+        """
+        Split a job into parts with at most `size` samples each.
+
+        Args:
+            job (Job): The job asking for more than `size` samples.
+            size (int): The maximum number of samples per part.
+
+        Returns:
+            list[Job]: The parts, with seeds derived from the job's seed.
+        """
+        num_samples = job.message["num_samples"]
+        seed = job.message.get("seed")
+        parts = []
+        for index, start in enumerate(range(0, num_samples, size)):
+            message = {**job.message, "num_samples": min(size, num_samples - start)}
+            if seed is not None:
+                message["seed"] = derive_seed(seed, index)
+            parts.append(Job(
+                message,
+                job.body,
+                f"{job.key}:{index}",
+                priority=job.priority,
+                model=job.model,
+                session=job.session,
+                deadline=job.deadline,
+                parent=job,
+                index=index,
+            ))
+        return parts
+
+    async def process_requests(self, model: str):
+        """Dispatch the queued requests of a model to workers without waiting for their results.
+
+        Keeps running no matter what happens to a single job or worker.
+
+        Args:
+            model (str): The model whose queue is processed.
+        """
+        while True:
+            try:
+                await self.dispatch_next(model)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Failed to dispatch a job")
+
+    async def dispatch_next(self, model: str):
+        """
+        Wait for a queued job and a free worker of a model, then send the job to the worker.
+
+        Args:
+            model (str): The model whose queue is processed.
+        """
+        request_queue = self.queue(model)
+        # Only pick the job once a worker is free, so it is the most
+        # important one at that time
+        await request_queue.wait()
+        worker = await self.get_next_worker(model)
+        try:
+            job, priority = request_queue.get_nowait()
+        except IndexError:
+            return  # Taken by another gateway in the meantime
+        if job.cancelled:
+            return
+        if job.deadline is not None and job.deadline < time.time():
+            await self.expire(job)
+            return
+        if job.session is not None:
+            preferred = self.session_worker(job.session, model)
+            metrics.SESSION_DISPATCHES.inc(affinity="hit" if preferred else "miss")
+            worker = preferred or worker
+        worker.account()
+        worker.in_flight[job.id] = job
+        job.worker = worker
+        job.attempts += 1
+        job.dispatched_at = time.monotonic()
+        self.stats[f"dispatched_{priority}"] += 1
+        self.stats[f"queue_wait_seconds_{priority}"] += job.dispatched_at - job.queued_at
+        metrics.QUEUE_WAIT.observe(job.dispatched_at - job.queued_at, priority=priority)
+        if job.parent is not None and not job.parent.dispatched_at:
+            job.parent.dispatched_at = job.dispatched_at
+        logger.debug(f"Dispatching job {job.id} to worker {worker.id}")
+        sent = await worker.send({**job.message, "request_id": job.id}, job.body)
+        if not sent and worker.in_flight.pop(job.id, None) is not None:
+            # The worker is gone, but was not unregistered yet
+            job.attempts -= 1
+            await self.retry(job, f"Worker {worker.id} is unreachable")
+
+    async def cancel(self, client: Connection, request_id: str) -> bool:
+        """
+        Cancel a request of a client.
+
+        The job of the request is only cancelled once none of its coalesced
+        requests is left. Queued jobs are dropped, running jobs are cancelled on
+        the worker and their slot is freed right away.
+
+        Args:
+            client (Connection): The client that sent the request.
+            request_id (str): The request ID of the client.
+
+        Returns:
+            bool: Whether the request was still queued or running.
+        """
+        job = self.subscriptions.pop((client.id, request_id), None)
+        if job is None:
+            return False
+        job.subscribers = [
+            s for s in job.subscribers
+            if not (s.client is client and s.request_id == request_id)
+        ]
+        self.stats["cancelled_requests"] += 1
+        if job.subscribers:
+            return True
+
+        self.stats["cancelled_jobs"] += 1
+        for part in job.parts:
+            await self._cancel_job(part)
+        await self._cancel_job(job)
+        return True
+
+    async def _cancel_job(self, job: Job):
+        """Drop a queued job or cancel it on its worker, freeing the slot right away."""
+        job.cancelled = True
+        self.queue(job.model).remove(job)
+        async with self.worker_available:
+            if self.pending.get(job.key) is job:
+                del self.pending[job.key]
+            worker = job.worker
+            if worker is not None:
+                worker.account()
+            if worker is not None and worker.in_flight.pop(job.id, None) is not None:
+                self.worker_available.notify_all()
+            else:
+                worker = None
+        if worker is not None:
+            logger.info(f"Cancelling job {job.id} on worker {worker.id}")
+            await worker.send({"type": "cancel", "request_id": job.id})
+        elif not job.parts:
+            logger.info(f"Dropped queued job {job.id}")
+
+    async def cancel_client(self, client: Connection):
+        """
+        Cancel all requests of a disconnected client.
+
+        Args:
+            client (Connection): The client that disconnected.
+        """
+        request_ids = [r for c, r in self.subscriptions if c == client.id]
+        for request_id in request_ids:
+            await self.cancel(client, request_id)
+
+    async def handle_progress(self, worker: Worker, message: dict):
+        """
+        Relay the progress of a running job to its clients.
+
+        Args:
+            worker (Worker): The worker running the job.
+            message (dict): The `progress` message, tagged with the `request_id` of the job.
+        """
+        job = worker.in_flight.get(message.get("request_id"))
+        if job is not None and job.parent is not None:
+            message = {**message, "part": job.index, "parts": len(job.parent.parts)}
+            job = job.parent
+        if job is not None:
+            await job.notify(message)
+
+    async def handle_result(self, worker: Worker, result: dict, body: bytes = b""):
+        """
+        Route a result or error from a worker back to the client of the job.
+
+        Binary results are relayed without decoding their body, unless the
+        client only accepts JSON.
+
+        Args:
+            worker (Worker): The worker that sent the result.
+            result (dict): The `result` or `error` message, tagged with the
+                `request_id` of the job.
+            body (bytes): The binary body of the result.
+        """
+        async with self.worker_available:
+            worker.account()
+            job_id = result.pop("request_id", None)
+            job = worker.in_flight.pop(job_id, None)
+            if job_id is None and result["type"] == "result" and len(worker.in_flight) == 1:
+                # Workers that do not echo the ID can only hold a single job
+                job = worker.in_flight.popitem()[1]
+            if job is not None:
+                worker.record_service_time(time.monotonic() - job.dispatched_at)
+                metrics.SERVICE_TIME.observe(time.monotonic() - job.dispatched_at)
+                self._forget(job)
+            self.worker_available.notify_all()
+
+        if job is None:
+            logger.error(
+                f"Worker {worker.id} sent a {result['type']} for no known job "
+                f"{result.get('message', '')}"
+            )
+            return
+
+        if result["type"] == "error":
+            logger.error(f"Job {job.id} failed on worker {worker.id}: {result.get('message')}")
+        elif job.cache and worker.checkpoint:
+            await self.cache.put(
+                cache_key(job.key, worker.checkpoint), encode_frame(result, body)
+            )
+        await self.complete(job, result, body, worker.checkpoint)
+
+    async def complete(self, job: Job, result: dict, body: bytes = b"", checkpoint: Optional[str] = None):
+        """
+        Pass the outcome of a job on to whoever waits for it.
+
+        That is the gateway that queued a remote job, the split job a part belongs
+        to, or the subscribers of the job.
+
+        Args:
+            job (Job): The finished job.
+            result (dict): The `result`, `error` or `expired` message.
+            body (bytes): The binary body of the message.
+            checkpoint (Optional[str]): The checkpoint that produced the result, if known.
+        """
+        if job.remote:
+            await self.queue(job.model).finish(job, encode_frame(result, body))
+        elif job.parent is not None:
+            await self.gather(job, result, body, checkpoint)
+        else:
+            await job.notify(result, body)
+            metrics.REQUEST_LATENCY.observe(time.monotonic() - job.created_at, outcome=result["type"])
+
+    async def gather(self, part: Job, result: dict, body: bytes, checkpoint: Optional[str]):
+        """
+        Collect the outcome of a part and complete its split job once all parts finished.
+
+        The first part that fails fails the split job and cancels the other parts.
+
+        Args:
+            part (Job): The finished part.
+            result (dict): The `result`, `error` or `expired` message of the part.
+            body (bytes): The binary body of the message.
+            checkpoint (Optional[str]): The checkpoint that produced the result, if known.
+        """
+        job = part.parent
+        if job.cancelled:
+            return
+        if result["type"] != "result":
+            logger.error(f"Split job {job.id} failed with part {part.index}")
+            for other in job.parts:
+                if other is not part and other.index not in job.part_results:
+                    await self._cancel_job(other)
+            job.cancelled = True
+            self._forget(job)
+            await self.complete(job, result, body)
+            return
+
+        job.part_results[part.index] = (result, body, checkpoint)
+        if len(job.part_results) < len(job.parts):
+            return
+        outcomes = [job.part_results[i] for i in range(len(job.parts))]
+        result, body = concat_results([(header, data) for header, data, _ in outcomes])
+        checkpoints = {used for *_, used in outcomes}
+        if job.cache and len(checkpoints) == 1 and None not in checkpoints:
+            await self.cache.put(cache_key(job.key, checkpoints.pop()), encode_frame(result, body))
+        self._forget(job)
+        await self.complete(job, result, body)
+
+    async def collect_results(self, interval: float):
+        """
+        Periodically relay the outcomes of jobs that other gateways ran to their clients.
+
+        Args:
+            interval (float): The seconds between two checks.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            for queue in list(self.queues.values()):
+                try:
+                    outcomes = await queue.collect()
+                except Exception:
+                    logger.exception("Failed to collect results from the queue")
+                    continue
+                for job, frame in outcomes:
+                    result, body = decode_frame(frame)
+                    self._forget(job)
+                    await self.complete(job, result, body)
 
 
 class ClientManager:
-    """Client manager class to manage client connections."""
+    """Client manager class to manage client connections, keyed by their ID."""
 
     def __init__(self):
-        self.clients: list[Connection] = []
-        self.lock = asyncio.Lock()
+        self.clients: dict[str, Connection] = {}
 
     async def register(self, websocket: WebSocket) -> Connection:
         """
@@ -106,11 +1535,9 @@ class ClientManager:
             Connection: The registered client instance.
         """
         client = Connection(websocket)
-        async with self.lock:
-            self.clients.append(client)
-            logger.info(
-                f"Client {client.id} connected. Total clients: {len(self.clients)}"
-            )
+        client.start()
+        self.clients[client.id] = client
+        logger.info(f"Client {client.id} connected. Total clients: {len(self.clients)}")
         return client
 
     async def unregister(self, client: Connection):
@@ -120,37 +1547,487 @@ class ClientManager:
         Args:
             client (Connection): The client instance to unregister.
         """
-        async with self.lock:
-            self.clients.remove(client)
-            logger.info(
-                f"Client {client.id} disconnected. Total clients: {len(self.clients)}"
-            )
+        await client.close()
+        self.clients.pop(client.id, None)
+        logger.info(f"Client {client.id} disconnected. Total clients: {len(self.clients)}")
 
 
-worker_manager = WorkerManager()
+worker_manager = WorkerManager(
+    cache=ResultCache(
+        max_bytes=int(os.getenv("MOLAB_CACHE_MAX_BYTES", 256 * 2**20)),
+        ttl=float(os.getenv("MOLAB_CACHE_TTL", 24 * 60 * 60)),
+        spill_dir=Path(os.environ["MOLAB_CACHE_DIR"]) if os.getenv("MOLAB_CACHE_DIR") else None,
+    ),
+    max_queue_depth=int(os.getenv("MOLAB_MAX_QUEUE_DEPTH", 1000)),
+    max_retries=int(os.getenv("MOLAB_MAX_RETRIES", 2)),
+    queue_factory=(
+        lambda model: SQLiteQueue(
+            Path(os.environ["MOLAB_QUEUE_DB"]),
+            model,
+            owner=GATEWAY_ID,
+            encode=Job.encode,
+            decode=Job.decode,
+        )
+    )
+    if os.getenv("MOLAB_QUEUE_DB")
+    else None,
+)
 client_manager = ClientManager()
+job_spool = JobSpool(
+    directory=Path(os.getenv("MOLAB_SPOOL_DIR", Path(tempfile.gettempdir()) / "molab_spool")),
+    ttl=float(os.getenv("MOLAB_SPOOL_TTL", 7 * 24 * 60 * 60)),
+)
+spool_client = SpoolConnection(websocket=None, id="http", spool=job_spool)
+decode_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("MOLAB_DECODE_THREADS", 2)), thread_name_prefix="molab-decode"
+)
+autoscaler = Autoscaler(
+    worker_manager,
+    command=os.getenv("MOLAB_AUTOSCALE_COMMAND", ""),
+    min_workers=int(os.getenv("MOLAB_AUTOSCALE_MIN", 0)),
+    max_workers=int(os.getenv("MOLAB_AUTOSCALE_MAX", 4)),
+    up_cooldown=float(os.getenv("MOLAB_AUTOSCALE_UP_COOLDOWN", 60)),
+    down_cooldown=float(os.getenv("MOLAB_AUTOSCALE_DOWN_COOLDOWN", 300)),
+    target_wait=float(os.getenv("MOLAB_AUTOSCALE_TARGET_WAIT", 60)),
+)
 
 app = FastAPI(title="Motion Inference Server")
 
 
-async def handle_client_request(client: Connection, message: dict):
+async def handle_client_request(
+    client: Connection, message: dict, body: bytes = b"", size: int = 0
+):
     """
     Handle client requests.
 
+    Every request is identified by its `request_id`, either supplied by the client
+    or assigned by the gateway. It is acknowledged with a `queued` message and
+    echoed on all following messages, so a client can have many requests in flight
+    and match the responses that arrive out of order.
+
+    Requests identical to a queued or running one share its result, unless they
+    set `coalesce` to false. Requests with a fixed `seed` are answered from the
+    result cache, unless they set `cache` to false.
+
+    Once the queue is full, requests that can not be coalesced or answered from
+    the cache are rejected with a `busy` message carrying `retry_after` seconds.
+
+    Requests are only dispatched to workers serving their `model`, which
+    defaults to `DEFAULT_MODEL`. Every model is queued separately.
+
+    Requests with `priority` "interactive" (default) are dispatched before
+    "batch" requests, and every client gets a fair share of the workers within
+    a priority class.
+
+    Requests for more `num_samples` than `split` (default `SPLIT_SAMPLES`) are
+    split into parts that run on several workers in parallel, their results
+    are merged in order.
+
+    Requests with a `deadline` (Unix time) or `max_queue_age` (seconds) are
+    dispatched earliest deadline first within their priority class. If they are
+    still queued once the deadline passed, they are dropped with an `expired`
+    message.
+
+    Requests of the same `session`, e.g. an animator iterating on a shot, are
+    preferably dispatched to the same workers, see `WorkerManager.session_worker`.
+
+    Requests with a `base_request_id` are deltas of one of the client's recent
+    requests: their fields replace those of the base request, the frames of
+    their `packed_motion` are added or replaced and the frames listed in
+    `remove_frames` are removed, see `molab_backend.protocol.patch_request`.
+    Unless set, a delta inherits the `session` of its base, or starts one.
+
+    A `sweep` message submits an `infer` request for every point of its `grid`,
+    see `expand_grid`. The other fields form the base request of all points,
+    which default to the "batch" priority and share a session, so the points
+    spread over all workers of the model while workers reuse the preprocessing
+    of points with the same input. The sweep is answered with a `sweep` message
+    listing the `request_id` ("<sweep request_id>/<index>") and `params` of every
+    point, the results of the points follow as they complete.
+
+    Requests are cancelled with a `cancel` message carrying their `request_id`,
+    which is confirmed with a `cancelled` message. Cancelling a sweep cancels
+    all of its points.
+
+    Clients that list `binary` in the `encodings` of a `hello` message exchange
+    binary frames for large payloads, see `molab_backend.protocol`.
+
     Args:
         client (Connection): The client instance sending the request.
         message (dict): The message sent by the client.
+        body (bytes): The binary body of the message.
+        size (int): The size of the received message in bytes, large messages
+            are patched and hashed off the event loop, see `offload`.
     """
-    if message["type"] == "infer":
-        await worker_manager.request_queue.put((client, message))
+    request_id = str(message.get("request_id") or uuid.uuid4())
+    if message.get("type") == "hello":
+        reply = client.negotiate(message.get("encodings", []), message.get("compression", []))
+        await client.send({"type": "hello", **reply})
+    elif message.get("type") == "cancel":
+        cancelled = await worker_manager.cancel(client, request_id)
+        points = [
+            r for c, r in list(worker_manager.subscriptions)
+            if c == client.id and r.startswith(f"{request_id}/")
+        ]
+        for point_id in points:
+            cancelled = await worker_manager.cancel(client, point_id) or cancelled
+        if cancelled:
+            await client.send({"type": "cancelled", "request_id": request_id})
+        else:
+            await client.send({
+                "type": "error",
+                "request_id": request_id,
+                "message": "Unknown or finished request",
+            })
+    elif message.get("type") == "infer":
+        base_request_id = message.get("base_request_id")
+        if base_request_id is not None:
+            base = client.history.get(str(base_request_id))
+            if base is None:
+                await client.send({
+                    "type": "error",
+                    "request_id": request_id,
+                    "message": "Unknown base request, send the full request instead",
+                })
+                return
+            try:
+                message, body = await offload(
+                    size + len(base[1]), patch_request, *base, message, body
+                )
+            except ValueError as e:
+                await client.send({
+                    "type": "error",
+                    "request_id": request_id,
+                    "message": f"Invalid delta request: {e}",
+                })
+                return
+            message.setdefault("session", f"{client.id}/{base_request_id}")
+            worker_manager.stats["delta_requests"] += 1
+        coalesce = bool(message.get("coalesce", True))
+        cache = bool(message.get("cache", True))
+        priority = message.get("priority", PRIORITIES[0])
+        if priority not in PRIORITIES:
+            await client.send({
+                "type": "error",
+                "request_id": request_id,
+                "message": f"Invalid priority, expected one of {', '.join(PRIORITIES)}",
+            })
+            return
+        model = str(message.get("model") or DEFAULT_MODEL)
+        if model not in worker_manager.models:
+            await client.send({
+                "type": "error",
+                "request_id": request_id,
+                "message": f"Unknown model, expected one of {', '.join(sorted(worker_manager.models))}",
+            })
+            return
+        session = message.get("session")
+        session = None if session is None else str(session)
+        try:
+            deadlines = [float(message["deadline"])] if message.get("deadline") is not None else []
+            if message.get("max_queue_age") is not None:
+                deadlines.append(time.time() + float(message["max_queue_age"]))
+        except (TypeError, ValueError):
+            await client.send({
+                "type": "error",
+                "request_id": request_id,
+                "message": "Invalid deadline, expected a Unix time and max_queue_age in seconds",
+            })
+            return
+        deadline = min(deadlines, default=None)
+        split = message.get("split", SPLIT_SAMPLES)
+        if not isinstance(split, int) or isinstance(split, bool) or split < 0:
+            await client.send({
+                "type": "error",
+                "request_id": request_id,
+                "message": "Invalid split, expected the number of samples per part or 0",
+            })
+            return
+        client.remember(
+            request_id,
+            {k: v for k, v in message.items() if k not in ("request_id", "deadline")},
+            body,
+        )
+        message = {k: v for k, v in message.items() if k not in GATEWAY_FIELDS}
+        try:
+            await worker_manager.submit(
+                client,
+                message,
+                body,
+                request_id,
+                coalesce,
+                cache,
+                priority,
+                model,
+                session,
+                deadline,
+                split,
+                size,
+            )
+        except QueueFull as e:
+            await client.send({
+                "type": "busy",
+                "request_id": request_id,
+                "message": str(e),
+                "retry_after": round(e.retry_after),
+            })
+    elif message.get("type") == "sweep":
+        try:
+            points = expand_grid(message.get("grid"))
+        except ValueError as e:
+            await client.send({
+                "type": "error",
+                "request_id": request_id,
+                "message": f"Invalid sweep grid: {e}",
+            })
+            return
+        base = {k: v for k, v in message.items() if k not in ("grid", "request_id")}
+        base = {"priority": "batch", "session": f"{client.id}/{request_id}", **base, "type": "infer"}
+        points = [(f"{request_id}/{i}", params) for i, params in enumerate(points)]
+        await client.send({
+            "type": "sweep",
+            "request_id": request_id,
+            "points": [{"request_id": point_id, "params": params} for point_id, params in points],
+        })
+        worker_manager.stats["sweeps"] += 1
+        for point_id, params in points:
+            await handle_client_request(
+                client, {**base, **params, "request_id": point_id}, body, size
+            )
     else:
         logger.error(f"Client {client.id} sent unknown message:\n{message}")
-        await client.websocket.send_text("Invalid message type")
+        await client.send({
+            "type": "error",
+            "request_id": request_id,
+            "message": "Invalid message type",
+        })
+
+
+async def handle_worker_message(worker: Worker, message: dict, body: bytes = b""):
+    """
+    Handle worker messages.
+
+    Args:
+        worker (Worker): The worker instance sending the message.
+        message (dict): The message sent by the worker, results may carry no type.
+        body (bytes): The binary body of the message.
+    """
+    message_type = message.setdefault("type", "result")
+    if message_type == "register":
+        reply = worker.negotiate(message.get("encodings", []), message.get("compression", []))
+        await worker.send({"type": "registered", "worker_id": worker.id, **reply})
+        await worker_manager.update_worker(worker, message)
+    elif message_type == "status":
+        await worker_manager.update_worker(worker, message)
+    elif message_type == "progress":
+        await worker_manager.handle_progress(worker, message)
+    elif message_type in ("result", "error"):
+        await worker_manager.handle_result(worker, message, body)
+    elif message_type == "cancelled":
+        logger.info(f"Worker {worker.id} cancelled job {message.get('request_id')}")
+    else:
+        logger.error(f"Worker {worker.id} sent unknown message:\n{message}")
+
+
+@app.get("/stats")
+async def stats() -> dict:
+    """Counters of the requests handled by the gateway, e.g. how many were coalesced."""
+    return dict(worker_manager.stats)
+
+
+@app.post("/jobs", status_code=202)
+async def submit_jobs(request: Union[dict, list[dict]] = Body(...)) -> dict:  # noqa: B008
+    """
+    Submit one inference request or a list of them as jobs, without a WebSocket.
+
+    The requests are the same as `infer` messages of WebSocket clients, but
+    default to the "batch" priority. All HTTP jobs share a fair queueing flow.
+    A request with a `grid` is a sweep, it submits a job for every point of
+    the grid, see `expand_grid`.
+
+    Args:
+        request (Union[dict, list[dict]]): The inference request or requests.
+
+    Returns:
+        dict: The status records of the new jobs under `jobs`, in request order,
+            the jobs of sweep points list their swept fields under `params`.
+
+    Raises:
+        HTTPException: If the grid of a sweep is invalid.
+    """
+    requests = request if isinstance(request, list) else [request]
+    sweeps = []
+    for message in requests:
+        try:
+            sweeps.append(expand_grid(message["grid"]) if "grid" in message else None)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid sweep grid: {e}") from None
+    records = []
+    for message, points in zip(requests, sweeps):
+        message = {k: v for k, v in message.items() if k != "grid"}
+        session = {"session": str(uuid.uuid4())} if points is not None else {}
+        for params in points or [{}]:
+            job_id = str(uuid.uuid4())
+            record = job_spool.create(job_id)
+            records.append({**record, "params": params} if points is not None else record)
+            await handle_client_request(
+                spool_client,
+                {"priority": "batch", **session, **message, **params, "type": "infer", "request_id": job_id},
+            )
+    return {"jobs": records}
+
+
+def _get_job_record(job_id: str) -> dict:
+    record = job_spool.get(job_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired job")
+    job = worker_manager.subscriptions.get((spool_client.id, job_id))
+    if record["status"] == "queued" and job is not None and job.dispatched_at:
+        return {**record, "status": "running"}
+    return record
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str) -> dict:
+    """
+    Poll the status of a job.
+
+    The `status` is one of "queued", "running", "done", "failed", "rejected" or
+    "cancelled". Queued jobs report their `position` and `estimated_start`,
+    running jobs their latest `progress`.
+
+    Args:
+        job_id (str): The ID of the job.
+
+    Returns:
+        dict: The status record of the job.
+    """
+    return _get_job_record(job_id)
+
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str) -> dict:
+    """
+    Cancel a queued or running job.
+
+    Args:
+        job_id (str): The ID of the job.
+
+    Returns:
+        dict: The status record of the job.
+    """
+    record = _get_job_record(job_id)
+    if not await worker_manager.cancel(spool_client, job_id):
+        raise HTTPException(status_code=409, detail=f"Job is already {record['status']}")
+    job_spool.update(job_id, status="cancelled")
+    return job_spool.get(job_id)
+
+
+def _iter_json(message: dict, chunk_size: int = 2**16):
+    """Encode a message as JSON in chunks of about `chunk_size` characters."""
+    chunks = []
+    size = 0
+    for chunk in json.JSONEncoder(separators=(",", ":"), ensure_ascii=False).iterencode(message):
+        chunks.append(chunk)
+        size += len(chunk)
+        if size >= chunk_size:
+            yield "".join(chunks)
+            chunks, size = [], 0
+    yield "".join(chunks)
+
+
+@app.get("/jobs/{job_id}/result")
+async def get_job_result(job_id: str, format: str = "json"):  # noqa: A002
+    """
+    Download the result of a finished job from the spool.
+
+    Args:
+        job_id (str): The ID of the job.
+        format (str): "json" for the `result` message as JSON (default), or
+            "binary" for the spooled binary frame, see `molab_backend.protocol`.
+
+    Returns:
+        The streamed result file.
+    """
+    record = _get_job_record(job_id)
+    if record["status"] != "done":
+        raise HTTPException(status_code=409, detail=f"Job is {record['status']}")
+    path = job_spool.result_path(job_id)
+    if format == "binary":
+        return FileResponse(path, media_type="application/octet-stream", filename=path.name)
+    if format != "json":
+        raise HTTPException(status_code=400, detail='Invalid format, expected "json" or "binary"')
+    try:
+        frame = await asyncio.to_thread(path.read_bytes)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Unknown or expired job") from None
+    return StreamingResponse(
+        _iter_json(unpack_arrays(*decode_frame(frame))), media_type="application/json"
+    )
+
+
+@app.get("/workers")
+async def workers() -> list[dict]:
+    """The connected workers with their capabilities and current load."""
+    return [
+        {
+            "id": worker.id,
+            "model": worker.model,
+            "checkpoint": worker.checkpoint,
+            "samplers": worker.samplers,
+            "max_frames": worker.max_frames,
+            "device": worker.device,
+            "capacity": worker.capacity,
+            "load": worker.load,
+        }
+        for worker in worker_manager.workers
+    ]
+
+
+@app.get("/autoscale")
+async def autoscale() -> dict:
+    """The desired number of workers of every model and the queue measurements it is based on."""
+    return autoscaler.status()
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint() -> str:
+    """Operational metrics of the gateway in the Prometheus text format."""
+    for model in worker_manager.models | set(worker_manager.queues):
+        queue = worker_manager.queues.get(model)
+        queued = queue.counts() if queue else {}
+        for priority in PRIORITIES:
+            metrics.QUEUE_DEPTH.set(queued.get(priority, 0), model=model, priority=priority)
+    metrics.CONNECTED_WORKERS.set(len(worker_manager.workers))
+    metrics.CONNECTED_CLIENTS.set(len(client_manager.clients))
+    for worker in worker_manager.workers:
+        worker.account()
+        metrics.WORKER_CAPACITY.set(worker.capacity, worker=worker.id)
+        metrics.WORKER_LOAD.set(worker.load, worker=worker.id)
+        metrics.WORKER_BUSY_RATIO.set(worker.busy_ratio, worker=worker.id)
+    if worker_manager.cache is not None:
+        metrics.CACHE_BYTES.set(worker_manager.cache.size)
+        metrics.CACHE_ENTRIES.set(len(worker_manager.cache))
+    return metrics.registry.render()
 
 
 @app.on_event("startup")
 async def startup_event():
-    asyncio.create_task(worker_manager.process_requests())
+    worker_manager.queue(DEFAULT_MODEL)
+    asyncio.create_task(job_spool.prune_periodically(60 * 60))
+    if os.getenv("MOLAB_QUEUE_DB"):
+        asyncio.create_task(worker_manager.collect_results(0.1))
+    asyncio.create_task(
+        worker_manager.report_positions(float(os.getenv("MOLAB_POSITION_INTERVAL", 2.0)))
+    )
+    asyncio.create_task(autoscaler.run(float(os.getenv("MOLAB_AUTOSCALE_INTERVAL", 10.0))))
+    asyncio.create_task(monitor_event_loop_lag(float(os.getenv("MOLAB_LAG_INTERVAL", 0.5))))
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await autoscaler.stop()
+    decode_executor.shutdown(wait=False)
 
 
 @app.websocket("/register_worker")
@@ -158,6 +2035,11 @@ async def register_worker(websocket: WebSocket):
     """
     WebSocket endpoint to register workers.
 
+    Workers can advertise their `capacity` and capabilities, i.e. the `model`
+    they serve, its `checkpoint`, `samplers`, `max_frames` and `device`, with a
+    `register` message and report their current `load` with `status` messages. Results and errors are tagged
+    with the `request_id` of the job they belong to.
+
     Args:
         websocket (WebSocket): The WebSocket connection for the worker.
     """
@@ -166,7 +2048,12 @@ async def register_worker(websocket: WebSocket):
     try:
         while True:
             # Ping/Keepalive done by uvicorn
-            await asyncio.sleep(5)
+            try:
+                message, body, _ = await receive_message(websocket, worker.peer)
+            except ValueError:
+                logger.exception(f"Worker {worker.id} sent an invalid message")
+                continue
+            await handle_worker_message(worker, message, body)
     except WebSocketDisconnect:
         await worker_manager.unregister(worker)
 
@@ -183,10 +2070,26 @@ async def register_client(websocket: WebSocket):
     client = await client_manager.register(websocket)
     try:
         while True:
-            message = await websocket.receive_json()
-            await handle_client_request(client, message)
+            try:
+                message, body, size = await receive_message(websocket, client.peer)
+            except ValueError as e:
+                logger.error(f"Client {client.id} sent an invalid message: {e}")
+                await client.send({"type": "error", "message": f"Invalid message: {e}"})
+                continue
+            try:
+                await offload(len(body), validate_frame, message, body, client.compression)
+            except ValueError as e:
+                logger.warning(f"Client {client.id} sent an invalid frame: {e}")
+                await client.send({
+                    "type": "error",
+                    "request_id": message.get("request_id"),
+                    "message": f"Invalid message: {e}",
+                })
+                continue
+            await handle_client_request(client, message, body, size)
     except WebSocketDisconnect:
         await client_manager.unregister(client)
+        await worker_manager.cancel_client(client)
 
 
 def main():
@@ -0,0 +1,246 @@
+"""Minimal metrics in the Prometheus text exposition format.
+
+Only the features the gateway needs are implemented, i.e. counters, gauges and
+histograms with labels, so the backend does not depend on a metrics client.
+"""
+
+import math
+from bisect import bisect_left
+
+# Seconds, from interactive requests to long batches
+TIME_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 60, 120, 300, 600)
+# Bytes, from control messages to long motions with many samples
+SIZE_BUCKETS = tuple(4**i * 256 for i in range(10))
+# Seconds, from a busy event loop to one that stalls every connection
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(str(v))}"' for k, v in labels.items()) + "}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+    """Base class of all metrics, with one value per combination of label values.
+
+    Args:
+        name (str): The metric name, e.g. `molab_requests_total`.
+        documentation (str): The help text of the metric.
+        labelnames (tuple[str, ...]): The names of the labels.
+    """
+
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values: dict[tuple, object] = {}
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects the labels {self.labelnames}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def remove(self, **labels):
+        """Remove the series with the given labels, e.g. of a disconnected worker."""
+        self.values.pop(self._key(labels), None)
+
+    def clear(self):
+        """Remove all series."""
+        self.values.clear()
+
+    def samples(self):
+        """Yield (name suffix, labels, value) of all series."""
+        for key, value in self.values.items():
+            yield "", dict(zip(self.labelnames, key)), value
+
+    def render(self) -> list[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    """A value that only increases, e.g. the number of requests."""
+
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that goes up and down, e.g. the number of connected workers."""
+
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        self.values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    """Counts observations in cumulative buckets, e.g. request latencies.
+
+    Args:
+        buckets (tuple[float, ...]): The upper bounds of the buckets.
+    """
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = TIME_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+        counts[bisect_left(self.buckets, value)] += 1
+        self.values[key] = (counts, total + value)
+
+    def samples(self):
+        for key, (counts, total) in self.values.items():
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield "_bucket", {**labels, "le": _format_value(bound)}, cumulative
+            yield "_sum", labels, total
+            yield "_count", labels, cumulative
+
+
+class Registry:
+    """Collection of metrics rendered together on `/metrics`."""
+
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """Render all metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+QUEUE_DEPTH = registry.register(
+    Gauge("molab_queue_depth", "Number of queued requests.", ("model", "priority"))
+)
+CONNECTED_WORKERS = registry.register(
+    Gauge("molab_connected_workers", "Number of connected workers.")
+)
+CONNECTED_CLIENTS = registry.register(
+    Gauge("molab_connected_clients", "Number of connected clients.")
+)
+WORKER_CAPACITY = registry.register(
+    Gauge("molab_worker_capacity", "Number of concurrent jobs a worker accepts.", ("worker",))
+)
+WORKER_LOAD = registry.register(
+    Gauge("molab_worker_load", "Number of jobs a worker is busy with.", ("worker",))
+)
+WORKER_BUSY_SECONDS = registry.register(
+    Counter(
+        "molab_worker_busy_seconds_total",
+        "Seconds a worker was busy, weighted by the fraction of used slots.",
+        ("worker",),
+    )
+)
+WORKER_BUSY_RATIO = registry.register(
+    Gauge("molab_worker_busy_ratio", "Fraction of its connected time a worker was busy.", ("worker",))
+)
+QUEUE_WAIT = registry.register(
+    Histogram("molab_queue_wait_seconds", "Seconds a job waited in the queue.", ("priority",))
+)
+SERVICE_TIME = registry.register(
+    Histogram("molab_service_time_seconds", "Seconds from dispatch to the result of a job.")
+)
+REQUEST_LATENCY = registry.register(
+    Histogram(
+        "molab_request_latency_seconds",
+        "Seconds from receiving a request to sending its outcome.",
+        ("outcome",),
+    )
+)
+PAYLOAD_BYTES = registry.register(
+    Histogram(
+        "molab_payload_bytes",
+        "Size of the messages received from and sent to peers.",
+        ("peer", "direction", "encoding"),
+        buckets=SIZE_BUCKETS,
+    )
+)
+EXPIRED_REQUESTS = registry.register(
+    Counter(
+        "molab_expired_requests_total",
+        "Requests dropped because their deadline passed before dispatch.",
+        ("priority",),
+    )
+)
+SESSION_DISPATCHES = registry.register(
+    Counter(
+        "molab_session_dispatches_total",
+        "Dispatches of jobs with a session, by whether a preferred worker was free.",
+        ("affinity",),
+    )
+)
+EVENT_LOOP_LAG = registry.register(
+    Histogram(
+        "molab_event_loop_lag_seconds",
+        "Delay of the event loop in waking up a sleeping task.",
+        buckets=LAG_BUCKETS,
+    )
+)
+OFFLOADED_CALLS = registry.register(
+    Counter(
+        "molab_offloaded_calls_total",
+        "Decoding, hashing and encoding of large messages run off the event loop.",
+        ("function",),
+    )
+)
+OUTBOX_OVERFLOWS = registry.register(
+    Counter(
+        "molab_outbox_overflows_total",
+        "Messages for peers with a full outbox, by whether they were shed or the peer disconnected.",
+        ("peer", "action"),
+    )
+)
+DESIRED_WORKERS = registry.register(
+    Gauge("molab_desired_workers", "Number of workers a model needs, see the autoscaler.", ("model",))
+)
+CACHE_LOOKUPS = registry.register(
+    Counter("molab_cache_lookups_total", "Result cache lookups.", ("result",))
+)
+CACHE_BYTES = registry.register(
+    Gauge("molab_cache_bytes", "Size of the results cached in memory.")
+)
+CACHE_ENTRIES = registry.register(
+    Gauge("molab_cache_entries", "Number of results cached in memory.")
+)
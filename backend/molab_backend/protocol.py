@@ -0,0 +1,484 @@
+"""Binary framing for messages with large numeric payloads.
+
+A binary frame consists of the 4-byte magic `MOLB`, the length of the JSON header
+as unsigned 32-bit little-endian integer, the UTF-8 encoded JSON header and the
+body. The header is a regular message, except that the fields listed in its
+`arrays` entry are stored in the body as little-endian float32 buffers, in the
+order of the entries:
+
+    {"type": "result", "arrays": {"root_positions": {"shape": [3, 196, 3]}}}
+
+Arrays with `keys` describe mappings of frames to poses like `packed_motion`,
+the first dimension of the array then follows the order of the keys.
+
+Messages are kept as (header, body) pairs, a JSON message is simply a header
+without body, so the gateway can relay frames without looking at the body.
+
+Bodies above a size threshold can be compressed with one of the negotiated
+`COMPRESSIONS`, which is named in the `compression` header field. Before
+compression the bytes of the float32 values are grouped by significance
+(byte shuffling), so the mostly equal sign and exponent bytes of smooth curves
+and zero rotations end up next to each other. Compressed frames are relayed
+as they are to peers that support their compression.
+
+JSON is parsed with the optional `orjson` package if it is installed, see `loads`.
+"""
+
+import json
+import struct
+import sys
+import zlib
+from array import array
+from typing import Any, Optional, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MAGIC = b"MOLB"
+HEADER_LENGTH = struct.Struct("<I")
+ENCODINGS = ["binary", "json"]
+# Supported body compressions, preferred first, zstd needs the optional `zstandard` package
+COMPRESSIONS = ["zstd", "zlib"] if zstandard is not None else ["zlib"]
+# Errors raised by the decompressors for corrupt bodies
+DECOMPRESSION_ERRORS = (zlib.error, ValueError, *((zstandard.ZstdError,) if zstandard is not None else ()))
+# Bodies smaller than this are sent uncompressed, in bytes
+COMPRESSION_THRESHOLD = 16 * 2**10
+# Fields of `InferenceResults` that hold one entry per sample
+RESULT_ARRAYS = [
+    "root_positions",
+    "joint_rotations",
+    "obs_root_positions",
+    "obs_joint_rotations",
+]
+
+
+def loads(data: Union[str, bytes]) -> Any:
+    """
+    Parse a JSON document, several times faster with the optional `orjson` package.
+
+    Documents `orjson` rejects although the `json` module accepts them, e.g.
+    with `NaN` values, are parsed by the `json` module.
+
+    Args:
+        data (Union[str, bytes]): The JSON document.
+
+    Returns:
+        Any: The parsed document.
+
+    Raises:
+        ValueError: If the data is not valid JSON.
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(data)
+
+
+def encode_frame(message: dict, body: bytes = b"") -> bytes:
+    """
+    Encode a message and its body as binary frame.
+
+    Args:
+        message (dict): The message header.
+        body (bytes): The concatenated array buffers described by the header.
+
+    Returns:
+        bytes: The binary frame.
+    """
+    header = json.dumps(message, separators=(",", ":")).encode()
+    return b"".join((MAGIC, HEADER_LENGTH.pack(len(header)), header, body))
+
+
+def decode_frame(data: bytes) -> tuple[dict, bytes]:
+    """
+    Split a binary frame into its message header and body without decoding the body.
+
+    Args:
+        data (bytes): The binary frame.
+
+    Returns:
+        tuple[dict, bytes]: The message header and the body.
+
+    Raises:
+        ValueError: If the data is not a valid frame.
+    """
+    if data[:4] != MAGIC or len(data) < 4 + HEADER_LENGTH.size:
+        raise ValueError("Not a MoLab frame")
+    (header_length,) = HEADER_LENGTH.unpack_from(data, 4)
+    start = 4 + HEADER_LENGTH.size
+    message = loads(data[start : start + header_length])
+    if not isinstance(message, dict):
+        raise ValueError("Frame header is not a JSON object")  # noqa: TRY004
+    return message, data[start + header_length :]
+
+
+def _shape(value: Any) -> list[int]:
+    shape = []
+    while isinstance(value, (list, tuple)):
+        shape.append(len(value))
+        value = value[0] if value else None
+    return shape
+
+
+def _flatten(value: Any, depth: int):
+    if depth == 0:
+        yield value
+        return
+    for item in value:
+        yield from _flatten(item, depth - 1)
+
+
+def _unflatten(values: list, shape: list[int]) -> list:
+    for size in reversed(shape[1:]):
+        values = [values[i : i + size] for i in range(0, len(values), size)]
+    return values
+
+
+def pack_arrays(message: dict, names: list[str]) -> tuple[dict, bytes]:
+    """
+    Move the nested lists of numbers in the given fields into a float32 body.
+
+    Fields that are missing or not rectangular stay in the header.
+    The message must not contain packed arrays yet.
+
+    Args:
+        message (dict): The message with nested lists, e.g. an `InferenceResults` dump.
+        names (list[str]): The fields to move into the body.
+
+    Returns:
+        tuple[dict, bytes]: The message header and the body.
+    """
+    message = dict(message)
+    arrays = {}
+    buffers = []
+    for name in names:
+        value = message.get(name)
+        descriptor = {}
+        if isinstance(value, dict):
+            descriptor["keys"] = list(value.keys())
+            value = list(value.values())
+        if not isinstance(value, list):
+            continue
+        shape = _shape(value)
+        try:
+            buffer = array("f", _flatten(value, len(shape)))
+        except (TypeError, OverflowError):
+            continue  # Not numeric, keep it as JSON
+        expected = 1
+        for size in shape:
+            expected *= size
+        if len(buffer) != expected:
+            continue  # Ragged, keep it as JSON
+        if sys.byteorder == "big":
+            buffer.byteswap()
+        arrays[name] = {**descriptor, "shape": shape, "dtype": "<f4"}
+        buffers.append(buffer.tobytes())
+        del message[name]
+    if arrays:
+        message["arrays"] = arrays
+    return message, b"".join(buffers)
+
+
+def unpack_arrays(message: dict, body: bytes) -> dict:
+    """
+    Decode the float32 body of a message back into nested lists in the header.
+
+    Args:
+        message (dict): The message header with its `arrays` descriptors.
+        body (bytes): The body of the frame, possibly compressed.
+
+    Returns:
+        dict: The message with all arrays as nested lists, ready for JSON.
+    """
+    message, body = decompress_body(message, body)
+    message = dict(message)
+    offset = 0
+    for name, descriptor in message.pop("arrays", {}).items():
+        count = 1
+        for size in descriptor["shape"]:
+            count *= size
+        buffer = array("f")
+        buffer.frombytes(body[offset : offset + 4 * count])
+        offset += 4 * count
+        if sys.byteorder == "big":
+            buffer.byteswap()
+        value = _unflatten(buffer.tolist(), descriptor["shape"])
+        if "keys" in descriptor:
+            value = dict(zip(descriptor["keys"], value))
+        message[name] = value
+    return message
+
+
+def negotiate_compression(offered: list) -> list[str]:
+    """
+    Agree on the compressions supported by both sides.
+
+    Args:
+        offered (list): The compressions supported by the peer.
+
+    Returns:
+        list[str]: The common compressions, preferred first.
+    """
+    return [compression for compression in COMPRESSIONS if compression in offered]
+
+
+def _shuffle(body: bytes) -> bytes:
+    """Group the bytes of the float32 values by their position within the value."""
+    return b"".join(body[i::4] for i in range(4))
+
+
+def _unshuffle(data: bytes) -> bytes:
+    size = len(data) // 4
+    body = bytearray(len(data))
+    for i in range(4):
+        body[i::4] = data[i * size : (i + 1) * size]
+    return bytes(body)
+
+
+def compress_body(
+    message: dict,
+    body: bytes,
+    compressions: list,
+    threshold: int = COMPRESSION_THRESHOLD,
+) -> tuple[dict, bytes]:
+    """
+    Compress the body of a message with the first supported compression.
+
+    Bodies below the threshold, bodies that are already compressed and bodies
+    that do not get smaller are left as they are.
+
+    Args:
+        message (dict): The message header.
+        body (bytes): The float32 body.
+        compressions (list): The compressions negotiated with the receiver, preferred first.
+        threshold (int): The minimum size of the body to compress, in bytes.
+
+    Returns:
+        tuple[dict, bytes]: The message header, naming the `compression` if
+            applied, and the body.
+    """
+    if "compression" in message or len(body) < threshold or len(body) % 4:
+        return message, body
+    compression = next((c for c in compressions if c in COMPRESSIONS), None)
+    if compression == "zstd":
+        data = zstandard.ZstdCompressor(level=3).compress(_shuffle(body))
+    elif compression == "zlib":
+        data = zlib.compress(_shuffle(body), 6)
+    else:
+        return message, body
+    if len(data) >= len(body):
+        return message, body
+    return {**message, "compression": compression}, data
+
+
+def decompress_body(message: dict, body: bytes) -> tuple[dict, bytes]:
+    """
+    Undo `compress_body`.
+
+    Args:
+        message (dict): The message header.
+        body (bytes): The body, compressed if the header names a `compression`.
+
+    Returns:
+        tuple[dict, bytes]: The message header without `compression` and the
+            uncompressed body.
+
+    Raises:
+        ValueError: If the compression is not supported.
+    """
+    compression = message.get("compression")
+    if compression is None:
+        return message, body
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unsupported compression {compression!r}")
+    if compression == "zstd":
+        data = zstandard.ZstdDecompressor().decompress(body)
+    else:
+        data = zlib.decompress(body)
+    message = {k: v for k, v in message.items() if k != "compression"}
+    return message, _unshuffle(data)
+
+
+def validate_frame(message: dict, body: bytes, compressions: list = COMPRESSIONS):
+    """
+    Check that the header of a message describes its body, before it is relayed.
+
+    Compressed bodies are decompressed to check their size.
+
+    Args:
+        message (dict): The message header.
+        body (bytes): The body of the message, empty for JSON messages.
+        compressions (list): The compressions negotiated with the sender.
+
+    Raises:
+        ValueError: If the compression is not supported or was not negotiated,
+            the body can not be decompressed, or the `arrays` descriptors do
+            not add up to the size of the body.
+    """
+    compression = message.get("compression")
+    if compression is not None:
+        if compression not in COMPRESSIONS or compression not in compressions:
+            raise ValueError(f"Unsupported compression {compression!r}")
+        try:
+            message, body = decompress_body(message, body)
+        except DECOMPRESSION_ERRORS as e:
+            raise ValueError(f"Invalid {compression} body: {e}") from e
+    arrays = message.get("arrays", {})
+    if not isinstance(arrays, dict):
+        raise ValueError("Expected the array descriptors as object")  # noqa: TRY004
+    size = 0
+    for name, descriptor in arrays.items():
+        shape = descriptor.get("shape") if isinstance(descriptor, dict) else None
+        if not isinstance(shape, list) or not all(
+            isinstance(d, int) and not isinstance(d, bool) and d >= 0 for d in shape
+        ):
+            raise ValueError(f"Invalid shape of array {name!r}")
+        keys = descriptor.get("keys")
+        if keys is not None and (not isinstance(keys, list) or not shape or len(keys) != shape[0]):
+            raise ValueError(f"Invalid keys of array {name!r}")
+        count = 4
+        for dimension in shape:
+            count *= dimension
+        size += count
+    if size != len(body):
+        raise ValueError(f"The arrays describe {size} bytes, but the body has {len(body)} bytes")
+
+
+def _arrays(message: dict, body: bytes) -> dict[str, tuple[dict, bytes]]:
+    """Split a body into the descriptors and buffers of its arrays."""
+    arrays = {}
+    offset = 0
+    for name, descriptor in message.get("arrays", {}).items():
+        size = 4
+        for dimension in descriptor["shape"]:
+            size *= dimension
+        arrays[name] = (descriptor, body[offset : offset + size])
+        offset += size
+    return arrays
+
+
+def _frames(message: dict, body: bytes, name: str) -> tuple[dict[str, bytes], Optional[list[int]]]:
+    """Split the packed mapping of frames to poses into the buffers of the poses."""
+    if name in message:
+        message, body = pack_arrays({name: message[name]}, [name])
+        if name in message:
+            raise ValueError(f"The poses of `{name}` must have the same shape")
+    descriptor, buffer = _arrays(message, body).get(name, ({"keys": [], "shape": [0]}, b""))
+    if "keys" not in descriptor:
+        raise ValueError(f"`{name}` must map frames to poses")
+    pose_shape = descriptor["shape"][1:]
+    size = len(buffer) // len(descriptor["keys"]) if descriptor["keys"] else 0
+    frames = {
+        str(key): buffer[i * size : (i + 1) * size] for i, key in enumerate(descriptor["keys"])
+    }
+    return frames, pose_shape if frames else None
+
+
+def patch_request(
+    base: dict,
+    base_body: bytes,
+    patch: dict,
+    patch_body: bytes = b"",
+    name: str = "packed_motion",
+) -> tuple[dict, bytes]:
+    """
+    Reconstruct a request from the request it is based on and a patch.
+
+    The fields of the patch replace those of the base, except for the mapping
+    of frames to poses `name`, whose frames are added to the base's or replace
+    them, and `remove_frames`, the frames to remove from the base. The poses
+    are patched as float32 buffers, without decoding them.
+
+    Args:
+        base (dict): The header of the base request.
+        base_body (bytes): The body of the base request, possibly compressed.
+        patch (dict): The header of the patch, its `base_request_id` is dropped.
+        patch_body (bytes): The body of the patch, possibly compressed.
+        name (str): The field holding the frames.
+
+    Returns:
+        tuple[dict, bytes]: The header and body of the full request, with the
+            frames packed like `pack_arrays` does.
+
+    Raises:
+        ValueError: If the frames can not be packed or their poses do not match.
+    """
+    base, base_body = decompress_body(base, base_body)
+    patch, patch_body = decompress_body(patch, patch_body)
+    frames, pose_shape = _frames(base, base_body, name)
+    patch_frames, patch_pose_shape = _frames(patch, patch_body, name)
+    if pose_shape is not None and patch_pose_shape is not None and pose_shape != patch_pose_shape:
+        raise ValueError(f"The poses of the patch have the shape {patch_pose_shape}, expected {pose_shape}")
+
+    for key in patch.get("remove_frames", []):
+        frames.pop(str(key), None)
+    frames.update(patch_frames)
+    pose_shape = pose_shape or patch_pose_shape or []
+
+    arrays = {**_arrays(base, base_body), **_arrays(patch, patch_body)}
+    arrays[name] = (
+        {"keys": list(frames), "shape": [len(frames), *pose_shape], "dtype": "<f4"},
+        b"".join(frames.values()),
+    )
+    skipped = ("arrays", name, "base_request_id", "remove_frames")
+    message = {k: v for k, v in base.items() if k not in skipped}
+    message.update((k, v) for k, v in patch.items() if k not in skipped)
+    message["arrays"] = {k: descriptor for k, (descriptor, _) in arrays.items()}
+    return message, b"".join(buffer for _, buffer in arrays.values())
+
+
+def concat_results(parts: list[tuple[dict, bytes]], names: list[str] = RESULT_ARRAYS) -> tuple[dict, bytes]:
+    """
+    Merge the results of the parts of a request into one result, in order.
+
+    The per-sample fields are concatenated along their first dimension, as
+    float32 buffers if possible, all other fields are taken from the first part.
+
+    Args:
+        parts (list[tuple[dict, bytes]]): The headers and bodies of the results.
+        names (list[str]): The fields with one entry per sample.
+
+    Returns:
+        tuple[dict, bytes]: The header and body of the merged result.
+    """
+    decoded = []
+    for message, body in parts:
+        message, body = decompress_body(message, body)
+        # Pack the fields of JSON results, ragged ones stay JSON
+        fields, fields_body = pack_arrays({k: message[k] for k in names if k in message}, names)
+        message = {**message, **fields, "arrays": {**message.get("arrays", {}), **fields.get("arrays", {})}}
+        decoded.append((message, _arrays(message, body + fields_body)))
+
+    first, first_arrays = decoded[0]
+    merged = {k: v for k, v in first.items() if k not in names and k != "arrays"}
+    arrays = {k: v for k, v in first_arrays.items() if k not in names}
+    for name in names:
+        entries = [part_arrays.get(name) for _, part_arrays in decoded]
+        shapes = {tuple(entry[0]["shape"][1:]) for entry in entries if entry is not None}
+        if None not in entries and len(shapes) == 1:
+            arrays[name] = (
+                {"shape": [sum(entry[0]["shape"][0] for entry in entries), *shapes.pop()], "dtype": "<f4"},
+                b"".join(entry[1] for entry in entries),
+            )
+            continue
+        # Missing, ragged or of different shapes, merge as JSON
+        values = []
+        for message, part_arrays in decoded:
+            if name in part_arrays:
+                descriptor, buffer = part_arrays[name]
+                values.extend(unpack_arrays({"arrays": {name: descriptor}}, buffer)[name])
+            else:
+                values.extend(message.get(name, []))
+        merged[name] = values
+    if arrays:
+        merged["arrays"] = {k: descriptor for k, (descriptor, _) in arrays.items()}
+    return merged, b"".join(buffer for _, buffer in arrays.values())
@@ -0,0 +1,340 @@
+import asyncio
+import bisect
+import hashlib
+import heapq
+import itertools
+from abc import ABC, abstractmethod
+from collections import Counter
+from typing import Any, Optional
+
+PRIORITIES = ("interactive", "batch")
+
+
+class JobQueue(ABC):
+    """Interface of the queue and job state of a model, shared by the gateway's dispatchers.
+
+    Implementations order the items by priority class first, then by their
+    deadline and then share the dispatches fairly between the flows (i.e.
+    clients) of a class, see `RequestQueue`. Queues that are shared between several gateway processes can
+    hand out items queued by another gateway, the outcome of such an item is
+    passed back to its gateway with `finish` and picked up there by `collect`.
+    """
+
+    @abstractmethod
+    def __len__(self) -> int:
+        """The number of queued items."""
+
+    @abstractmethod
+    async def put(
+        self,
+        item: Any,
+        flow: str,
+        priority: str = PRIORITIES[0],
+        weight: float = 1.0,
+        cost: float = 1.0,
+        deadline: Optional[float] = None,
+    ):
+        """Queue an item, see `RequestQueue.put`."""
+
+    @abstractmethod
+    async def requeue(self, item: Any, priority: str = PRIORITIES[0]):
+        """Queue an item at the head of its priority class, see `RequestQueue.requeue`."""
+
+    @abstractmethod
+    def promote(self, item: Any, flow: str, priority: str, weight: float = 1.0, cost: float = 1.0) -> bool:
+        """Move a queued item to a higher priority class, see `RequestQueue.promote`."""
+
+    @abstractmethod
+    def remove(self, item: Any) -> bool:
+        """Remove a queued item, e.g. a cancelled one, see `RequestQueue.remove`."""
+
+    @abstractmethod
+    def get_nowait(self) -> tuple[Any, str]:
+        """Remove and return the next item and its priority class.
+
+        Raises:
+            IndexError: If the queue is empty.
+        """
+
+    @abstractmethod
+    async def wait(self):
+        """Wait until the queue contains an item, without removing it."""
+
+    @abstractmethod
+    def positions(self) -> list[tuple[int, Any]]:
+        """The queue positions of the items queued by this gateway, in dispatch order."""
+
+    @abstractmethod
+    def counts(self) -> dict[str, int]:
+        """The number of queued items per priority class."""
+
+    async def get(self) -> tuple[Any, str]:
+        """
+        Remove and return the next item, waiting until one is available.
+
+        Returns:
+            tuple[Any, str]: The item and its priority class.
+        """
+        while True:
+            await self.wait()
+            try:
+                return self.get_nowait()
+            except IndexError:
+                continue  # Taken by another gateway in the meantime
+
+    async def finish(self, item: Any, frame: bytes):
+        """
+        Pass the outcome of an item queued by another gateway back to it.
+
+        Only called for items handed out by queues shared between gateways.
+
+        Args:
+            item (Any): The item taken from the queue.
+            frame (bytes): The encoded `result` or `error` message.
+        """
+        raise NotImplementedError
+
+    async def collect(self) -> list[tuple[Any, bytes]]:
+        """
+        Take the outcomes of the items of this gateway that other gateways finished.
+
+        Returns:
+            list[tuple[Any, bytes]]: The items and their encoded outcomes.
+        """
+        return []
+
+
+class RequestQueue(JobQueue):
+    """Queue with strict priority classes and weighted fair queueing per client.
+
+    Items of a higher priority class are always taken first. Within a class,
+    items with a deadline are taken earliest deadline first, ahead of the items
+    without one. All other items are shared between the flows (i.e. clients) of
+    the class, every flow gets a share of the dispatches proportional to its
+    weight, so a client that enqueues hundreds of requests at once can not
+    starve the others. This is self-clocked fair queueing: each item is tagged
+    with the virtual time at which it would finish if all backlogged flows were
+    served in proportion to their weights, and the smallest tag goes first.
+
+    This is the in-memory `JobQueue` of a single gateway process.
+    """
+
+    def __init__(self, priorities: tuple[str, ...] = PRIORITIES):
+        """
+        Args:
+            priorities (tuple[str, ...]): The priority classes, highest first.
+        """
+        self.priorities = priorities
+        self.heaps: dict[str, list] = {p: [] for p in priorities}
+        self.virtual_time: dict[str, float] = dict.fromkeys(priorities, 0.0)
+        self.finish_tags: dict[str, dict[str, float]] = {p: {} for p in priorities}
+        self.entries: dict[int, list] = {}
+        self.counter = itertools.count()
+        self.not_empty = asyncio.Condition()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def qsize(self) -> int:
+        """The number of queued items."""
+        return len(self.entries)
+
+    def items(self) -> list[Any]:
+        """The queued items in the order they would be taken right now."""
+        return [
+            entry[3]
+            for priority in self.priorities
+            for entry in sorted(e for e in self.heaps[priority] if e[5])
+        ]
+
+    def positions(self) -> list[tuple[int, Any]]:
+        """The queue positions of all queued items, in dispatch order."""
+        return list(enumerate(self.items()))
+
+    def counts(self) -> dict[str, int]:
+        """The number of queued items per priority class."""
+        counts = Counter(entry[4] for entry in self.entries.values())
+        return {priority: counts[priority] for priority in self.priorities}
+
+    def _push(self, item: Any, flow: str, priority: str, weight: float, cost: float, due: float):
+        if priority not in self.heaps:
+            raise ValueError(f"Unknown priority {priority!r}, expected one of {self.priorities}")
+        finish_tags = self.finish_tags[priority]
+        start = max(self.virtual_time[priority], finish_tags.get(flow, 0.0))
+        finish_tags[flow] = start + cost / weight
+        # [deadline, finish tag, sequence number, item, priority, valid]
+        entry = [due, finish_tags[flow], next(self.counter), item, priority, True]
+        heapq.heappush(self.heaps[priority], entry)
+        self.entries[id(item)] = entry
+
+    async def put(
+        self,
+        item: Any,
+        flow: str,
+        priority: str = PRIORITIES[0],
+        weight: float = 1.0,
+        cost: float = 1.0,
+        deadline: Optional[float] = None,
+    ):
+        """
+        Queue an item.
+
+        Args:
+            item (Any): The item to queue.
+            flow (str): The flow the item belongs to, e.g. the client ID.
+            priority (str): The priority class of the item.
+            weight (float): The weight of the flow within its class.
+            cost (float): The cost of the item, e.g. its expected service time.
+            deadline (Optional[float]): The Unix time by which the item has to
+                be taken, None for no deadline.
+
+        Raises:
+            ValueError: If the priority class is unknown.
+        """
+        self._push(item, flow, priority, weight, cost, float("inf") if deadline is None else deadline)
+        async with self.not_empty:
+            self.not_empty.notify()
+
+    async def requeue(self, item: Any, priority: str = PRIORITIES[0]):
+        """
+        Queue an item at the head of its priority class, e.g. to retry it.
+
+        Requeued items keep their order among themselves.
+
+        Args:
+            item (Any): The item to queue.
+            priority (str): The priority class of the item.
+        """
+        entry = [float("-inf"), float("-inf"), next(self.counter), item, priority, True]
+        heapq.heappush(self.heaps[priority], entry)
+        self.entries[id(item)] = entry
+        async with self.not_empty:
+            self.not_empty.notify()
+
+    def promote(self, item: Any, flow: str, priority: str, weight: float = 1.0, cost: float = 1.0) -> bool:
+        """
+        Move a queued item to a higher priority class.
+
+        Args:
+            item (Any): The queued item.
+            flow (str): The flow to charge in the new class.
+            priority (str): The new priority class.
+            weight (float): The weight of the flow within its new class.
+            cost (float): The cost of the item.
+
+        Returns:
+            bool: Whether the item was moved, False if it is not queued or its
+                priority is already as high.
+        """
+        entry = self.entries.get(id(item))
+        if entry is None or self.priorities.index(priority) >= self.priorities.index(entry[4]):
+            return False
+        entry[5] = False  # Invalidate, it is skipped when it is popped
+        del self.entries[id(item)]
+        self._push(item, flow, priority, weight, cost, entry[0])
+        return True
+
+    def remove(self, item: Any) -> bool:
+        """
+        Remove a queued item, e.g. because it was cancelled.
+
+        Args:
+            item (Any): The queued item.
+
+        Returns:
+            bool: Whether the item was queued.
+        """
+        entry = self.entries.pop(id(item), None)
+        if entry is None:
+            return False
+        entry[5] = False  # Invalidate, it is skipped when it is popped
+        return True
+
+    def get_nowait(self) -> tuple[Any, str]:
+        """
+        Remove and return the next item.
+
+        Returns:
+            tuple[Any, str]: The item and its priority class.
+
+        Raises:
+            IndexError: If the queue is empty.
+        """
+        for priority in self.priorities:
+            heap = self.heaps[priority]
+            while heap:
+                _, tag, _, item, _, valid = heapq.heappop(heap)
+                if valid:
+                    del self.entries[id(item)]
+                    self.virtual_time[priority] = max(self.virtual_time[priority], tag)
+                    if not heap:
+                        # All flows are idle, their history no longer matters
+                        self.finish_tags[priority].clear()
+                    return item, priority
+        raise IndexError("get from an empty RequestQueue")
+
+    async def wait(self):
+        """Wait until the queue contains an item, without removing it."""
+        async with self.not_empty:
+            while not self.entries:
+                await self.not_empty.wait()
+
+
+class HashRing:
+    """Consistent hashing of keys, e.g. sessions, onto a changing set of nodes.
+
+    Every node is placed at `replicas` pseudo-random points of a ring, a key
+    belongs to the first node following its own point. When a node joins or
+    leaves, only the keys between its points and their predecessors move, all
+    other keys keep their node.
+
+    Args:
+        replicas (int): The number of points per node, more points spread the
+            keys more evenly.
+    """
+
+    def __init__(self, replicas: int = 64):
+        self.replicas = replicas
+        self.points: list[tuple[int, str]] = []
+
+    def __len__(self) -> int:
+        return len(self.points) // self.replicas
+
+    def __contains__(self, node: str) -> bool:
+        return (self._hash(f"{node}:0"), node) in self.points
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+    def add(self, node: str):
+        """Add a node to the ring, nodes already on the ring are ignored."""
+        if node in self:
+            return
+        for i in range(self.replicas):
+            bisect.insort(self.points, (self._hash(f"{node}:{i}"), node))
+
+    def remove(self, node: str):
+        """Remove a node from the ring, unknown nodes are ignored."""
+        self.points = [point for point in self.points if point[1] != node]
+
+    def nodes(self, key: str):
+        """
+        Iterate over the distinct nodes in the order of preference for a key.
+
+        The first node owns the key, the following ones take it over in turn
+        if the nodes before them leave the ring.
+
+        Args:
+            key (str): The key to look up.
+
+        Yields:
+            str: The nodes, each once.
+        """
+        start = bisect.bisect(self.points, (self._hash(key), ""))
+        seen = set()
+        for i in range(len(self.points)):
+            node = self.points[(start + i) % len(self.points)][1]
+            if node not in seen:
+                seen.add(node)
+                yield node
@@ -0,0 +1,144 @@
+import asyncio
+import logging
+import time
+from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger("backend.spool")
+
+# Job states after which nothing changes anymore
+FINAL_STATES = ("done", "failed", "rejected", "cancelled", "expired")
+
+
+class JobSpool:
+    """Status records and on-disk results of jobs submitted over HTTP.
+
+    Only a small status record per job is kept in memory, results are written to
+    `directory` as encoded binary frames, see `molab_backend.protocol`, as soon as
+    they arrive. Results from before a restart can still be downloaded, their
+    record is recreated from the file. Finished jobs older than `ttl` seconds are
+    removed by `prune`.
+    """
+
+    def __init__(self, directory: Path, ttl: float):
+        """
+        Initialize the spool and remove expired results from its directory.
+
+        Args:
+            directory (Path): The directory the results are written to.
+            ttl (float): The number of seconds a finished job is kept.
+        """
+        self.directory = directory
+        self.ttl = ttl
+        self.records: dict[str, dict] = {}
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.prune()
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def result_path(self, job_id: str) -> Path:
+        """The path of the spooled result of a job."""
+        return self.directory / f"{job_id}.bin"
+
+    def create(self, job_id: str) -> dict:
+        """
+        Add the record of a new job.
+
+        Args:
+            job_id (str): The ID of the job, used as `request_id` in the gateway.
+
+        Returns:
+            dict: The status record of the job.
+        """
+        now = time.time()
+        record = {"id": job_id, "status": "queued", "created_at": now, "updated_at": now}
+        self.records[job_id] = record
+        return record
+
+    def get(self, job_id: str) -> Optional[dict]:
+        """
+        Get the status record of a job.
+
+        Args:
+            job_id (str): The ID of the job.
+
+        Returns:
+            Optional[dict]: The status record, None if the job is unknown or expired.
+        """
+        record = self.records.get(job_id)
+        if record is None and Path(job_id).name == job_id and self.result_path(job_id).is_file():
+            # Finished before a restart
+            stored_at = self.result_path(job_id).stat().st_mtime
+            record = {"id": job_id, "status": "done", "created_at": stored_at, "updated_at": stored_at}
+            self.records[job_id] = record
+        return record
+
+    def update(self, job_id: str, **fields):
+        """
+        Update the status record of a job, final states are never left again.
+
+        Args:
+            job_id (str): The ID of the job.
+            **fields: The fields to update, e.g. `status`, `position` or `progress`.
+        """
+        record = self.records.get(job_id)
+        if record is None or record["status"] in FINAL_STATES:
+            return
+        record.update(fields, updated_at=time.time())
+
+    def _store(self, job_id: str, data: bytes):
+        """Write a result, atomically so a download never sees a partial file."""
+        path = self.result_path(job_id)
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_bytes(data)
+        tmp_path.replace(path)
+
+    async def store(self, job_id: str, data: bytes):
+        """
+        Spool the result of a job and mark it as done.
+
+        Args:
+            job_id (str): The ID of the job.
+            data (bytes): The encoded result.
+        """
+        try:
+            await asyncio.to_thread(self._store, job_id, data)
+        except OSError as e:
+            logger.exception(f"Failed to spool the result of job {job_id}")
+            self.update(job_id, status="failed", error=f"Failed to spool the result: {e}")
+            return
+        self.update(job_id, status="done", size=len(data))
+
+    def _prune_records(self):
+        now = time.time()
+        for job_id, record in list(self.records.items()):
+            if record["status"] in FINAL_STATES and now - record["updated_at"] > self.ttl:
+                del self.records[job_id]
+
+    def _prune_directory(self):
+        now = time.time()
+        for path in self.directory.iterdir():
+            if now - path.stat().st_mtime > self.ttl:
+                path.unlink(missing_ok=True)
+
+    def prune(self):
+        """Remove finished jobs and spooled results that exceeded the TTL."""
+        self._prune_records()
+        self._prune_directory()
+
+    async def prune_periodically(self, interval: float):
+        """
+        Call `prune` every `interval` seconds.
+
+        Args:
+            interval (float): The seconds between two prunes.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            self._prune_records()
+            try:
+                await asyncio.to_thread(self._prune_directory)
+            except OSError:
+                logger.exception("Failed to prune the job spool")
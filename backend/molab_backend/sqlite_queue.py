@@ -0,0 +1,385 @@
+import asyncio
+import contextlib
+import logging
+import sqlite3
+import time
+from operator import attrgetter
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+from .scheduling import PRIORITIES, JobQueue
+
+logger = logging.getLogger("backend.sqlite_queue")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    model TEXT NOT NULL,
+    priority INTEGER NOT NULL,
+    due REAL NOT NULL,
+    tag REAL NOT NULL,
+    seq INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    owner TEXT NOT NULL,
+    data BLOB NOT NULL,
+    result BLOB,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_due_order ON jobs (model, state, priority, due, tag, seq);
+CREATE INDEX IF NOT EXISTS jobs_owner ON jobs (owner, state);
+CREATE INDEX IF NOT EXISTS jobs_seq ON jobs (seq);
+CREATE TABLE IF NOT EXISTS flows (
+    model TEXT NOT NULL,
+    priority INTEGER NOT NULL,
+    flow TEXT NOT NULL,
+    finish_tag REAL NOT NULL,
+    PRIMARY KEY (model, priority, flow)
+);
+CREATE TABLE IF NOT EXISTS clocks (
+    model TEXT NOT NULL,
+    priority INTEGER NOT NULL,
+    virtual_time REAL NOT NULL,
+    PRIMARY KEY (model, priority)
+);
+"""
+
+
+class SQLiteQueue(JobQueue):
+    """Durable `JobQueue` in a SQLite database shared by several gateway processes.
+
+    The queue of a model is a table of jobs ordered like `RequestQueue`, i.e. by
+    priority class, deadline and the weighted fair queueing tag of their flow, with the
+    virtual times and finish tags stored next to it so all gateways share them.
+    Every gateway can take any queued job: its own jobs are handed out as the
+    original items, jobs of other gateways are rebuilt with `decode`. The
+    outcomes of those jobs are written back to the database by `finish` and
+    taken by the owning gateway with `collect`, which relays them to its clients.
+
+    Jobs that are not collected, e.g. because their gateway is gone for good,
+    are removed after `ttl` seconds.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        model: str,
+        owner: str,
+        encode: Callable[[Any], bytes],
+        decode: Callable[[bytes], Any],
+        identify: Callable[[Any], str] = attrgetter("id"),
+        priorities: tuple[str, ...] = PRIORITIES,
+        poll_interval: float = 0.1,
+        ttl: float = 24 * 60 * 60,
+    ):
+        """
+        Open or create the database.
+
+        Args:
+            path (Path): The database file, on a local disk of the host running
+                the gateways, SQLite locking is not reliable on network filesystems.
+            model (str): The model of the queued jobs.
+            owner (str): The unique identifier of this gateway process.
+            encode (Callable[[Any], bytes]): Serializes an item.
+            decode (Callable[[bytes], Any]): Rebuilds an item from its serialized form.
+            identify (Callable[[Any], str]): Returns the unique ID of an item,
+                its `id` attribute by default.
+            priorities (tuple[str, ...]): The priority classes, highest first.
+            poll_interval (float): The seconds between two checks for jobs
+                queued by other gateways.
+            ttl (float): The seconds after which uncollected jobs are removed.
+        """
+        self.path = path
+        self.model = model
+        self.owner = owner
+        self.encode = encode
+        self.decode = decode
+        self.identify = identify
+        self.priorities = priorities
+        self.poll_interval = poll_interval
+        self.ttl = ttl
+        self.local: dict[str, Any] = {}
+        self.not_empty = asyncio.Condition()
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Transactions are handled explicitly, see `_transaction`
+        self.db = sqlite3.connect(path, timeout=5.0, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(jobs)")}
+        if columns and "due" not in columns:
+            # Created before deadlines were supported
+            self.db.execute("DROP INDEX IF EXISTS jobs_order")
+            self.db.execute("ALTER TABLE jobs ADD COLUMN due REAL NOT NULL DEFAULT 9e999")
+        self.db.executescript(SCHEMA)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """Run the statements in an exclusive write transaction across processes."""
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.db
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+
+    def __len__(self) -> int:
+        (count,) = self.db.execute(
+            "SELECT COUNT(*) FROM jobs WHERE model = ? AND state = 'queued'", (self.model,)
+        ).fetchone()
+        return count
+
+    def _priority_index(self, priority: str) -> int:
+        if priority not in self.priorities:
+            raise ValueError(f"Unknown priority {priority!r}, expected one of {self.priorities}")
+        return self.priorities.index(priority)
+
+    def _next_seq(self) -> int:
+        (seq,) = self.db.execute("SELECT COALESCE(MAX(seq), 0) + 1 FROM jobs").fetchone()
+        return seq
+
+    def _tag(self, flow: str, priority: int, weight: float, cost: float) -> float:
+        """Compute the finish tag of a new item of a flow and remember it, within a transaction."""
+        row = self.db.execute(
+            "SELECT virtual_time FROM clocks WHERE model = ? AND priority = ?",
+            (self.model, priority),
+        ).fetchone()
+        virtual_time = row[0] if row else 0.0
+        row = self.db.execute(
+            "SELECT finish_tag FROM flows WHERE model = ? AND priority = ? AND flow = ?",
+            (self.model, priority, flow),
+        ).fetchone()
+        tag = max(virtual_time, row[0] if row else 0.0) + cost / weight
+        self.db.execute(
+            "INSERT OR REPLACE INTO flows (model, priority, flow, finish_tag) VALUES (?, ?, ?, ?)",
+            (self.model, priority, flow, tag),
+        )
+        return tag
+
+    def _insert(self, item: Any, priority: int, due: float, tag: float):
+        """Insert or replace the row of an item, within a transaction."""
+        job_id = self.identify(item)
+        self.db.execute(
+            "INSERT OR REPLACE INTO jobs (id, model, priority, due, tag, seq, state, owner, data, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, 'queued', COALESCE((SELECT owner FROM jobs WHERE id = ?), ?), ?, ?)",
+            (
+                job_id, self.model, priority, due, tag, self._next_seq(),
+                job_id, self.owner, self.encode(item), time.time(),
+            ),
+        )
+        (owner,) = self.db.execute("SELECT owner FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if owner == self.owner:
+            self.local[job_id] = item
+
+    async def _notify(self):
+        async with self.not_empty:
+            self.not_empty.notify()
+
+    async def put(
+        self,
+        item: Any,
+        flow: str,
+        priority: str = PRIORITIES[0],
+        weight: float = 1.0,
+        cost: float = 1.0,
+        deadline: Optional[float] = None,
+    ):
+        """
+        Queue an item.
+
+        Args:
+            item (Any): The item to queue.
+            flow (str): The flow the item belongs to, e.g. the client ID.
+            priority (str): The priority class of the item.
+            weight (float): The weight of the flow within its class.
+            cost (float): The cost of the item, e.g. its expected service time.
+            deadline (Optional[float]): The Unix time by which the item has to
+                be taken, None for no deadline.
+
+        Raises:
+            ValueError: If the priority class is unknown.
+        """
+        index = self._priority_index(priority)
+        due = float("inf") if deadline is None else deadline
+        with self._transaction():
+            self._insert(item, index, due, self._tag(flow, index, weight, cost))
+        await self._notify()
+
+    async def requeue(self, item: Any, priority: str = PRIORITIES[0]):
+        """
+        Queue an item at the head of its priority class, e.g. to retry it.
+
+        Requeued items keep their order among themselves and their owner, so
+        the outcome still reaches the gateway of their clients.
+
+        Args:
+            item (Any): The item to queue.
+            priority (str): The priority class of the item.
+        """
+        with self._transaction():
+            self._insert(item, self._priority_index(priority), float("-inf"), float("-inf"))
+        await self._notify()
+
+    def promote(self, item: Any, flow: str, priority: str, weight: float = 1.0, cost: float = 1.0) -> bool:
+        """
+        Move a queued item to a higher priority class.
+
+        Args:
+            item (Any): The queued item.
+            flow (str): The flow to charge in the new class.
+            priority (str): The new priority class.
+            weight (float): The weight of the flow within its new class.
+            cost (float): The cost of the item.
+
+        Returns:
+            bool: Whether the item was moved, False if it is not queued or its
+                priority is already as high.
+        """
+        job_id = self.identify(item)
+        index = self._priority_index(priority)
+        with self._transaction():
+            row = self.db.execute(
+                "SELECT priority FROM jobs WHERE id = ? AND state = 'queued'", (job_id,)
+            ).fetchone()
+            if row is None or index >= row[0]:
+                return False
+            self.db.execute(
+                "UPDATE jobs SET priority = ?, tag = ?, updated_at = ? WHERE id = ?",
+                (index, self._tag(flow, index, weight, cost), time.time(), job_id),
+            )
+        return True
+
+    def remove(self, item: Any) -> bool:
+        """
+        Remove an item, e.g. because it was cancelled.
+
+        Items taken by another gateway are removed as well, so their outcome is
+        dropped instead of being collected.
+
+        Args:
+            item (Any): The item.
+
+        Returns:
+            bool: Whether the item was still queued.
+        """
+        job_id = self.identify(item)
+        self.local.pop(job_id, None)
+        with self._transaction():
+            row = self.db.execute("SELECT state FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            self.db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+        return row is not None and row[0] == "queued"
+
+    def get_nowait(self) -> tuple[Any, str]:
+        """
+        Take the next item, which may have been queued by another gateway.
+
+        Returns:
+            tuple[Any, str]: The item and its priority class.
+
+        Raises:
+            IndexError: If the queue is empty.
+        """
+        with self._transaction():
+            row = self.db.execute(
+                "SELECT id, priority, tag, owner, data FROM jobs "
+                "WHERE model = ? AND state = 'queued' ORDER BY priority, due, tag, seq LIMIT 1",
+                (self.model,),
+            ).fetchone()
+            if row is None:
+                raise IndexError("get from an empty SQLiteQueue")
+            job_id, priority, tag, owner, data = row
+            if owner == self.owner:
+                # Nobody else needs to know about it anymore
+                self.db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+            else:
+                self.db.execute(
+                    "UPDATE jobs SET state = 'running', updated_at = ? WHERE id = ?",
+                    (time.time(), job_id),
+                )
+            self.db.execute(
+                "INSERT INTO clocks (model, priority, virtual_time) VALUES (?, ?, ?) "
+                "ON CONFLICT (model, priority) DO UPDATE SET virtual_time = MAX(virtual_time, excluded.virtual_time)",
+                (self.model, priority, max(tag, 0.0)),
+            )
+            (remaining,) = self.db.execute(
+                "SELECT COUNT(*) FROM jobs WHERE model = ? AND state = 'queued' AND priority = ?",
+                (self.model, priority),
+            ).fetchone()
+            if not remaining:
+                # All flows are idle, their history no longer matters
+                self.db.execute(
+                    "DELETE FROM flows WHERE model = ? AND priority = ?", (self.model, priority)
+                )
+        item = self.local.pop(job_id) if owner == self.owner else self.decode(data)
+        return item, self.priorities[priority]
+
+    async def wait(self):
+        """Wait until the queue contains an item, checking for items of other gateways periodically."""
+        while not len(self):
+            async with self.not_empty:
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self.not_empty.wait(), self.poll_interval)
+
+    def positions(self) -> list[tuple[int, Any]]:
+        """The queue positions of the items queued by this gateway, in dispatch order."""
+        rows = self.db.execute(
+            "SELECT id FROM jobs WHERE model = ? AND state = 'queued' ORDER BY priority, due, tag, seq",
+            (self.model,),
+        ).fetchall()
+        return [
+            (position, self.local[job_id])
+            for position, (job_id,) in enumerate(rows)
+            if job_id in self.local
+        ]
+
+    def counts(self) -> dict[str, int]:
+        """The number of queued items per priority class, of all gateways."""
+        rows = self.db.execute(
+            "SELECT priority, COUNT(*) FROM jobs WHERE model = ? AND state = 'queued' GROUP BY priority",
+            (self.model,),
+        ).fetchall()
+        counts = dict(rows)
+        return {priority: counts.get(i, 0) for i, priority in enumerate(self.priorities)}
+
+    async def finish(self, item: Any, frame: bytes):
+        """
+        Store the outcome of an item of another gateway, to be collected by it.
+
+        Outcomes of items that were cancelled in the meantime are dropped.
+
+        Args:
+            item (Any): The item taken from the queue.
+            frame (bytes): The encoded `result` or `error` message.
+        """
+        job_id = self.identify(item)
+        with self._transaction():
+            self.db.execute(
+                "UPDATE jobs SET state = 'done', result = ?, updated_at = ? "
+                "WHERE id = ? AND state = 'running'",
+                (frame, time.time(), job_id),
+            )
+
+    async def collect(self) -> list[tuple[Any, bytes]]:
+        """
+        Take the outcomes of the items of this gateway that other gateways finished.
+
+        Also removes jobs that nobody collected within the TTL.
+
+        Returns:
+            list[tuple[Any, bytes]]: The items and their encoded outcomes.
+        """
+        with self._transaction():
+            rows = self.db.execute(
+                "SELECT id, result FROM jobs WHERE owner = ? AND model = ? AND state = 'done'",
+                (self.owner, self.model),
+            ).fetchall()
+            self.db.executemany("DELETE FROM jobs WHERE id = ?", [(job_id,) for job_id, _ in rows])
+            self.db.execute(
+                "DELETE FROM jobs WHERE model = ? AND updated_at < ?",
+                (self.model, time.time() - self.ttl),
+            )
+        outcomes = []
+        for job_id, frame in rows:
+            item = self.local.pop(job_id, None)
+            if item is not None:
+                outcomes.append((item, frame))
+        return outcomes
@@ -0,0 +1,62 @@
+import asyncio
+import sys
+from collections import Counter
+from types import SimpleNamespace
+
+from molab_backend.autoscaler import Autoscaler, desired_workers
+
+
+def test_desired_workers():
+    assert desired_workers(0, 0, 0.0, 30.0, 1, 60.0) == 0
+    # A single queued job needs a worker
+    assert desired_workers(1, 0, 0.0, 30.0, 1, 60.0) == 1
+    # 0.1 jobs/s of 30s keep 3 slots busy, at 80% utilization that are 4 slots
+    assert desired_workers(0, 0, 0.1, 30.0, 1, 60.0) == 4
+    assert desired_workers(0, 0, 0.1, 30.0, 2, 60.0) == 2
+    # 200 queued jobs worked off within 10 minutes
+    assert desired_workers(200, 0, 0.0, 30.0, 1, 600.0) == 10
+    # Running jobs keep their workers
+    assert desired_workers(0, 3, 0.0, 30.0, 1, 60.0) == 3
+
+
+def test_launch_and_retire():
+    async def run():
+        manager = SimpleNamespace(
+            workers=[],
+            queues={"model": [object()] * 5},
+            arrivals=Counter(),
+            lock=asyncio.Lock(),
+            models={"model"},
+        )
+        autoscaler = Autoscaler(
+            manager,
+            command=f'"{sys.executable}" -c "import time; time.sleep(60)"',
+            max_workers=2,
+            up_cooldown=0,
+            down_cooldown=0,
+        )
+        try:
+            await autoscaler.update()
+            assert autoscaler.status()["model"]["desired"] == 1
+            [process] = autoscaler.processes["model"]
+
+            # The launched worker connects and is busy, so it is kept
+            worker = SimpleNamespace(
+                model="model", pid=process.pid, retiring=False, load=1, capacity=1, service_time=30.0
+            )
+            manager.workers.append(worker)
+            manager.queues["model"] = []
+            await autoscaler.update()
+            assert autoscaler.status()["model"]["desired"] == 1
+            assert autoscaler.processes["model"] == [process]
+
+            worker.load = 0
+            await autoscaler.update()
+            assert autoscaler.status()["model"]["desired"] == 0
+            assert worker.retiring
+            assert autoscaler.processes["model"] == []
+            assert await asyncio.wait_for(process.wait(), 10) != 0
+        finally:
+            await autoscaler.stop()
+
+    asyncio.run(run())
@@ -0,0 +1,30 @@
+import asyncio
+
+from molab_backend.cache import ResultCache
+
+
+def test_eviction_and_spill(tmp_path):
+    async def run():
+        cache = ResultCache(max_bytes=40, ttl=60, spill_dir=tmp_path)
+        await cache.put("a", b"a" * 30)
+        await cache.put("b", b"b" * 30)
+        assert len(cache) == 1  # "a" was evicted from memory ...
+        assert await cache.get("a") == b"a" * 30  # ... but not from disk
+
+        # A new cache with the same directory survives a restart
+        restarted = ResultCache(max_bytes=40, ttl=60, spill_dir=tmp_path)
+        assert await restarted.get("b") == b"b" * 30
+        assert await restarted.get("c") is None
+
+    asyncio.run(run())
+
+
+def test_ttl():
+    async def run():
+        cache = ResultCache(max_bytes=1000, ttl=0)
+        await cache.put("a", b"1")
+        await asyncio.sleep(0.01)
+        assert await cache.get("a") is None
+        assert cache.size == 0
+
+    asyncio.run(run())
@@ -0,0 +1,28 @@
+import asyncio
+
+from molab_backend.loadtest import free_port, percentile, run_load_test, start_gateway
+
+
+def test_percentile():
+    values = [float(i) for i in range(1, 101)]
+    assert percentile(values, 50) == 50.0
+    assert percentile(values, 99) == 99.0
+    assert percentile([], 50) is None
+
+
+def test_load_test():
+    port = free_port()
+    with start_gateway(port) as process:
+        report = asyncio.run(
+            run_load_test(
+                f"ws://localhost:{port}",
+                workers=2,
+                clients=2,
+                requests=3,
+                service_time=0.01,
+                frames=10,
+                pid=process.pid,
+            )
+        )
+    assert report.results == 6
+    assert report.summary()["throughput"] > 0
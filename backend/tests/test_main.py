@@ -0,0 +1,746 @@
+import asyncio
+import json
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+from molab_backend import main
+from molab_backend.main import (
+    Connection,
+    Job,
+    Subscriber,
+    WorkerManager,
+    app,
+    derive_seed,
+    worker_manager,
+)
+from molab_backend.protocol import (
+    compress_body,
+    decode_frame,
+    encode_frame,
+    loads,
+    pack_arrays,
+    unpack_arrays,
+)
+
+
+@pytest.fixture(scope="module")
+def test_client():
+    with TestClient(app) as test_client:
+        yield test_client
+
+
+def receive(websocket, message_type: str) -> dict:
+    """Receive messages until one of the given type arrives."""
+    while True:
+        message = websocket.receive_json()
+        if message["type"] == message_type:
+            return message
+
+
+def test_dispatch_to_all_workers(test_client: TestClient):
+    """Both workers receive a job before either of them has answered."""
+    with test_client.websocket_connect(
+        "/register_worker"
+    ) as worker_a, test_client.websocket_connect(
+        "/register_worker"
+    ) as worker_b, test_client.websocket_connect("/register_client") as client:
+        client.send_json({"type": "infer", "text_prompt": "first"})
+        client.send_json({"type": "infer", "text_prompt": "second"})
+
+        job_a = receive(worker_a, "infer")
+        job_b = receive(worker_b, "infer")
+        assert {job_a["text_prompt"], job_b["text_prompt"]} == {"first", "second"}
+
+        # Answer out of order, the results still reach the client
+        worker_b.send_json({"root_positions": [], "request_id": job_b["request_id"]})
+        worker_a.send_json({"root_positions": [], "request_id": job_a["request_id"]})
+        assert "root_positions" in receive(client, "result")
+        assert "root_positions" in receive(client, "result")
+
+
+def test_worker_capacity(test_client: TestClient):
+    """A worker advertising two slots receives two jobs at once."""
+    with test_client.websocket_connect(
+        "/register_worker"
+    ) as worker, test_client.websocket_connect("/register_client") as client:
+        worker.send_json({"type": "register", "capacity": 2})
+        client.send_json({"type": "infer", "text_prompt": "first"})
+        client.send_json({"type": "infer", "text_prompt": "second"})
+
+        jobs = [receive(worker, "infer"), receive(worker, "infer")]
+        assert [job["text_prompt"] for job in jobs] == ["first", "second"]
+
+        for job in jobs:
+            worker.send_json({"root_positions": [], "request_id": job["request_id"]})
+            assert "root_positions" in receive(client, "result")
+
+
+def test_request_ids(test_client: TestClient):
+    """Responses are tagged with the client's request ID, even out of order."""
+    with test_client.websocket_connect(
+        "/register_worker"
+    ) as worker, test_client.websocket_connect("/register_client") as client:
+        worker.send_json({"type": "register", "capacity": 2})
+        client.send_json({"type": "infer", "text_prompt": "a", "request_id": "a"})
+        assert receive(client, "queued")["request_id"] == "a"
+        client.send_json({"type": "infer", "text_prompt": "b"})
+        assigned_id = receive(client, "queued")["request_id"]
+
+        job_a, job_b = receive(worker, "infer"), receive(worker, "infer")
+        worker.send_json({"type": "error", "message": "oops", "request_id": job_b["request_id"]})
+        worker.send_json({"type": "result", "request_id": job_a["request_id"]})
+
+        error = receive(client, "error")
+        assert error["request_id"] == assigned_id
+        assert error["message"] == "oops"
+        assert receive(client, "result")["request_id"] == "a"
+
+        client.send_json({"type": "unknown", "request_id": "b"})
+        assert receive(client, "error")["request_id"] == "b"
+
+
+def test_coalescing(test_client: TestClient):
+    """Identical requests share one job, unless coalescing is disabled."""
+    coalesced = test_client.get("/stats").json().get("coalesced_queued", 0)
+    with test_client.websocket_connect("/register_client") as client:
+        request = {"type": "infer", "text_prompt": "coalesce", "num_samples": 1}
+        client.send_json({**request, "request_id": "a"})
+        client.send_json({**request, "request_id": "b"})
+        client.send_json({**request, "request_id": "c", "coalesce": False})
+        for _ in range(3):
+            receive(client, "queued")
+
+        with test_client.websocket_connect("/register_worker") as worker:
+            job = receive(worker, "infer")
+            assert "coalesce" not in job
+            worker.send_json({"type": "result", "request_id": job["request_id"]})
+            request_ids = {receive(client, "result")["request_id"] for _ in range(2)}
+            assert request_ids == {"a", "b"}
+
+            job = receive(worker, "infer")
+            worker.send_json({"type": "result", "request_id": job["request_id"]})
+            assert receive(client, "result")["request_id"] == "c"
+
+    assert test_client.get("/stats").json()["coalesced_queued"] == coalesced + 1
+
+
+def test_result_cache(test_client: TestClient):
+    """Requests with a fixed seed are answered from the cache the second time."""
+    request = {"type": "infer", "text_prompt": "cached", "seed": 42}
+    with test_client.websocket_connect(
+        "/register_worker"
+    ) as worker, test_client.websocket_connect("/register_client") as client:
+        worker.send_json({"type": "register", "checkpoint": "test_checkpoint"})
+        client.send_json({**request, "request_id": "a"})
+        job = receive(worker, "infer")
+        worker.send_json({"type": "result", "root_positions": [1], "request_id": job["request_id"]})
+        assert receive(client, "result")["request_id"] == "a"
+
+        # The worker never sees the second request
+        client.send_json({**request, "request_id": "b"})
+        result = receive(client, "result")
+        assert result["request_id"] == "b"
+        assert result["root_positions"] == [1]
+
+
+def test_binary_frames(test_client: TestClient):
+    """Binary results are relayed as is to binary clients and decoded for JSON clients."""
+    request = {"type": "infer", "text_prompt": "binary"}
+    with test_client.websocket_connect(
+        "/register_worker"
+    ) as worker, test_client.websocket_connect(
+        "/register_client"
+    ) as json_client, test_client.websocket_connect("/register_client") as binary_client:
+        worker.send_json({"type": "register", "encodings": ["binary", "json"]})
+        assert "binary" in receive(worker, "registered")["encodings"]
+        binary_client.send_json({"type": "hello", "encodings": ["binary", "json"]})
+        assert "binary" in receive(binary_client, "hello")["encodings"]
+
+        json_client.send_json({**request, "request_id": "json"})
+        job = receive(worker, "infer")
+        binary_client.send_json({**request, "request_id": "binary"})
+        receive(binary_client, "queued")
+
+        positions = [[0.5, 1.0, 1.5], [2.0, 2.5, 3.0]]
+        result, body = pack_arrays(
+            {"type": "result", "request_id": job["request_id"], "root_positions": positions},
+            ["root_positions"],
+        )
+        assert len(body) == 6 * 4
+        worker.send_bytes(encode_frame(result, body))
+
+        assert receive(json_client, "result")["root_positions"] == positions
+        message, body = decode_frame(binary_client.receive_bytes())
+        assert message["request_id"] == "binary"
+        assert unpack_arrays(message, body)["root_positions"] == positions
+
+
+def test_compression(test_client: TestClient):
+    """Compressed results are relayed as they are and only decompressed for other peers."""
+    request = {"type": "infer", "text_prompt": "compressed"}
+    with test_client.websocket_connect(
+        "/register_worker"
+    ) as worker, test_client.websocket_connect(
+        "/register_client"
+    ) as zlib_client, test_client.websocket_connect("/register_client") as plain_client:
+        worker.send_json({"type": "register", "encodings": ["binary"], "compression": ["zlib"]})
+        assert receive(worker, "registered")["compression"] == ["zlib"]
+        zlib_client.send_json({"type": "hello", "encodings": ["binary"], "compression": ["lz4", "zlib"]})
+        assert receive(zlib_client, "hello")["compression"] == ["zlib"]
+        plain_client.send_json({"type": "hello", "encodings": ["binary"]})
+        assert receive(plain_client, "hello")["compression"] == []
+
+        zlib_client.send_json({**request, "request_id": "zlib"})
+        receive(zlib_client, "queued")
+        job = receive(worker, "infer")
+        plain_client.send_json({**request, "request_id": "plain"})
+        receive(plain_client, "queued")
+
+        positions = [[0.0, 1.0, 0.0]] * 100
+        result, body = pack_arrays(
+            {"type": "result", "request_id": job["request_id"], "root_positions": positions},
+            ["root_positions"],
+        )
+        compressed, compressed_body = compress_body(result, body, ["zlib"], threshold=0)
+        assert compressed["compression"] == "zlib"
+        assert len(compressed_body) < len(body)
+        worker.send_bytes(encode_frame(compressed, compressed_body))
+
+        message, received_body = decode_frame(zlib_client.receive_bytes())
+        assert message["compression"] == "zlib"
+        assert received_body == compressed_body
+        assert unpack_arrays(message, received_body)["root_positions"] == positions
+        message, received_body = decode_frame(plain_client.receive_bytes())
+        assert "compression" not in message
+        assert received_body == body
+
+
+def test_invalid_frames(test_client: TestClient):
+    """Frames whose header does not describe their body are rejected at ingress."""
+    pose = [[0.0, 1.0, 0.0]] * 100
+    request, body = pack_arrays(
+        {"type": "infer", "request_id": "frame", "packed_motion": {"0": pose}}, ["packed_motion"]
+    )
+    compressed, compressed_body = compress_body(request, body, ["zlib"], threshold=0)
+    with test_client.websocket_connect(
+        "/register_worker"
+    ) as worker, test_client.websocket_connect("/register_client") as client:
+        client.send_json({"type": "hello", "encodings": ["binary"]})
+        receive(client, "hello")
+        for header, frame_body in [
+            ({**request, "compression": "bogus"}, body),
+            (compressed, compressed_body),  # zlib was not negotiated
+            (request, body[:-4]),
+            ({**request, "arrays": {"packed_motion": {"shape": "x"}}}, body),
+        ]:
+            client.send_bytes(encode_frame(header, frame_body))
+            error = receive(client, "error")
+            assert error["request_id"] == "frame"
+            assert error["message"].startswith("Invalid message")
+
+        client.send_bytes(encode_frame(request, body))
+        job = receive(worker, "infer")
+        assert job["packed_motion"] == {"0": pose}
+        worker.send_json({"type": "result", "request_id": job["request_id"]})
+        receive(client, "result")
+
+def test_progress(test_client: TestClient):
+    """Progress of a running job is relayed to its client."""
+    with test_client.websocket_connect(
+        "/register_worker"
+    ) as worker, test_client.websocket_connect("/register_client") as client:
+        client.send_json({"type": "infer", "text_prompt": "progress", "request_id": "a"})
+        job = receive(worker, "infer")
+        worker.send_json({
+            "type": "progress",
+            "request_id": job["request_id"],
+            "stage": "sampling",
+            "step": 10,
+            "total": 50,
+            "eta": 2.0,
+        })
+        progress = receive(client, "progress")
+        assert progress["request_id"] == "a"
+        assert progress["step"] == 10
+
+        worker.send_json({"type": "result", "request_id": job["request_id"]})
+        assert receive(client, "result")["request_id"] == "a"
+
+
+def test_cancel(test_client: TestClient):
+    """Queued requests are dropped and running requests are cancelled on the worker."""
+    with test_client.websocket_connect(
+        "/register_worker"
+    ) as worker, test_client.websocket_connect("/register_client") as client:
+        client.send_json({"type": "infer", "text_prompt": "running", "request_id": "a"})
+        running = receive(worker, "infer")
+        client.send_json({"type": "infer", "text_prompt": "queued", "request_id": "b"})
+        receive(client, "queued")
+
+        client.send_json({"type": "cancel", "request_id": "b"})
+        assert receive(client, "cancelled")["request_id"] == "b"
+        client.send_json({"type": "cancel", "request_id": "a"})
+        assert receive(client, "cancelled")["request_id"] == "a"
+        assert receive(worker, "cancel")["request_id"] == running["request_id"]
+        worker.send_json({"type": "cancelled", "request_id": running["request_id"]})
+
+        # The slot is free again and the dropped request never reaches the worker
+        client.send_json({"type": "infer", "text_prompt": "next", "request_id": "c"})
+        assert receive(worker, "infer")["text_prompt"] == "next"
+
+        client.send_json({"type": "cancel", "request_id": "a"})
+        assert receive(client, "error")["request_id"] == "a"
+
+
+def test_priority(test_client: TestClient):
+    """Interactive requests overtake queued batch requests."""
+    with test_client.websocket_connect("/register_client") as client:
+        for name in ("batch0", "batch1"):
+            client.send_json({"type": "infer", "text_prompt": name, "priority": "batch"})
+            receive(client, "queued")
+        client.send_json({"type": "infer", "text_prompt": "interactive"})
+        receive(client, "queued")
+        client.send_json({"type": "infer", "priority": "urgent", "request_id": "x"})
+        assert receive(client, "error")["request_id"] == "x"
+
+        with test_client.websocket_connect("/register_worker") as worker:
+            order = []
+            for _ in range(3):
+                job = receive(worker, "infer")
+                order.append(job["text_prompt"])
+                worker.send_json({"type": "result", "request_id": job["request_id"]})
+            assert order == ["interactive", "batch0", "batch1"]
+
+    stats = test_client.get("/stats").json()
+    assert stats["dispatched_batch"] >= 2
+    assert "queue_wait_seconds_batch" in stats
+
+
+def test_admission_control(test_client: TestClient):
+    """Requests are rejected once the queue is full, queued ones learn their position."""
+    max_queue_depth = worker_manager.max_queue_depth
+    worker_manager.max_queue_depth = 2
+    try:
+        with test_client.websocket_connect("/register_client") as client:
+            for name in ("first", "second"):
+                client.send_json({"type": "infer", "text_prompt": name, "request_id": name})
+            assert receive(client, "queued")["position"] == 0
+            assert receive(client, "queued")["position"] == 1
+
+            client.send_json({"type": "infer", "text_prompt": "third", "request_id": "third"})
+            busy = receive(client, "busy")
+            assert busy["request_id"] == "third"
+            assert busy["retry_after"] >= 1
+
+            with test_client.websocket_connect("/register_worker") as worker:
+                for _ in range(2):
+                    job = receive(worker, "infer")
+                    worker.send_json({"type": "result", "request_id": job["request_id"]})
+                    receive(client, "result")
+    finally:
+        worker_manager.max_queue_depth = max_queue_depth
+
+
+def test_requeue_on_disconnect(test_client: TestClient):
+    """Jobs of a lost worker are retried on another worker until the budget is used up."""
+    max_retries = worker_manager.max_retries
+    worker_manager.max_retries = 1
+    try:
+        with test_client.websocket_connect("/register_client") as client:
+            client.send_json({"type": "infer", "text_prompt": "retry", "request_id": "a"})
+            with test_client.websocket_connect("/register_worker") as worker:
+                job = receive(worker, "infer")
+            with test_client.websocket_connect("/register_worker") as worker:
+                retried = receive(worker, "infer")
+                assert retried["request_id"] == job["request_id"]
+                worker.send_json({"type": "result", "request_id": retried["request_id"]})
+                assert receive(client, "result")["request_id"] == "a"
+
+            client.send_json({"type": "infer", "text_prompt": "fail", "request_id": "b"})
+            for _ in range(2):
+                with test_client.websocket_connect("/register_worker") as worker:
+                    receive(worker, "infer")
+            error = receive(client, "error")
+            assert error["request_id"] == "b"
+            assert "giving up" in error["message"]
+    finally:
+        worker_manager.max_retries = max_retries
+
+
+def test_model_routing(test_client: TestClient):
+    """Requests only reach workers of their model, a busy model does not block another."""
+    with test_client.websocket_connect(
+        "/register_worker"
+    ) as joints_worker, test_client.websocket_connect(
+        "/register_worker"
+    ) as frames_worker, test_client.websocket_connect("/register_client") as client:
+        joints_worker.send_json({
+            "type": "register",
+            "model": "random_joints",
+            "samplers": ["ddpm"],
+            "max_frames": 196,
+            "device": "cpu",
+        })
+        receive(joints_worker, "registered")
+        client.send_json({"type": "infer", "text_prompt": "a", "model": "random_joints"})
+        client.send_json({"type": "infer", "text_prompt": "b", "model": "random_joints"})
+        client.send_json({"type": "infer", "text_prompt": "c"})
+
+        job = receive(joints_worker, "infer")
+        assert job["text_prompt"] == "a"
+        assert "model" not in job
+        frames_job = receive(frames_worker, "infer")
+        assert frames_job["text_prompt"] == "c"
+        joints_worker.send_json({"type": "result", "request_id": job["request_id"]})
+        job = receive(joints_worker, "infer")
+        assert job["text_prompt"] == "b"
+
+        workers = {w["model"]: w for w in test_client.get("/workers").json()}
+        assert workers["random_joints"]["max_frames"] == 196
+        assert workers["random_joints"]["samplers"] == ["ddpm"]
+
+        client.send_json({"type": "infer", "model": "unknown", "request_id": "x"})
+        assert "Unknown model" in receive(client, "error")["message"]
+
+        joints_worker.send_json({"type": "result", "request_id": job["request_id"]})
+        frames_worker.send_json({"type": "result", "request_id": frames_job["request_id"]})
+        for _ in range(2):  # The first result was skipped while waiting for the error
+            receive(client, "result")
+
+
+def test_session_affinity(test_client: TestClient):
+    """Requests of a session go to the same worker while it has a free slot."""
+    with test_client.websocket_connect(
+        "/register_worker"
+    ) as worker_a, test_client.websocket_connect(
+        "/register_worker"
+    ) as worker_b, test_client.websocket_connect("/register_client") as client:
+        workers = {}
+        for worker in (worker_a, worker_b):
+            worker.send_json({"type": "register", "capacity": 2})
+            workers[receive(worker, "registered")["worker_id"]] = worker
+        owner = workers[next(worker_manager.rings["random_frames"].nodes("shot 1"))]
+
+        for i in range(3):
+            client.send_json({"type": "infer", "text_prompt": f"edit {i}", "session": "shot 1"})
+            job = receive(owner, "infer")
+            assert job["text_prompt"] == f"edit {i}"
+            assert "session" not in job
+            owner.send_json({"type": "result", "request_id": job["request_id"]})
+            receive(client, "result")
+
+
+def test_deadlines(test_client: TestClient):
+    """Requests go earliest deadline first and are dropped once their deadline passed."""
+    with test_client.websocket_connect(
+        "/register_worker"
+    ) as worker, test_client.websocket_connect("/register_client") as client:
+        client.send_json({"type": "infer", "text_prompt": "running"})
+        running = receive(worker, "infer")
+        client.send_json({"type": "infer", "text_prompt": "patient", "request_id": "patient"})
+        client.send_json({
+            "type": "infer",
+            "text_prompt": "stale",
+            "request_id": "stale",
+            "max_queue_age": 0.05,
+        })
+        client.send_json({"type": "infer", "deadline": "soon", "request_id": "invalid"})
+        assert "Invalid deadline" in receive(client, "error")["message"]
+        time.sleep(0.1)
+
+        worker.send_json({"type": "result", "request_id": running["request_id"]})
+        assert receive(client, "expired")["request_id"] == "stale"
+        job = receive(worker, "infer")
+        assert job["text_prompt"] == "patient"
+        assert "max_queue_age" not in job
+        worker.send_json({"type": "result", "request_id": job["request_id"]})
+        assert receive(client, "result")["request_id"] == "patient"
+        assert worker_manager.stats["expired"] == 1
+
+
+def test_delta_requests(test_client: TestClient):
+    """Delta requests patch the frames and arguments of a previous request."""
+    pose = [[0.0, 1.0, 0.0], [0.5, 0.5, 0.5]]
+    with test_client.websocket_connect(
+        "/register_worker"
+    ) as worker, test_client.websocket_connect("/register_client") as client:
+        client.send_json({"type": "hello", "encodings": ["binary", "json"]})
+        receive(client, "hello")
+        client.send_json({
+            "type": "infer",
+            "request_id": "base",
+            "text_prompt": "walk",
+            "num_samples": 2,
+            "packed_motion": {"0": pose, "10": pose, "20": pose},
+        })
+        job = receive(worker, "infer")
+        worker.send_json({"type": "result", "request_id": job["request_id"]})
+
+        moved = [[1.0, 1.0, 0.0], [0.5, 0.5, 0.5]]
+        delta, body = pack_arrays(
+            {
+                "type": "infer",
+                "request_id": "delta",
+                "base_request_id": "base",
+                "text_prompt": "run",
+                "packed_motion": {"10": moved, "30": pose},
+                "remove_frames": [20],
+            },
+            ["packed_motion"],
+        )
+        client.send_bytes(encode_frame(delta, body))
+        job = receive(worker, "infer")
+        assert job["text_prompt"] == "run"
+        assert job["num_samples"] == 2
+        assert job["packed_motion"] == {"0": pose, "10": moved, "30": pose}
+        assert "remove_frames" not in job and "base_request_id" not in job
+        worker.send_json({"type": "result", "request_id": job["request_id"]})
+
+        client.send_json({"type": "infer", "request_id": "x", "base_request_id": "unknown"})
+        assert "Unknown base request" in receive(client, "error")["message"]
+
+
+def test_split_requests(test_client: TestClient):
+    """Requests for many samples are split across workers and their results merged in order."""
+    with test_client.websocket_connect(
+        "/register_worker"
+    ) as worker_a, test_client.websocket_connect(
+        "/register_worker"
+    ) as worker_b, test_client.websocket_connect("/register_client") as client:
+        client.send_json({
+            "type": "infer",
+            "text_prompt": "many",
+            "num_samples": 5,
+            "seed": 7,
+            "split": 2,
+            "request_id": "many",
+        })
+        indices = {derive_seed(7, index): index for index in range(3)}
+        for worker in (worker_a, worker_b, worker_a):
+            part = receive(worker, "infer")
+            assert "split" not in part
+            index = indices.pop(part["seed"])
+            assert part["num_samples"] == (1 if index == 2 else 2)
+            samples = [[[index, sample, 0.0]] for sample in range(part["num_samples"])]
+            worker.send_json({
+                "type": "result",
+                "request_id": part["request_id"],
+                "root_positions": samples,
+            })
+
+        result = receive(client, "result")
+        assert result["request_id"] == "many"
+        # The samples of the parts are merged in the order of the parts
+        assert [sample[0][:2] for sample in result["root_positions"]] == [
+            [0, 0], [0, 1], [1, 0], [1, 1], [2, 0]
+        ]
+
+
+def test_sweeps(test_client: TestClient):
+    """Sweeps run a request per grid point, stream their results and are cancelled as a whole."""
+    with test_client.websocket_connect(
+        "/register_worker"
+    ) as worker, test_client.websocket_connect("/register_client") as client:
+        client.send_json({
+            "type": "sweep",
+            "request_id": "sweep",
+            "text_prompt": "walk",
+            "grid": {"editable_features": ["pos", "pos_rot"], "seed": [1, 2]},
+        })
+        points = receive(client, "sweep")["points"]
+        assert [p["request_id"] for p in points] == [f"sweep/{i}" for i in range(4)]
+        assert points[1]["params"] == {"editable_features": "pos", "seed": 2}
+
+        for _ in points:
+            job = receive(worker, "infer")
+            assert job["text_prompt"] == "walk"
+            assert "grid" not in job and "priority" not in job
+            worker.send_json({"type": "result", "request_id": job["request_id"], "seed": job["seed"]})
+        results = {r["request_id"]: r["seed"] for r in (receive(client, "result") for _ in points)}
+        assert results == {p["request_id"]: p["params"]["seed"] for p in points}
+
+        client.send_json({"type": "sweep", "request_id": "big", "grid": {"seed": [1, 2]}})
+        receive(worker, "infer")
+        client.send_json({"type": "cancel", "request_id": "big"})
+        assert receive(client, "cancelled")["request_id"] == "big"
+        receive(worker, "cancel")
+
+        client.send_json({"type": "sweep", "request_id": "empty", "grid": {"seed": []}})
+        assert "Invalid sweep grid" in receive(client, "error")["message"]
+
+
+def test_large_messages_off_event_loop(test_client: TestClient, monkeypatch):
+    """Large messages are decoded and hashed on threads, small ones on the event loop."""
+    monkeypatch.setattr(main, "LARGE_MESSAGE_BYTES", 4096)
+    offloaded = main.metrics.OFFLOADED_CALLS
+    offloaded.clear()
+    pose = [[0.1, 0.2, 0.3]] * 23
+    with test_client.websocket_connect(
+        "/register_worker"
+    ) as worker, test_client.websocket_connect("/register_client") as client:
+        client.send_json({"type": "infer", "request_id": "small", "text_prompt": "walk"})
+        job = receive(worker, "infer")
+        worker.send_json({"type": "result", "request_id": job["request_id"]})
+        receive(client, "result")
+        assert offloaded.values == {}
+
+        motion = {str(frame): pose for frame in range(0, 100, 5)}
+        client.send_json({"type": "infer", "request_id": "large", "packed_motion": motion})
+        job = receive(worker, "infer")
+        assert job["packed_motion"] == motion
+        worker.send_json({"type": "result", "request_id": job["request_id"]})
+        receive(client, "result")
+        assert offloaded.values == {("parse_message",): 1, ("request_hash",): 1}
+
+    assert loads('{"a": [1.5, NaN]}')["a"][0] == 1.5  # Falls back to the json module
+
+
+class StalledWebSocket:
+    """WebSocket of a client on a slow link, sends only complete once released."""
+
+    def __init__(self):
+        self.released = asyncio.Event()
+        self.sent = []
+        self.close_code = None
+
+    async def send_text(self, data: str):
+        await self.released.wait()
+        self.sent.append(json.loads(data))
+
+    async def close(self, code: int = 1000):
+        self.close_code = code
+
+
+def test_outbox_isolates_slow_clients(monkeypatch):
+    """Sends to a stalled client return right away and overflows follow the policy."""
+    monkeypatch.setattr(main, "OUTBOX_SIZE", 2)
+
+    async def run():
+        websocket = StalledWebSocket()
+        client = Connection(websocket)
+        client.start()
+        assert await client.send({"type": "result", "request_id": "a"})
+        await asyncio.sleep(0)  # The writer is stuck on the first message
+        assert await client.send({"type": "result", "request_id": "b"})
+        assert await client.send({"type": "progress", "request_id": "c"})
+        # The outbox is full, progress updates are shed
+        assert not await client.send({"type": "progress", "request_id": "d"})
+        assert websocket.close_code is None
+
+        websocket.released.set()
+        await asyncio.sleep(0.01)
+        assert [m["request_id"] for m in websocket.sent] == ["a", "b", "c"]
+
+        websocket.released.clear()
+        for request_id in "efg":
+            await client.send({"type": "result", "request_id": request_id})
+        # Results can not be shed, the client is disconnected instead
+        assert not await client.send({"type": "result", "request_id": "h"})
+        assert websocket.close_code == 1013
+        assert not await client.send({"type": "result", "request_id": "i"})
+
+    asyncio.run(run())
+
+
+class RecordingWebSocket:
+    """WebSocket of a JSON-only peer that records the sent messages."""
+
+    def __init__(self):
+        self.sent = []
+
+    async def send_text(self, data: str):
+        self.sent.append(json.loads(data))
+
+    async def close(self, code: int = 1000):
+        pass
+
+
+def test_writer_survives_unencodable_messages():
+    """A message the writer can not encode fails its own request, the outbox keeps draining."""
+    unencodable = {"type": "result", "compression": "bogus", "arrays": {"x": {"shape": [2]}}}
+
+    async def run():
+        websocket = RecordingWebSocket()
+        client = Connection(websocket)
+        client.start()
+        await client.send({**unencodable, "request_id": "bad"}, bytes(8))
+        await client.send({"type": "result", "request_id": "ok"})
+        await asyncio.sleep(0.01)
+        assert [(m["type"], m["request_id"]) for m in websocket.sent] == [
+            ("error", "bad"),
+            ("result", "ok"),
+        ]
+        assert not client.closed
+
+        # Jobs whose message can not be written to their worker fail back to the client
+        manager = WorkerManager()
+        worker = await manager.register(RecordingWebSocket())
+        job = Job({}, subscribers=[Subscriber(client, "job")])
+        job.worker = worker
+        job.dispatched_at = time.monotonic()
+        worker.in_flight[job.id] = job
+        await worker.send({**unencodable, "type": "infer", "request_id": job.id}, bytes(8))
+        await asyncio.sleep(0.01)
+        assert worker.in_flight == {}
+        assert websocket.sent[-1]["type"] == "error"
+        assert websocket.sent[-1]["request_id"] == "job"
+        assert not worker.closed
+        await worker.close()
+        await client.close()
+
+    asyncio.run(run())
+
+
+def test_jobs_api(test_client: TestClient):
+    """Jobs submitted over HTTP are polled and their spooled results downloaded."""
+    response = test_client.post(
+        "/jobs", json=[{"text_prompt": "http a"}, {"text_prompt": "http b", "priority": "x"}]
+    )
+    assert response.status_code == 202
+    job, invalid = response.json()["jobs"]
+    assert test_client.get(f"/jobs/{job['id']}").json()["status"] == "queued"
+    assert test_client.get(f"/jobs/{invalid['id']}").json()["status"] == "failed"
+    assert test_client.get(f"/jobs/{job['id']}/result").status_code == 409
+
+    with test_client.websocket_connect("/register_worker") as worker:
+        worker.send_json({"type": "register", "encodings": ["binary", "json"]})
+        message = receive(worker, "infer")
+        assert test_client.get(f"/jobs/{job['id']}").json()["status"] == "running"
+        result, body = pack_arrays(
+            {"type": "result", "root_positions": [[1.0, 2.0]], "request_id": message["request_id"]},
+            ["root_positions"],
+        )
+        worker.send_bytes(encode_frame(result, body))
+        for _ in range(100):  # Poll like a batch client
+            if test_client.get(f"/jobs/{job['id']}").json()["status"] == "done":
+                break
+            time.sleep(0.05)
+
+    assert test_client.get(f"/jobs/{job['id']}/result").json()["root_positions"] == [[1.0, 2.0]]
+    frame = test_client.get(f"/jobs/{job['id']}/result", params={"format": "binary"}).content
+    assert unpack_arrays(*decode_frame(frame))["root_positions"] == [[1.0, 2.0]]
+    assert test_client.get("/jobs/unknown").status_code == 404
+
+
+def test_metrics(test_client: TestClient):
+    """The metrics endpoint reports queue, worker, latency and payload metrics."""
+    with test_client.websocket_connect(
+        "/register_worker"
+    ) as worker, test_client.websocket_connect("/register_client") as client:
+        client.send_json({"type": "infer", "text_prompt": "metrics"})
+        job = receive(worker, "infer")
+        worker.send_json({"type": "result", "root_positions": [1], "request_id": job["request_id"]})
+        receive(client, "result")
+
+        response = test_client.get("/metrics")
+        assert response.status_code == 200
+        assert "text/plain" in response.headers["content-type"]
+        text = response.text
+        assert 'molab_queue_depth{model="random_frames",priority="interactive"} 0' in text
+        assert "molab_connected_workers 1" in text
+        assert "molab_worker_busy_ratio{worker=" in text
+        assert 'molab_queue_wait_seconds_bucket{priority="interactive",le="+Inf"}' in text
+        assert 'molab_request_latency_seconds_count{outcome="result"}' in text
+        assert 'molab_payload_bytes_count{peer="worker",direction="in",encoding="json"}' in text
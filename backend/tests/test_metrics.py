@@ -0,0 +1,26 @@
+from molab_backend.metrics import Counter, Histogram, Registry
+
+
+def test_render():
+    registry = Registry()
+    requests = registry.register(Counter("requests_total", "Requests.", ("outcome",)))
+    latency = registry.register(Histogram("latency_seconds", "Latency.", buckets=(1, 5)))
+    requests.inc(outcome="result")
+    requests.inc(2, outcome='say "hi"')
+    latency.observe(1)
+    latency.observe(3)
+    latency.observe(7)
+
+    assert registry.render().splitlines() == [
+        "# HELP requests_total Requests.",
+        "# TYPE requests_total counter",
+        'requests_total{outcome="result"} 1',
+        'requests_total{outcome="say \\"hi\\""} 2',
+        "# HELP latency_seconds Latency.",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{le="1"} 1',
+        'latency_seconds_bucket{le="5"} 2',
+        'latency_seconds_bucket{le="+Inf"} 3',
+        "latency_seconds_sum 11",
+        "latency_seconds_count 3",
+    ]
@@ -0,0 +1,73 @@
+import asyncio
+
+from molab_backend.scheduling import HashRing, RequestQueue
+
+
+def test_priorities_and_fairness():
+    async def run():
+        queue = RequestQueue()
+        for i in range(4):
+            await queue.put(f"heavy{i}", "heavy", "batch")
+        await queue.put("light0", "light", "batch")
+        await queue.put("light1", "light", "batch")
+        await queue.put("interactive", "light", "interactive")
+
+        order = [(await queue.get())[0] for _ in range(len(queue))]
+        # Interactive first, then the light client is not stuck behind the heavy one
+        assert order == ["interactive", "heavy0", "light0", "heavy1", "light1", "heavy2", "heavy3"]
+
+    asyncio.run(run())
+
+
+def test_weights_and_promotion():
+    async def run():
+        queue = RequestQueue()
+        items = {}
+        for i in range(3):
+            items[f"a{i}"] = {"name": f"a{i}"}
+            items[f"b{i}"] = {"name": f"b{i}"}
+            await queue.put(items[f"a{i}"], "a", "batch", weight=2.0)
+            await queue.put(items[f"b{i}"], "b", "batch")
+        assert queue.promote(items["b2"], "b", "interactive")
+        assert not queue.promote(items["b2"], "b", "batch")
+
+        order = [(await queue.get()) for _ in range(len(queue))]
+        assert order[0] == (items["b2"], "interactive")
+        # The flow with twice the weight is served twice as often
+        assert [item["name"] for item, _ in order[1:]] == ["a0", "b0", "a1", "a2", "b1"]
+
+    asyncio.run(run())
+
+
+def test_hash_ring():
+    ring = HashRing()
+    for node in ("a", "b", "c"):
+        ring.add(node)
+    ring.add("a")
+    assert len(ring) == 3
+    assert sorted(ring.nodes("shot")) == ["a", "b", "c"]
+
+    owners = {f"shot{i}": next(ring.nodes(f"shot{i}")) for i in range(300)}
+    assert set(owners.values()) == {"a", "b", "c"}
+    ring.remove("b")
+    ring.add("d")
+    moved = {key for key, owner in owners.items() if next(ring.nodes(key)) != owner}
+    # Only the sessions of the leaving node and those taken by the new node move
+    assert {key for key, owner in owners.items() if owner == "b"} <= moved
+    assert all(next(ring.nodes(key)) == "d" for key in moved if owners[key] != "b")
+
+
+def test_deadlines():
+    async def run():
+        queue = RequestQueue()
+        await queue.put("no deadline", "a", "batch")
+        await queue.put("late", "a", "batch", deadline=200.0)
+        await queue.put("early", "b", "batch", deadline=100.0)
+        await queue.put("interactive", "b", "interactive")
+        await queue.requeue("retry", "batch")
+
+        order = [(await queue.get())[0] for _ in range(len(queue))]
+        # Earliest deadline first within a class, after retries
+        assert order == ["interactive", "retry", "early", "late", "no deadline"]
+
+    asyncio.run(run())
@@ -0,0 +1,38 @@
+import asyncio
+import os
+
+from molab_backend.spool import JobSpool
+
+
+def test_status_and_restart(tmp_path):
+    async def run():
+        spool = JobSpool(tmp_path, ttl=60)
+        spool.create("a")
+        spool.update("a", status="running", progress={"stage": "sampling"})
+        await spool.store("a", b"frame")
+        spool.update("a", status="failed")  # Final states are kept
+        assert spool.get("a")["status"] == "done"
+        assert spool.result_path("a").read_bytes() == b"frame"
+
+        # Finished jobs are still known after a restart
+        restarted = JobSpool(tmp_path, ttl=60)
+        assert restarted.get("a")["status"] == "done"
+        assert restarted.get("b") is None
+        assert restarted.get("../a") is None
+
+    asyncio.run(run())
+
+
+def test_prune(tmp_path):
+    async def run():
+        spool = JobSpool(tmp_path, ttl=60)
+        spool.create("a")
+        await spool.store("a", b"frame")
+        spool.create("b")
+        spool.records["a"]["updated_at"] -= 120
+        os.utime(spool.result_path("a"), (0, 0))
+        spool.prune()
+        assert spool.get("a") is None
+        assert spool.get("b")["status"] == "queued"  # Unfinished jobs are kept
+
+    asyncio.run(run())
@@ -0,0 +1,66 @@
+import asyncio
+import json
+from dataclasses import dataclass
+
+from molab_backend.sqlite_queue import SQLiteQueue
+
+
+@dataclass
+class Item:
+    id: str
+    remote: bool = False
+
+
+def open_queue(path, owner):
+    return SQLiteQueue(
+        path,
+        "random_frames",
+        owner,
+        encode=lambda item: json.dumps(item.id).encode(),
+        decode=lambda data: Item(json.loads(data), remote=True),
+    )
+
+
+def test_priorities_and_fairness(tmp_path):
+    async def run():
+        queue = open_queue(tmp_path / "queue.db", "a")
+        for i in range(3):
+            await queue.put(Item(f"heavy{i}"), "heavy", "batch")
+        await queue.put(Item("light0"), "light", "batch")
+        await queue.put(Item("interactive"), "light", "interactive")
+        await queue.put(Item("deadline"), "light", "batch", deadline=100.0)
+        assert queue.counts() == {"interactive": 1, "batch": 5}
+        assert [item.id for _, item in queue.positions()][:2] == ["interactive", "deadline"]
+
+        order = [(await queue.get())[0].id for _ in range(len(queue))]
+        assert order == ["interactive", "deadline", "heavy0", "light0", "heavy1", "heavy2"]
+
+    asyncio.run(run())
+
+
+def test_shared_between_gateways(tmp_path):
+    async def run():
+        gateway_a = open_queue(tmp_path / "queue.db", "a")
+        gateway_b = open_queue(tmp_path / "queue.db", "b")
+        first, second, cancelled = Item("first"), Item("second"), Item("cancelled")
+        await gateway_a.put(first, "client")
+        await gateway_a.put(second, "client")
+        await gateway_a.put(cancelled, "client")
+        assert len(gateway_b) == 3
+
+        # Gateway B runs a job of gateway A and passes the result back
+        remote, _ = await gateway_b.get()
+        assert remote == Item("first", remote=True)
+        await gateway_b.finish(remote, b"result")
+        assert await gateway_a.collect() == [(first, b"result")]
+        assert await gateway_a.collect() == []
+
+        # Retried jobs keep their owner and are taken first
+        remote, _ = await gateway_b.get()
+        await gateway_b.requeue(remote)
+        assert gateway_a.remove(cancelled)
+        local, _ = await gateway_a.get()
+        assert local is second
+        assert len(gateway_a) == 0
+
+    asyncio.run(run())
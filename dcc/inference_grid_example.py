@@ -6,7 +6,7 @@
 3. Run the script
 """
 
-import itertools
+import math
 from pprint import pprint
 
 from molab_maya import motion_io
@@ -14,91 +14,85 @@ from molab_maya.qclient import MoLabQClient
 
 # Global tracking variables
 client = MoLabQClient("ws://localhost:8000")
-current_inference = 0
+finished_inferences = 0
 total_inferences = 0
-waiting_for_result = False
-grid_keys = []
-parameter_combinations = []
+pending_requests = {}  # Maps request IDs to the index of their parameter combination
+sweep_request_id = None
 skeleton_group = None
-packed_motion = None
+
+
+def on_sweep_received(request_id, points):
+    if request_id != sweep_request_id:
+        return
+    for index, point in enumerate(points):
+        print(
+            f"\n========== Inference [{index + 1}/{total_inferences}] =========="
+        )
+        pprint(point["params"], depth=2)
+    print("================================================")
 
 
 def on_inference_finished(result):
-    global waiting_for_result
+    global finished_inferences
+
+    index = pending_requests.pop(result.get("request_id"), None)
+    if index is None:
+        return
+    finished_inferences += 1
 
     print(
-        f"Inference {current_inference}/{total_inferences} finished. Importing the results..."
+        f"Inference {index + 1} finished ({finished_inferences}/{total_inferences}). Importing the results..."
     )
     motion_io.import_motions(
         skeleton_group,
         result["root_positions"],
         result["joint_rotations"],
         start_frame=0,
-        name=f"sample{current_inference}",
+        name=f"sample{index + 1}",
     )
 
-    # Mark this inference as complete
-    waiting_for_result = False
-
-    # Move to the next inference or close if done
-    process_next_inference()
-
-
-def process_next_inference():
-    global current_inference, waiting_for_result
-
-    # Check if we've processed all inferences
-    if current_inference >= total_inferences:
+    # Close once all inferences are done
+    if not pending_requests:
         print("All inferences completed. Closing client...")
         client.close()
-        return
-
-    # Get the next set of parameters
-    params = parameter_combinations[current_inference]
-    data = dict(zip(grid_keys, params))
-    if packed_motion and "packed_motion" in data:
-        data["packed_motion"] = packed_motion
 
-    print(
-        f"\n========== Starting Inference [{current_inference + 1}/{total_inferences}] =========="
-    )
-    pprint(data, depth=2)
-    print("================================================")
 
-    # Send the inference request
-    client.infer(data)
-
-    # Mark that we're waiting for this inference to complete
-    waiting_for_result = True
-    current_inference += 1
-    print("Waiting for inference result...")
+def on_inference_failed(request_id, message):
+    if request_id == sweep_request_id:
+        print(f"Sweep failed: {message}")
+        pending_requests.clear()
+    elif request_id in pending_requests:
+        print(f"Inference {pending_requests.pop(request_id) + 1} failed: {message}")
+    if not pending_requests:
+        client.close()
 
 
-def infer_by_grid_search(grid: dict[str, list], insert_packed_motion=None):
+def infer_by_grid_search(grid: dict[str, list], base_args: dict):
     """Takes a dictionary of lists. Each list is a parameter to search over.
     The search/test space is the cartesian product of all the lists.
+    The whole grid is sent as a single sweep, the backend runs the combinations
+    in parallel and reuses the preprocessed keyframes between them.
     """
-    global total_inferences, parameter_combinations, grid_keys, packed_motion
+    global total_inferences, sweep_request_id
 
-    grid_keys = list(grid.keys())
-    packed_motion = insert_packed_motion
+    total_inferences = math.prod(len(values) for values in grid.values())
 
-    # Generate all parameter combinations
-    parameter_combinations = list(itertools.product(*grid.values()))
-    total_inferences = len(parameter_combinations)
+    print(f"Running parallel inference on {total_inferences} parameter combinations.")
+    print(f"This will take approx. {total_inferences * 2} minutes on Apple M3, divided by the number of workers.")
 
-    print(f"Running sequential inference on {total_inferences} parameter combinations.")
-    print(f"This will take approx. {total_inferences * 2} minutes on Apple M3.")
-
-    # Start the first inference
-    process_next_inference()
+    # Sweeps run as batch requests, so interactive users are served first
+    sweep_request_id = client.sweep(base_args, grid)
+    # The requests of the combinations are numbered "<sweep request ID>/<index>"
+    pending_requests.update(
+        {f"{sweep_request_id}/{index}": index for index in range(total_inferences)}
+    )
+    print("Waiting for inference results...")
 
 
 try:
     # Initialize the client globally
     client.open()
-    current_inference = 0
-    waiting_for_result = False
+    finished_inferences = 0
 
     # Extracting the keyframes for the skeleton under the selected hip bone
     joints = motion_io.get_selected_skeleton_joints()
@@ -107,7 +101,6 @@ try:
 
     # Usage with packed_motion
     packed_motion_test_grid = {
-        "packed_motion": [None],
         "num_samples": [1],
         "foot_ik": [False],
         "jacobian_ik": [False],
@@ -116,9 +109,11 @@ try:
         "unpack_randomness": [0.0],
     }
 
+    client.sweep_received.connect(on_sweep_received)
     client.inference_received.connect(on_inference_finished)
+    client.error_received.connect(on_inference_failed)
     client.connected.connect(
-        lambda: infer_by_grid_search(packed_motion_test_grid, packed_motion)
+        lambda: infer_by_grid_search(packed_motion_test_grid, {"packed_motion": packed_motion})
     )
 
     # Client will be closed when all inferences complete
@@ -0,0 +1,261 @@
+"""Binary framing of the gateway protocol, mirrors `molab_backend.protocol`.
+
+A binary frame consists of the 4-byte magic `MOLB`, the length of the JSON header
+as unsigned 32-bit little-endian integer, the UTF-8 encoded JSON header and the
+body holding the little-endian float32 arrays listed in the `arrays` header field.
+Large bodies can be byte shuffled and compressed with a negotiated compression
+named in the `compression` header field.
+Only the standard library is used, so it runs in any DCC interpreter.
+"""
+
+import json
+import struct
+import sys
+import zlib
+from array import array
+from typing import Any
+
+MAGIC = b"MOLB"
+HEADER_LENGTH = struct.Struct("<I")
+ENCODINGS = ["binary", "json"]
+# Supported body compressions, zstd is not in the standard library
+COMPRESSIONS = ["zlib"]
+# Bodies smaller than this are sent uncompressed, in bytes
+COMPRESSION_THRESHOLD = 16 * 2**10
+
+
+def encode_frame(message: dict, body: bytes = b"") -> bytes:
+    """
+    Encode a message and its body as binary frame.
+
+    Args:
+        message (dict): The message header.
+        body (bytes): The concatenated array buffers described by the header.
+
+    Returns:
+        bytes: The binary frame.
+    """
+    header = json.dumps(message, separators=(",", ":")).encode()
+    return b"".join((MAGIC, HEADER_LENGTH.pack(len(header)), header, body))
+
+
+def decode_frame(data: bytes) -> tuple[dict, bytes]:
+    """
+    Split a binary frame into its message header and body without decoding the body.
+
+    Args:
+        data (bytes): The binary frame.
+
+    Returns:
+        tuple[dict, bytes]: The message header and the body.
+
+    Raises:
+        ValueError: If the data is not a valid frame.
+    """
+    if data[:4] != MAGIC or len(data) < 4 + HEADER_LENGTH.size:
+        raise ValueError("Not a MoLab frame")
+    (header_length,) = HEADER_LENGTH.unpack_from(data, 4)
+    start = 4 + HEADER_LENGTH.size
+    message = json.loads(data[start : start + header_length])
+    if not isinstance(message, dict):
+        raise ValueError("Frame header is not a JSON object")  # noqa: TRY004
+    return message, data[start + header_length :]
+
+
+def _shape(value: Any) -> list[int]:
+    shape = []
+    while isinstance(value, (list, tuple)):
+        shape.append(len(value))
+        value = value[0] if value else None
+    return shape
+
+
+def _flatten(value: Any, depth: int):
+    if depth == 0:
+        yield value
+        return
+    for item in value:
+        yield from _flatten(item, depth - 1)
+
+
+def _unflatten(values: list, shape: list[int]) -> list:
+    for size in reversed(shape[1:]):
+        values = [values[i : i + size] for i in range(0, len(values), size)]
+    return values
+
+
+def pack_arrays(message: dict, names: list[str]) -> tuple[dict, bytes]:
+    """
+    Move the nested lists of numbers in the given fields into a float32 body.
+
+    Fields that are missing or not rectangular stay in the header.
+    The message must not contain packed arrays yet.
+
+    Args:
+        message (dict): The message with nested lists, e.g. an `InferenceResults` dump.
+        names (list[str]): The fields to move into the body.
+
+    Returns:
+        tuple[dict, bytes]: The message header and the body.
+    """
+    message = dict(message)
+    arrays = {}
+    buffers = []
+    for name in names:
+        value = message.get(name)
+        descriptor = {}
+        if isinstance(value, dict):
+            descriptor["keys"] = list(value.keys())
+            value = list(value.values())
+        if not isinstance(value, list):
+            continue
+        shape = _shape(value)
+        try:
+            buffer = array("f", _flatten(value, len(shape)))
+        except (TypeError, OverflowError):
+            continue  # Not numeric, keep it as JSON
+        expected = 1
+        for size in shape:
+            expected *= size
+        if len(buffer) != expected:
+            continue  # Ragged, keep it as JSON
+        if sys.byteorder == "big":
+            buffer.byteswap()
+        arrays[name] = {**descriptor, "shape": shape, "dtype": "<f4"}
+        buffers.append(buffer.tobytes())
+        del message[name]
+    if arrays:
+        message["arrays"] = arrays
+    return message, b"".join(buffers)
+
+
+def unpack_arrays(message: dict, body: bytes) -> dict:
+    """
+    Decode the float32 body of a message back into nested lists in the header.
+
+    Args:
+        message (dict): The message header with its `arrays` descriptors.
+        body (bytes): The body of the frame, possibly compressed.
+
+    Returns:
+        dict: The message with all arrays as nested lists, ready for JSON.
+    """
+    message, body = decompress_body(message, body)
+    message = dict(message)
+    offset = 0
+    for name, descriptor in message.pop("arrays", {}).items():
+        count = 1
+        for size in descriptor["shape"]:
+            count *= size
+        buffer = array("f")
+        buffer.frombytes(body[offset : offset + 4 * count])
+        offset += 4 * count
+        if sys.byteorder == "big":
+            buffer.byteswap()
+        value = _unflatten(buffer.tolist(), descriptor["shape"])
+        if "keys" in descriptor:
+            value = dict(zip(descriptor["keys"], value))
+        message[name] = value
+    return message
+
+
+def _shuffle(body: bytes) -> bytes:
+    """Group the bytes of the float32 values by their position within the value."""
+    return b"".join(body[i::4] for i in range(4))
+
+
+def _unshuffle(data: bytes) -> bytes:
+    size = len(data) // 4
+    body = bytearray(len(data))
+    for i in range(4):
+        body[i::4] = data[i * size : (i + 1) * size]
+    return bytes(body)
+
+
+def compress_body(
+    message: dict,
+    body: bytes,
+    compressions: list,
+    threshold: int = COMPRESSION_THRESHOLD,
+) -> tuple[dict, bytes]:
+    """
+    Compress the body of a message with the first supported compression.
+
+    Bodies below the threshold, bodies that are already compressed and bodies
+    that do not get smaller are left as they are.
+
+    Args:
+        message (dict): The message header.
+        body (bytes): The float32 body.
+        compressions (list): The compressions negotiated with the receiver, preferred first.
+        threshold (int): The minimum size of the body to compress, in bytes.
+
+    Returns:
+        tuple[dict, bytes]: The message header, naming the `compression` if
+            applied, and the body.
+    """
+    if "compression" in message or len(body) < threshold or len(body) % 4:
+        return message, body
+    compression = next((c for c in compressions if c in COMPRESSIONS), None)
+    if compression is None:
+        return message, body
+    data = zlib.compress(_shuffle(body), 6)
+    if len(data) >= len(body):
+        return message, body
+    return {**message, "compression": compression}, data
+
+
+def decompress_body(message: dict, body: bytes) -> tuple[dict, bytes]:
+    """
+    Undo `compress_body`.
+
+    Args:
+        message (dict): The message header.
+        body (bytes): The body, compressed if the header names a `compression`.
+
+    Returns:
+        tuple[dict, bytes]: The message header without `compression` and the
+            uncompressed body.
+
+    Raises:
+        ValueError: If the compression is not supported.
+    """
+    compression = message.get("compression")
+    if compression is None:
+        return message, body
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unsupported compression {compression!r}")
+    data = zlib.decompress(body)
+    message = {k: v for k, v in message.items() if k != "compression"}
+    return message, _unshuffle(data)
+
+
+def make_patch(base: dict, message: dict, name: str = "packed_motion") -> dict:
+    """
+    Describe a request as delta of a previous one, see `molab_backend.protocol.patch_request`.
+
+    Args:
+        base (dict): The previous request.
+        message (dict): The new request.
+        name (str): The field holding the mapping of frames to poses.
+
+    Returns:
+        dict: The changed fields of the new request, the changed or added frames
+            under `name` and the keys of the removed frames under `remove_frames`.
+    """
+    patch = {k: v for k, v in message.items() if k != name and _dumps(base.get(k)) != _dumps(v)}
+    patch.update((k, None) for k in base if k not in message and k != name)
+    base_frames = {str(k): v for k, v in base.get(name, {}).items()}
+    frames = {str(k): v for k, v in message.get(name, {}).items()}
+    # Compared as JSON, so poses with NaN for missing values are equal
+    patch[name] = {
+        k: v for k, v in frames.items() if k not in base_frames or _dumps(base_frames[k]) != _dumps(v)
+    }
+    removed = [k for k in base_frames if k not in frames]
+    if removed:
+        patch["remove_frames"] = removed
+    return patch
+
+
+def _dumps(value: Any) -> str:
+    return json.dumps(value, sort_keys=True)
@@ -1,25 +1,60 @@
-from qtpy.QtCore import QObject, QUrl, Signal
+from qtpy.QtCore import QByteArray, QObject, QUrl, Signal
 from qtpy.QtWebSockets import QWebSocket
 from qtpy.QtNetwork import QAbstractSocket
 
+import copy
 import json
 import os
+import uuid
+from collections import OrderedDict
+
+from .protocol import (
+    COMPRESSIONS,
+    ENCODINGS,
+    compress_body,
+    decode_frame,
+    encode_frame,
+    make_patch,
+    pack_arrays,
+    unpack_arrays,
+)
+
+
+# Number of recent requests kept as bases for delta requests, like the backend does
+REQUEST_HISTORY = 16
 
 
 class MoLabQClient(QObject):
     """
     A client for interacting with the MoLab backend for motion inference using Qt's QWebSocket.
+
+    Every request carries a `request_id` that the backend echoes on all responses,
+    so several requests can be in flight at once and their results arrive out of order.
+
+    Unless disabled, the client asks the backend for binary frames on connect, which
+    carry motions as float32 arrays instead of JSON numbers. Large motions are
+    compressed with zlib if the backend supports it.
+
+    A request can be sent as delta of one of the latest requests, so only the
+    changed keyframes and arguments are uploaded.
+
+    A parameter sweep is sent as a single request, the backend expands it into
+    one request per combination and streams their results as they complete.
     """
     inference_received = Signal(dict)
+    error_received = Signal(str, str)
+    progress_received = Signal(str, dict)
+    sweep_received = Signal(str, list)
     connected = Signal()
     disconnected = Signal()
 
-    def __init__(self, backend_uri=""):
+    def __init__(self, backend_uri="", binary=True):
         """
         Initializes the MoLabQClient with the given backend URI.
 
         Args:
             backend_uri (str): The URI of the MoLab backend server.
+            binary (bool): Whether to negotiate binary frames with the backend.
         """
         super().__init__()
         if backend_uri:
@@ -28,10 +63,15 @@ class MoLabQClient(QObject):
             host = os.getenv("MOLAB_GATEWAY_HOST", "localhost")
             port = os.getenv("MOLAB_GATEWAY_PORT", "8000")
             self.backend_uri = f"ws://{host}:{port}"
+        self.request_binary = binary
+        self.binary = False
+        self.compression = []
+        self.history = OrderedDict()
         self.websocket = QWebSocket()
         self.websocket.disconnected.connect(self.disconnected.emit)
-        self.websocket.connected.connect(self.connected.emit)
+        self.websocket.connected.connect(self.on_connected)
         self.websocket.textMessageReceived.connect(self.on_message_received)
+        self.websocket.binaryMessageReceived.connect(self.on_binary_message_received)
 
     def open(self):
         """
@@ -47,28 +87,150 @@ class MoLabQClient(QObject):
         print("Closing ...")
         self.websocket.close()
 
-    def infer(self, inference_args):
+    def infer(self, inference_args, base_request_id=None):
         """
         Sends an inference request to the backend.
 
         Args:
-            inference_args (dict): The data to be sent for inference.
+            inference_args (dict): The data to be sent for inference, optionally
+                containing a custom `request_id`.
+            base_request_id (str): The ID of a previous request of this connection,
+                only the differences to it are sent.
+
+        Returns:
+            str: The request ID, also contained in the `inference_received` result.
         """
         print("Sending inference request ...")
         inference_args["type"] = "infer"
-        self.websocket.sendTextMessage(json.dumps(inference_args))
+        inference_args.setdefault("request_id", str(uuid.uuid4()))
+        message = inference_args
+        base = self.history.get(base_request_id)
+        if base is not None:
+            message = make_patch(base, inference_args)
+            message["request_id"] = inference_args["request_id"]
+            message["base_request_id"] = base_request_id
+        self.history[inference_args["request_id"]] = copy.deepcopy(inference_args)
+        while len(self.history) > REQUEST_HISTORY:
+            self.history.popitem(last=False)
+
+        if self.binary:
+            header, body = compress_body(
+                *pack_arrays(message, ["packed_motion"]), self.compression
+            )
+            if body:
+                self.websocket.sendBinaryMessage(QByteArray(encode_frame(header, body)))
+                return inference_args["request_id"]
+        self.websocket.sendTextMessage(json.dumps(message))
+        return inference_args["request_id"]
+
+    def sweep(self, inference_args, grid):
+        """
+        Sends a parameter sweep to the backend.
+
+        Args:
+            inference_args (dict): The data shared by all combinations, optionally
+                containing a custom `request_id`.
+            grid (dict[str, list]): The values of every swept argument, the
+                combinations are their cartesian product.
+
+        Returns:
+            str: The request ID of the sweep. The `sweep_received` signal lists the
+                request ID and arguments of every combination, which are also
+                contained in the `inference_received` results.
+        """
+        print("Sending sweep request ...")
+        message = {**inference_args, "type": "sweep", "grid": grid}
+        message.setdefault("request_id", str(uuid.uuid4()))
+
+        if self.binary:
+            header, body = compress_body(
+                *pack_arrays(message, ["packed_motion"]), self.compression
+            )
+            if body:
+                self.websocket.sendBinaryMessage(QByteArray(encode_frame(header, body)))
+                return message["request_id"]
+        self.websocket.sendTextMessage(json.dumps(message))
+        return message["request_id"]
+
+    def cancel(self, request_id):
+        """
+        Cancels a queued or running inference request.
+
+        Args:
+            request_id (str): The request ID returned by `infer`.
+        """
+        print(f"Cancelling request {request_id} ...")
+        self.websocket.sendTextMessage(json.dumps({"type": "cancel", "request_id": request_id}))
 
     def is_connected(self):
         return self.websocket.state() == QAbstractSocket.SocketState.ConnectedState
 
+    def on_connected(self):
+        """
+        Slot called when the WebSocket is connected, negotiates binary frames.
+        """
+        self.binary = False
+        self.compression = []
+        self.history.clear()  # The backend forgot them as well
+        if self.request_binary:
+            self.websocket.sendTextMessage(
+                json.dumps({"type": "hello", "encodings": ENCODINGS, "compression": COMPRESSIONS})
+            )
+        self.connected.emit()
+
+    def on_binary_message_received(self, data):
+        """
+        Slot called when a binary frame is received from the WebSocket.
+
+        Args:
+            data (QByteArray): The frame received from the backend.
+        """
+        self.handle_message(unpack_arrays(*decode_frame(bytes(data))))
+
     def on_message_received(self, message):
         """
         Slot called when a message is received from the WebSocket.
-        Emits the inference_received signal with the result.
+        Emits the inference_received signal with results, the error_received
+        signal with the request ID and message of errors and the progress_received
+        signal with the request ID and progress of running requests.
 
         Args:
             message (str): The message received from the backend.
         """
-        result = json.loads(message)
-        print("Received Result!")
-        self.inference_received.emit(result)
+        self.handle_message(json.loads(message))
+
+    def handle_message(self, message):
+        """
+        Emits the signals for a decoded message.
+
+        Args:
+            message (dict): The message received from the backend.
+        """
+        message_type = message.get("type", "result")
+        if message_type == "hello":
+            self.binary = "binary" in message.get("encodings", [])
+            self.compression = message.get("compression", [])
+        elif message_type == "result":
+            print("Received Result!")
+            self.inference_received.emit(message)
+        elif message_type == "sweep":
+            print(f"Sweep {message.get('request_id')} runs {len(message.get('points', []))} requests")
+            self.sweep_received.emit(message.get("request_id", ""), message.get("points", []))
+        elif message_type == "queued" and "position" in message:
+            print(
+                f"Request {message.get('request_id')} is queued at position {message['position']}, "
+                f"estimated start in {message.get('estimated_start')}s"
+            )
+        elif message_type == "busy":
+            print(f"Backend is busy: {message.get('message')}")
+            self.error_received.emit(message.get("request_id", ""), message.get("message", ""))
+        elif message_type == "cancelled":
+            print(f"Cancelled request {message.get('request_id')}")
+        elif message_type == "expired":
+            print(f"Request {message.get('request_id')} expired: {message.get('message')}")
+            self.error_received.emit(message.get("request_id", ""), message.get("message", ""))
+        elif message_type == "progress":
+            self.progress_received.emit(message.get("request_id", ""), message)
+        elif message_type == "error":
+            print(f"Received Error: {message.get('message')}")
+            self.error_received.emit(message.get("request_id", ""), message.get("message", ""))
@@ -4,6 +4,8 @@ extends Node
 signal connected()
 signal disconnected()
 signal results_received(results: InferenceResults)
+signal progress_received(stage: String, step: int, total: int, eta: float)
+signal queued_received(position: int, estimated_start: float)
 
 # The URL we will connect to.
 @export var websocket_url = ""
@@ -44,6 +46,32 @@ func infer(infer_args: InferenceArgs):
 		print(text)
 	socket.send_text(text)
 
+func _handle_packet(packet: String):
+	# Messages carry a type and the request_id they belong to, results may carry no type
+	var data = JSON.parse_string(packet)
+	if not data is Dictionary:
+		print("Failed to parse Backend message")
+		return
+	match data.get("type", "result"):
+		"result":
+			results_received.emit(InferenceResults.from_json(packet))
+		"progress":
+			var eta = data.get("eta")
+			progress_received.emit(data.get("stage", ""), int(data.get("step", 0)), int(data.get("total", 1)), eta if eta != null else -1.0)
+		"queued":
+			if data.has("position"):
+				var estimated_start = data.get("estimated_start")
+				queued_received.emit(int(data["position"]), estimated_start if estimated_start != null else -1.0)
+		"busy":
+			print("Backend is busy, retry after %ss" % data.get("retry_after", ""))
+		"expired":
+			print("Backend dropped request %s: %s" % [data.get("request_id", ""), data.get("message", "")])
+		"error":
+			print("Backend error for request %s: %s" % [data.get("request_id", ""), data.get("message", "")])
+		_:
+			if OS.has_feature("debug"):
+				print("Backend message: ", data.get("type"))
+
 func _connect():
 	# Initiate connection to the given URL.
 	if socket.get_ready_state() != WebSocketPeer.STATE_CLOSED:
@@ -69,7 +97,7 @@ func _physics_process(_delta: float) -> void:
 				connected.emit()
 			while socket.get_available_packet_count():
 				var packet = socket.get_packet().get_string_from_utf8()
-				results_received.emit(InferenceResults.from_json(packet))
+				_handle_packet(packet)
 		WebSocketPeer.STATE_CLOSED:
 			if last_connected:
 				var code = socket.get_close_code()
@@ -4,7 +4,27 @@ extends HBoxContainer
 # var progress: int = 100
 # var indeterminate: bool = false
 
+func _ready():
+	Backend.progress_received.connect(_on_progress_received)
+	Backend.queued_received.connect(_on_queued_received)
+	Backend.results_received.connect(_on_results_received)
+
 func set_status(status: String, progress: int, indeterminate: bool):
 	%StatusLineEdit.text = status
 	%ProgressBar.value = progress
 	%ProgressBar.indeterminate = indeterminate
+
+func _on_progress_received(stage: String, step: int, total: int, eta: float):
+	var status = "Generating: %s %d/%d" % [stage.capitalize(), step, total]
+	if eta >= 0.0:
+		status += " (%ds left)" % ceili(eta)
+	set_status(status, 100 * step / max(total, 1), false)
+
+func _on_queued_received(position: int, estimated_start: float):
+	var status = "Queued at position %d" % (position + 1)
+	if estimated_start >= 0.0:
+		status += " (starts in ~%ds)" % ceili(estimated_start)
+	set_status(status, 0, true)
+
+func _on_results_received(_results: InferenceResults):
+	set_status("Generation finished", 100, false)
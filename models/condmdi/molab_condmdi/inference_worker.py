@@ -1,6 +1,10 @@
+import hashlib
 import json
+import threading
+from collections import OrderedDict
 from dataclasses import dataclass, field
 from pathlib import Path
+from typing import Callable, Optional
 
 import numpy as np
 import pandas as pd
@@ -86,6 +90,8 @@ class InferenceArgs(GenerateOptions, CondSyntOptions, CustomSyntOptions):
         imputate: Flag to enable imputation between inference steps. Default is False.
         reconstruction_guidance: Flag to enable reconstruction guidance during
             inference. Default is False.
+        seed: Random seed for this request, makes the results reproducible.
+            Default is None (continue with the current random state).
     """
 
     # A mapping of frame indices to poses (J+1, 3) where J is the number of joints.
@@ -96,6 +102,7 @@ class InferenceArgs(GenerateOptions, CondSyntOptions, CustomSyntOptions):
     jacobian_ik: bool = field(default=False)
     foot_ik: bool = field(default=False)
     unpack_randomness: float = 0.0
+    seed: Optional[int] = None
     unpack_mode: str = field(
         default="linear",
         metadata={
@@ -107,6 +114,10 @@ class InferenceArgs(GenerateOptions, CondSyntOptions, CustomSyntOptions):
     )
 
 
+class InferenceCancelled(Exception):
+    """Raised by a progress callback to stop an inference between two steps."""
+
+
 class InferenceResults(BaseModel):
     """Inference results containing samples and input motions.
 
@@ -311,6 +322,10 @@ def get_abs_data_from_jointpos(joint_positions: np.ndarray) -> torch.Tensor:
     return torch.from_numpy(abs_data).float(), pre_y, pre_xz, pre_rot
 
 
+# Number of preprocessed input motions kept for requests with the same input
+PREPROCESS_CACHE_SIZE = 8
+
+
 class MotionInferenceWorker:
     def __init__(self, name: str, model_args: ModelArgs):
         """Initialize the worker and parse arguments without starting the model."""
@@ -321,6 +336,9 @@ class MotionInferenceWorker:
         self.model = None
         self.diffusion = None
 
+        self.preprocess_cache: OrderedDict[str, tuple] = OrderedDict()
+        self.preprocess_lock = threading.Lock()
+
         self.start()
 
     def get_output_path(
@@ -442,13 +460,79 @@ class MotionInferenceWorker:
         self.dataloader = None
         self.model = None
         self.diffusion = None
+        self.preprocess_cache.clear()
+
+    def _preprocess_key(self, infer_config: InferenceArgs) -> Optional[str]:
+        """Identifies the input motion of deterministic preprocessing, None otherwise."""
+        if infer_config.bvh_path != "":
+            path = Path(infer_config.bvh_path)
+            if not path.is_file():
+                return None
+            return f"bvh:{path.resolve()}:{path.stat().st_mtime_ns}"
+        if infer_config.packed_motion and infer_config.unpack_randomness == 0:
+            motion = json.dumps(infer_config.packed_motion, sort_keys=True).encode()
+            return f"packed:{infer_config.unpack_mode}:{hashlib.sha256(motion).hexdigest()}"
+        return None
+
+    def preprocess(self, infer_config: InferenceArgs) -> tuple:
+        """Convert the input motion to the hml3d format.
+
+        The results are cached, so requests that only differ in their sampling
+        options, e.g. the points of a parameter sweep, share the preprocessing.
+        Unpacking with randomness is never cached.
+
+        Args:
+            infer_config (InferenceArgs): The arguments for motion inference.
+
+        Returns:
+            tuple: The preprocessed motion, the joint mask of the observed frames
+                and the `pre_y`, `pre_xz` and `pre_rot` to undo the preprocessing,
+                all None if no input motion is given. Must not be modified.
+        """
+        key = self._preprocess_key(infer_config)
+        if key is not None:
+            with self.preprocess_lock:
+                if key in self.preprocess_cache:
+                    self.preprocess_cache.move_to_end(key)
+                    return self.preprocess_cache[key]
+
+        input_joint_mask = None
+        if infer_config.bvh_path != "":
+            # Load BVH and convert it to hml3d format
+            input_motion_preprocessed, pre_y, pre_xz, pre_rot = get_abs_data_from_jointpos(
+                get_jointpos_from_bvh(Path(infer_config.bvh_path))
+            )
+        elif infer_config.packed_motion:
+            # Unpack sparse keyframes and convert them to hml3d format
+            _root_pos, _rotations, input_joint_mask = unpack_motion(
+                infer_config.packed_motion,
+                mode=infer_config.unpack_mode,
+                randomness=infer_config.unpack_randomness,
+            )
+            keyframe_pos = unpacked_motion_to_jointpos(_root_pos, _rotations)
+            input_motion_preprocessed, pre_y, pre_xz, pre_rot = get_abs_data_from_jointpos(
+                keyframe_pos
+            )
+        else:
+            return None, None, None, None, None
+
+        preprocessed = (input_motion_preprocessed, input_joint_mask, pre_y, pre_xz, pre_rot)
+        if key is not None:
+            with self.preprocess_lock:
+                self.preprocess_cache[key] = preprocessed
+                while len(self.preprocess_cache) > PREPROCESS_CACHE_SIZE:
+                    self.preprocess_cache.popitem(last=False)
+        return preprocessed
 
     def restart(self):
         self.stop()
         self.start()
 
     def infer(
-        self, infer_config: InferenceArgs, save_results: bool = True
+        self,
+        infer_config: InferenceArgs,
+        save_results: bool = True,
+        progress: Optional[Callable[[str, int, int], None]] = None,
     ) -> InferenceResults:
         """Infer using InferenceArgs and return InferenceResults, optionally
         save intermediate results to output directory.
@@ -456,10 +540,22 @@ class MotionInferenceWorker:
         Args:
             infer_config (InferenceArgs): The arguments for motion inference.
             save_results (bool, optional): Whether to save outputs to disk. Defaults to True.
+            progress (Callable[[str, int, int], None], optional): Called with the
+                current stage ("preprocess", "sampling", "ik" or "serialize"), the
+                number of finished steps and the total steps of the stage.
+                It is called from the inference thread, once per diffusion step,
+                and may raise `InferenceCancelled` to stop the inference.
 
         Returns:
             InferenceResults: The generated motion.
         """
+        if progress is None:
+            progress = lambda stage, step, total: None  # noqa: E731
+        progress("preprocess", 0, 1)
+
+        if infer_config.seed is not None:
+            fixseed(infer_config.seed)
+
         ###########################################################################
         # * Prepare Text and Motion Inputs for Sampling
         ###########################################################################
@@ -487,26 +583,10 @@ class MotionInferenceWorker:
             texts = [""] * infer_config.num_samples
             infer_config.guidance_param = 0.0  # Force unconditioned generation
 
-        input_joint_mask = None
-        input_motion_preprocessed = None
-
         # Handle Motion Input
-        if infer_config.bvh_path != "":
-            # Load BVH and convert it to hml3d format
-            input_motion_preprocessed, pre_y, pre_xz, pre_rot = get_abs_data_from_jointpos(
-                get_jointpos_from_bvh(Path(infer_config.bvh_path))
-            )
-        elif infer_config.packed_motion:
-            # Unpack sparse keyframes and convert them to hml3d format
-            _root_pos, _rotations, input_joint_mask = unpack_motion(
-                infer_config.packed_motion,
-                mode=infer_config.unpack_mode,
-                randomness=infer_config.unpack_randomness,
-            )
-            keyframe_pos = unpacked_motion_to_jointpos(_root_pos, _rotations)
-            input_motion_preprocessed, pre_y, pre_xz, pre_rot = get_abs_data_from_jointpos(
-                keyframe_pos
-            )
+        input_motion_preprocessed, input_joint_mask, pre_y, pre_xz, pre_rot = self.preprocess(
+            infer_config
+        )
 
         if input_motion_preprocessed is not None:
             # Normalize the motion
@@ -677,10 +757,13 @@ class MotionInferenceWorker:
         else:
             model_to_sample = self.model
 
-        for _ in tqdm.trange(
+        num_steps = self.diffusion.num_timesteps * self.model_config.num_repetitions
+        progress("sampling", 0, num_steps)
+        for i_rep in tqdm.trange(
             self.model_config.num_repetitions, desc="Sampling Repetitions"
         ):
-            sample = self.diffusion.p_sample_loop(
+            # Same as `p_sample_loop`, but reports every diffusion step
+            for i_step, out in enumerate(self.diffusion.p_sample_loop_progressive(
                 model_to_sample,
                 (
                     infer_config.num_samples,
@@ -693,10 +776,13 @@ class MotionInferenceWorker:
                 skip_timesteps=0,  # 0 is the default value - i.e. don't skip any step
                 init_image=None,
                 progress=True,
-                dump_steps=None,
                 noise=None,
                 const_noise=False,
-            )  # [nsamples, njoints, nfeats, nframes]
+            )):
+                progress(
+                    "sampling", i_rep * self.diffusion.num_timesteps + i_step + 1, num_steps
+                )
+            sample = out["sample"]  # [nsamples, njoints, nfeats, nframes]
 
             ###########################################################################
             # * Post-Processing Samples
@@ -755,6 +841,8 @@ class MotionInferenceWorker:
             json.dump(vars(infer_config), fw, indent=4, sort_keys=True)
 
         converter = joints2bvh.Joint2BVHConvertor()
+        num_conversions = infer_config.num_samples * (1 + self.model_config.num_repetitions)
+        progress("ik", 0, num_conversions)
 
         all_postpro_obs_motions_pos = []
         all_postpro_obs_motions_rot = []
@@ -780,6 +868,7 @@ class MotionInferenceWorker:
             all_postpro_obs_motions_rot.append(
                 np.rad2deg(new_anim.rotations.euler(order="xyz"))
             )
+            progress("ik", len(all_postpro_obs_motions_rot), num_conversions)
 
         all_postpro_motions_pos = []
         all_postpro_motions_rot = []
@@ -807,7 +896,13 @@ class MotionInferenceWorker:
                 all_postpro_motions_rot.append(
                     np.rad2deg(new_anim.rotations.euler(order="zyx"[::-1])) # see BVH.py:245
                 )
+                progress(
+                    "ik",
+                    len(all_postpro_obs_motions_rot) + len(all_postpro_motions_rot),
+                    num_conversions,
+                )
 
+        progress("serialize", 0, 1)
         if save_results:
             # TODO: Clean that up at some point, or output only in debug mode.
             results_dict = {
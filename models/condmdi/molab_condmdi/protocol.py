@@ -0,0 +1,169 @@
+"""Binary framing of the gateway protocol, see `molab_backend.protocol`.
+
+A binary frame consists of the 4-byte magic `MOLB`, the length of the JSON header
+as unsigned 32-bit little-endian integer, the UTF-8 encoded JSON header and the
+body holding the little-endian float32 arrays listed in the `arrays` header field.
+Large bodies can be byte shuffled and compressed with a negotiated compression
+named in the `compression` header field.
+"""
+
+import json
+import struct
+import zlib
+
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MAGIC = b"MOLB"
+HEADER_LENGTH = struct.Struct("<I")
+ENCODINGS = ["binary", "json"]
+# Supported body compressions, preferred first, zstd needs the optional `zstandard` package
+COMPRESSIONS = ["zstd", "zlib"] if zstandard is not None else ["zlib"]
+# Bodies smaller than this are sent uncompressed, in bytes
+COMPRESSION_THRESHOLD = 16 * 2**10
+
+# Fields of `InferenceResults` sent as arrays
+RESULT_ARRAYS = [
+    "root_positions",
+    "joint_rotations",
+    "obs_root_positions",
+    "obs_joint_rotations",
+]
+
+
+def encode_frame(message: dict, body: bytes = b"") -> bytes:
+    """Encode a message and its body as binary frame."""
+    header = json.dumps(message, separators=(",", ":")).encode()
+    return b"".join((MAGIC, HEADER_LENGTH.pack(len(header)), header, body))
+
+
+def decode_frame(data: bytes) -> tuple[dict, bytes]:
+    """Split a binary frame into its message header and body.
+
+    Raises:
+        ValueError: If the data is not a valid frame.
+    """
+    if data[:4] != MAGIC or len(data) < 4 + HEADER_LENGTH.size:
+        raise ValueError("Not a MoLab frame")
+    (header_length,) = HEADER_LENGTH.unpack_from(data, 4)
+    start = 4 + HEADER_LENGTH.size
+    return json.loads(data[start : start + header_length]), data[start + header_length :]
+
+
+def pack_arrays(message: dict, names: list[str]) -> tuple[dict, bytes]:
+    """Move the given fields of a message into a float32 body.
+
+    Fields that are missing or can not be converted to a float32 array, e.g.
+    because they are ragged, stay in the header.
+
+    Args:
+        message (dict): The message with nested lists or arrays.
+        names (list[str]): The fields to move into the body.
+
+    Returns:
+        tuple[dict, bytes]: The message header and the body.
+    """
+    message = dict(message)
+    arrays = {}
+    buffers = []
+    for name in names:
+        value = message.get(name)
+        descriptor = {}
+        if isinstance(value, dict):
+            descriptor["keys"] = list(value.keys())
+            value = list(value.values())
+        if value is None:
+            continue
+        try:
+            value = np.asarray(value, dtype="<f4")
+        except (TypeError, ValueError):
+            continue
+        arrays[name] = {**descriptor, "shape": list(value.shape), "dtype": "<f4"}
+        buffers.append(value.tobytes())
+        del message[name]
+    if arrays:
+        message["arrays"] = arrays
+    return message, b"".join(buffers)
+
+
+def unpack_arrays(message: dict, body: bytes) -> dict:
+    """Decode the float32 body of a message back into nested lists in the header.
+
+    Args:
+        message (dict): The message header with its `arrays` descriptors.
+        body (bytes): The body of the frame, possibly compressed.
+
+    Returns:
+        dict: The message as it would have been sent as JSON.
+    """
+    message, body = decompress_body(message, body)
+    message = dict(message)
+    offset = 0
+    for name, descriptor in message.pop("arrays", {}).items():
+        count = int(np.prod(descriptor["shape"]))
+        value = np.frombuffer(body, dtype="<f4", count=count, offset=offset)
+        offset += 4 * count
+        value = value.reshape(descriptor["shape"]).tolist()
+        if "keys" in descriptor:
+            value = dict(zip(descriptor["keys"], value))
+        message[name] = value
+    return message
+
+
+def compress_body(
+    message: dict,
+    body: bytes,
+    compressions: list,
+    threshold: int = COMPRESSION_THRESHOLD,
+) -> tuple[dict, bytes]:
+    """Compress the byte shuffled body of a message with the first supported compression.
+
+    Bodies below the threshold, bodies that are already compressed and bodies
+    that do not get smaller are left as they are.
+
+    Args:
+        message (dict): The message header.
+        body (bytes): The float32 body.
+        compressions (list): The compressions negotiated with the receiver, preferred first.
+        threshold (int): The minimum size of the body to compress, in bytes.
+
+    Returns:
+        tuple[dict, bytes]: The message header, naming the `compression` if
+            applied, and the body.
+    """
+    if "compression" in message or len(body) < threshold or len(body) % 4:
+        return message, body
+    compression = next((c for c in compressions if c in COMPRESSIONS), None)
+    if compression is None:
+        return message, body
+    shuffled = np.frombuffer(body, dtype=np.uint8).reshape(-1, 4).T.tobytes()
+    if compression == "zstd":
+        data = zstandard.ZstdCompressor(level=3).compress(shuffled)
+    else:
+        data = zlib.compress(shuffled, 6)
+    if len(data) >= len(body):
+        return message, body
+    return {**message, "compression": compression}, data
+
+
+def decompress_body(message: dict, body: bytes) -> tuple[dict, bytes]:
+    """Undo `compress_body`.
+
+    Raises:
+        ValueError: If the compression is not supported.
+    """
+    compression = message.get("compression")
+    if compression is None:
+        return message, body
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unsupported compression {compression!r}")
+    if compression == "zstd":
+        data = zstandard.ZstdDecompressor().decompress(body)
+    else:
+        data = zlib.decompress(body)
+    message = {k: v for k, v in message.items() if k != "compression"}
+    return message, np.frombuffer(data, dtype=np.uint8).reshape(4, -1).T.tobytes()
@@ -1,25 +1,118 @@
 import asyncio
+import contextlib
+import functools
 import json
 import logging
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Optional
 
+import torch
 import websockets
 
 from molab_condmdi.inference_worker import (
     InferenceArgs,
+    InferenceCancelled,
     InferenceResults,
     ModelArgs,
     MotionInferenceWorker,
 )
+from molab_condmdi.protocol import (
+    COMPRESSION_THRESHOLD,
+    COMPRESSIONS,
+    ENCODINGS,
+    RESULT_ARRAYS,
+    compress_body,
+    decode_frame,
+    encode_frame,
+    pack_arrays,
+    unpack_arrays,
+)
+from molab_condmdi.utils import dist_util
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("worker")
 
+# Samplers the worker can run, announced to the gateway on registration
+SAMPLERS = ["ddpm"]
+
+
+class ProgressReporter:
+    """Sends throttled `progress` messages of a single inference to the gateway.
+
+    Called from the inference thread, the messages are sent on the event loop
+    without waiting for them, so reporting never slows down the inference.
+    As it is called between all diffusion steps, it also stops cancelled inferences.
+    """
+
+    def __init__(
+        self,
+        websocket,
+        request_id: str,
+        interval: float,
+        loop: asyncio.AbstractEventLoop,
+        cancelled: threading.Event,
+    ):
+        """
+        Args:
+            websocket: The connection to the gateway.
+            request_id (str): The ID of the inference request.
+            interval (float): The minimum number of seconds between two messages
+                of the same stage, the first and last step are always sent.
+            loop (asyncio.AbstractEventLoop): The event loop of the connection.
+            cancelled (threading.Event): Set when the gateway cancels the request.
+        """
+        self.websocket = websocket
+        self.request_id = request_id
+        self.interval = interval
+        self.loop = loop
+        self.cancelled = cancelled
+        self.stage = ""
+        self.stage_started = 0.0
+        self.last_sent = 0.0
+
+    def __call__(self, stage: str, step: int, total: int):
+        if self.cancelled.is_set():
+            raise InferenceCancelled(self.request_id)
+
+        now = time.monotonic()
+        if stage != self.stage:
+            self.stage = stage
+            self.stage_started = now
+        elif step < total and now - self.last_sent < self.interval:
+            return
+        self.last_sent = now
+
+        eta: Optional[float] = None
+        if step > 0:
+            eta = round((now - self.stage_started) / step * (total - step), 1)
+        message = {
+            "type": "progress",
+            "request_id": self.request_id,
+            "stage": stage,
+            "step": step,
+            "total": total,
+            "eta": eta,
+        }
+        asyncio.run_coroutine_threadsafe(self.send(message), self.loop)
+
+    async def send(self, message: dict):
+        with contextlib.suppress(websockets.ConnectionClosed):
+            await self.websocket.send(json.dumps(message))
+
 
 class WebSocketWorker:
     def __init__(
-        self, backend_host="localhost", backend_port=8000, checkpoint="random_frames"
+        self,
+        backend_host="localhost",
+        backend_port=8000,
+        checkpoint="random_frames",
+        capacity=1,
+        progress_interval=0.5,
+        compression_threshold=COMPRESSION_THRESHOLD,
     ):
         """Initialize the WebSocketWorker.
 
@@ -28,12 +121,28 @@ class WebSocketWorker:
             backend_port (int): The port number of the backend server. Defaults to 8000.
             checkpoint (str): The name of the checkpoint to be used, current choices are
                 "random_frames" (Default) or "random_joints".
+            capacity (int): The number of inference requests processed concurrently,
+                advertised to the gateway on registration. Defaults to 1.
+            progress_interval (float): The minimum number of seconds between two
+                progress messages of a request. Defaults to 0.5.
+            compression_threshold (int): The minimum size in bytes of a binary result
+                body to compress. Defaults to 16 KiB.
 
         Attributes:
             inference_worker (None): Placeholder for the inference worker.
             uri (str): The WebSocket URI for registering the worker.
             checkpoint (str): The name of the checkpoint.
             checkpoint_path (Path): The path to the model checkpoint file.
+            capacity (int): The number of concurrent inference requests.
+            progress_interval (float): The throttling of progress messages.
+            executor (ThreadPoolExecutor): The threads running the inferences.
+            tasks (set[asyncio.Task]): The inference requests currently processed.
+            cancel_events (dict[str, threading.Event]): Cancellation flags of the
+                running requests, keyed by request ID.
+            binary (bool): Whether the gateway accepts binary frames, negotiated
+                on registration.
+            compression (list[str]): The compressions of binary bodies the gateway
+                accepts, negotiated on registration.
 
         Raises:
             FileNotFoundError: If the model checkpoint file is not found at the specified path.
@@ -49,6 +158,28 @@ class WebSocketWorker:
         )
         if not self.checkpoint_path.is_file():
             raise FileNotFoundError(f"Model checkpoint not found at [{self.checkpoint_path}]")
+        self.capacity = max(1, int(capacity))
+        self.executor = ThreadPoolExecutor(max_workers=self.capacity)
+        self.tasks: set[asyncio.Task] = set()
+        self.cancel_events: dict[str, threading.Event] = {}
+        self.progress_interval = float(progress_interval)
+        self.binary = False
+        self.compression: list[str] = []
+        self.compression_threshold = int(compression_threshold)
+
+    @property
+    def checkpoint_identity(self) -> str:
+        """Identifies the loaded model, so the gateway only reuses results of the same model."""
+        stat = self.checkpoint_path.stat()
+        return f"{self.checkpoint_path.parent.name}/{self.checkpoint_path.name}:{stat.st_size}:{int(stat.st_mtime)}"
+
+    @property
+    def device_class(self) -> str:
+        """The name of the GPU the model runs on, or the device type, e.g. "cpu"."""
+        device = dist_util.dev()
+        if device.type == "cuda":
+            return torch.cuda.get_device_name(device)
+        return device.type
 
     def setup(self):
         """Start the `MotionInferenceWorker`."""
@@ -68,14 +199,82 @@ class WebSocketWorker:
             f"{self.checkpoint}_worker", model_args
         )
 
+    async def send_status(self, websocket):
+        """Report the number of running inference requests to the gateway."""
+        with contextlib.suppress(websockets.ConnectionClosed):
+            await websocket.send(json.dumps({"type": "status", "load": len(self.tasks)}))
+
+    async def infer(self, websocket, message: dict):
+        """Run a single inference request and send the result to the gateway.
+
+        While running, `progress` messages report the current stage, step and
+        the estimated seconds until the stage finishes. Failed requests are
+        answered with an `error` message instead, cancelled requests stop after
+        the current diffusion step and are answered with a `cancelled` message.
+
+        Args:
+            websocket: The connection to the gateway.
+            message (dict): The inference request, tagged with a `request_id`.
+        """
+        logger.info("Worker received inference request")
+
+        del message["type"]
+        request_id = message.pop("request_id", None)
+        cancelled = self.cancel_events.setdefault(request_id, threading.Event())
+        try:
+            inference_args = InferenceArgs(**message)
+            loop = asyncio.get_running_loop()
+            progress = ProgressReporter(
+                websocket, request_id, self.progress_interval, loop, cancelled
+            )
+            result: InferenceResults = await loop.run_in_executor(
+                self.executor,
+                functools.partial(self.inference_worker.infer, inference_args, progress=progress),
+            )
+        except InferenceCancelled:
+            logger.info(f"Worker cancelled inference {request_id}")
+            response = {"type": "cancelled", "request_id": request_id}
+        except Exception as e:
+            logger.exception("Worker failed inference")
+            response = {"type": "error", "request_id": request_id, "message": str(e)}
+        else:
+            logger.info("Worker finished inference")
+            response = {**result.model_dump(), "type": "result", "request_id": request_id}
+            if self.binary:
+                header, body = compress_body(
+                    *pack_arrays(response, RESULT_ARRAYS),
+                    self.compression,
+                    self.compression_threshold,
+                )
+                await websocket.send(encode_frame(header, body))
+                return
+        finally:
+            self.cancel_events.pop(request_id, None)
+        await websocket.send(json.dumps(response))
+
     async def serve(self):
         """Connect to the gateway and wait for inference requests."""
-        async with websockets.connect(self.uri) as websocket:
+        # Bodies are compressed per frame, see `compress_body`
+        async with websockets.connect(self.uri, compression=None) as websocket:
             logger.info("Worker connected to gateway")
             if __debug__:
                 logger.debug("Asserts are enabled!")
             else:
                 logger.debug("Asserts are disabled!")
+            await websocket.send(
+                json.dumps({
+                    "type": "register",
+                    "capacity": self.capacity,
+                    "model": self.checkpoint,
+                    "checkpoint": self.checkpoint_identity,
+                    "samplers": SAMPLERS,
+                    "max_frames": self.inference_worker.max_frames,
+                    "device": self.device_class,
+                    "encodings": ENCODINGS,
+                    "compression": COMPRESSIONS,
+                    "pid": os.getpid(),
+                })
+            )
             try:
                 while True:
                     try:
@@ -85,33 +284,48 @@ class WebSocketWorker:
                             continue
 
                         try:
-                            message = json.loads(message)
-                        except json.JSONDecodeError:
+                            if isinstance(message, bytes):
+                                message = unpack_arrays(*decode_frame(message))
+                            else:
+                                message = json.loads(message)
+                        except ValueError:
                             logger.exception(f"Failed to decode message:\n{message}")
-                            await websocket.send("Failed to decode message")
+                            await websocket.send(
+                                json.dumps({"type": "error", "message": "Failed to decode message"})
+                            )
                             continue
 
-                        if message["type"] == "infer":
-                            logger.info("Worker received inference request")
-
-                            del message["type"]
-                            inference_args = InferenceArgs(**message)
-                            result: InferenceResults = (
-                                await asyncio.get_event_loop().run_in_executor(
-                                    None, self.inference_worker.infer, inference_args
-                                )
+                        if message["type"] == "registered":
+                            self.binary = "binary" in message.get("encodings", [])
+                            self.compression = message.get("compression", [])
+                            logger.info(
+                                f"Worker registered, binary frames: {self.binary}, "
+                                f"compression: {self.compression}"
                             )
-
-                            logger.info("Worker finished inference")
-                            await websocket.send(json.dumps(result.model_dump()))
+                        elif message["type"] == "cancel":
+                            event = self.cancel_events.get(message.get("request_id"))
+                            if event is not None:
+                                event.set()
+                        elif message["type"] == "infer":
+                            task = asyncio.create_task(self.infer(websocket, message))
+                            self.tasks.add(task)
+                            task.add_done_callback(self.tasks.discard)
+                            task.add_done_callback(
+                                lambda _: asyncio.create_task(self.send_status(websocket))
+                            )
+                            await self.send_status(websocket)
                         else:
                             logger.error(f"Unknown message type:\n{message}")
-                            await websocket.send("Unknown message type")
+                            await websocket.send(
+                                json.dumps({"type": "error", "message": "Unknown message type"})
+                            )
 
                     except websockets.ConnectionClosed:
                         logger.info("Connection to gateway closed")
                         break
             finally:
+                for task in self.tasks:
+                    task.cancel()
                 self.inference_worker.stop()
 
     def run(self):
@@ -124,7 +338,10 @@ def main():
     WebSocketWorker(
         backend_host=os.getenv("MOLAB_GATEWAY_HOST", "localhost"),
         backend_port=os.getenv("MOLAB_GATEWAY_PORT", "8000"),
-        checkpoint="random_frames",  # or "random_joints"
+        checkpoint=os.getenv("MOLAB_WORKER_CHECKPOINT", "random_frames"),  # or "random_joints"
+        capacity=os.getenv("MOLAB_WORKER_CAPACITY", "1"),
+        progress_interval=os.getenv("MOLAB_PROGRESS_INTERVAL", "0.5"),
+        compression_threshold=os.getenv("MOLAB_COMPRESSION_THRESHOLD", str(COMPRESSION_THRESHOLD)),
     ).run()
 
 